@@ -0,0 +1,417 @@
+"""截图工具性能基准
+
+用法: python benchmark.py [基准名 ...]   不带参数时运行全部基准
+"""
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import screenshot_tool
+
+
+def make_ui_image(megapixels, seed=0):
+    """生成近似界面截图的测试图像：纯色块、文字和一小块照片噪声"""
+    rng = np.random.default_rng(seed)
+    width = int((megapixels * 1e6 * 16 / 9) ** 0.5)
+    height = int(megapixels * 1e6 / width)
+    image = np.full((height, width, 3), 240, dtype=np.uint8)
+    for _ in range(int(40 * megapixels)):
+        x, y = rng.integers(0, width), rng.integers(0, height)
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.rectangle(image, (int(x), int(y)), (int(x + rng.integers(20, 400)), int(y + rng.integers(10, 200))), color, -1)
+    for row in range(30, height, 40):
+        cv2.putText(image, "Screenshot tool benchmark 0123456789", (20, row),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, (20, 20, 20), 1, cv2.LINE_AA)
+    image[:height // 8, :width // 8] = rng.integers(0, 256, (height // 8, width // 8, 3), dtype=np.uint8)
+    return image
+
+
+def make_flat_ui_image(megapixels, colors=120, seed=0):
+    """生成不超过 colors+2 种颜色的扁平界面图像（文字不抗锯齿）"""
+    rng = np.random.default_rng(seed)
+    width = int((megapixels * 1e6 * 16 / 9) ** 0.5)
+    height = int(megapixels * 1e6 / width)
+    palette = rng.integers(0, 256, (colors, 3))
+    image = np.full((height, width, 3), 240, dtype=np.uint8)
+    for _ in range(int(40 * megapixels)):
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        color = tuple(int(c) for c in palette[rng.integers(0, colors)])
+        cv2.rectangle(image, (x, y), (x + int(rng.integers(20, 400)), y + int(rng.integers(10, 200))), color, -1)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    for row in range(30, height, 40):
+        cv2.putText(mask, "Screenshot tool benchmark 0123456789", (20, row), cv2.FONT_HERSHEY_SIMPLEX, 0.6, 255, 1)
+    image[mask > 127] = (20, 20, 20)
+    return image
+
+
+def make_photo_image(megapixels, seed=0):
+    """生成近似照片的测试图像：平滑色块插值后叠加细噪声"""
+    rng = np.random.default_rng(seed)
+    width = int((megapixels * 1e6 * 16 / 9) ** 0.5)
+    height = int(megapixels * 1e6 / width)
+    small = rng.integers(0, 256, (max(2, height // 40), max(2, width // 40), 3), dtype=np.uint8)
+    image = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+    return cv2.add(image, rng.integers(0, 12, (height, width, 3), dtype=np.uint8))
+
+
+def timeit(func, repeat=3):
+    """返回多次运行中的最短耗时（秒）和最后一次的结果"""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def bench_png():
+    """cv2.imencode 与多线程 PNG 编码对比"""
+    workers = screenshot_tool.png_worker_count()
+    print(f"PNG 压缩线程: {workers}" + ("（单核时保存走 cv2.imencode）" if workers < 2 else ""))
+    print(f"{'MP':>4} {'cv2 ms':>9} {'cv2 KB':>9} {'并行 ms':>9} {'并行 KB':>9} {'加速':>6}")
+    for megapixels in (1, 2, 4, 8, 16, 32):
+        image = make_ui_image(megapixels)
+        cv2_time, cv2_data = timeit(lambda: cv2.imencode(".png", image)[1])
+        par_time, par_data = timeit(lambda: screenshot_tool.encode_png_parallel(image))
+        decoded = cv2.imdecode(np.frombuffer(par_data, np.uint8), cv2.IMREAD_UNCHANGED)
+        assert np.array_equal(decoded, image), "并行PNG解码结果不一致"
+        print(f"{megapixels:>4} {cv2_time * 1000:>9.1f} {len(cv2_data) / 1024:>9.0f} "
+              f"{par_time * 1000:>9.1f} {len(par_data) / 1024:>9.0f} {cv2_time / par_time:>6.2f}")
+
+
+def bench_text_detection():
+    """文字区域检测耗时（每百万像素）"""
+    print(f"{'MP':>4} {'区域数':>6} {'ms':>9} {'ms/MP':>9}")
+    for megapixels in (0.5, 1, 2, 4, 8):
+        image = make_ui_image(megapixels)
+        elapsed, regions = timeit(lambda: screenshot_tool.detect_text_regions(image))
+        print(f"{megapixels:>4} {len(regions):>6} {elapsed * 1000:>9.1f} {elapsed * 1000 / megapixels:>9.1f}")
+
+
+def bench_capture_backends():
+    """各抓屏后端的整屏与区域抓取延迟"""
+    from PyQt5.QtCore import QRect
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication(sys.argv)
+    print(f"{'后端':<10} {'尺寸':>11} {'整屏 ms':>9} {'区域 ms':>9}")
+    for spec in ("qt", "xshm", "synthetic"):
+        try:
+            backend = screenshot_tool.CAPTURE_BACKENDS[spec]()
+        except Exception as e:
+            print(f"{spec:<10} 不可用: {e}")
+            continue
+        try:
+            image = backend.grab()
+            if image.isNull():
+                print(f"{spec:<10} 不可用: 抓取结果为空")
+                continue
+            region = QRect(100, 100, 800, 600)
+            full_time, _ = timeit(backend.grab, repeat=20)
+            rect_time, _ = timeit(lambda: backend.grab(region), repeat=20)
+            size = f"{image.width()}x{image.height()}"
+            print(f"{spec:<10} {size:>11} {full_time * 1000:>9.2f} {rect_time * 1000:>9.2f}")
+        finally:
+            backend.close()
+
+
+def bench_selection():
+    """选择框手柄命中检测：逐个比较手柄矩形 vs 坐标区间计算，以及手柄缓存"""
+    from PyQt5.QtCore import QPoint, QRect
+    model = screenshot_tool.SelectionModel()
+    model.rect = QRect(300, 200, 800, 500)
+    rng = np.random.default_rng(0)
+    points = [QPoint(int(x), int(y)) for x, y in zip(rng.integers(250, 1150, 20000), rng.integers(150, 750, 20000))]
+
+    def linear():
+        handles = model.handles()
+        return [next((kind for rect, kind in handles if rect.contains(p)), None) for p in points]
+
+    def zones():
+        return [model.handle_at(p) for p in points]
+
+    def rebuild():
+        for _ in range(len(points) // 10):
+            model._handles_key = None
+            model.handles()
+
+    def cached():
+        for _ in range(len(points) // 10):
+            model.handles()
+
+    linear_time, expected = timeit(linear)
+    zone_time, result = timeit(zones)
+    assert expected == result, "命中检测结果不一致"
+    rebuild_time, _ = timeit(rebuild)
+    cached_time, _ = timeit(cached)
+    per_point = 1e6 / len(points)
+    per_call = 1e6 / (len(points) // 10)
+    print(f"命中检测  逐个比较 {linear_time * per_point:.2f} us  区间计算 {zone_time * per_point:.2f} us")
+    print(f"手柄列表  每次重建 {rebuild_time * per_call:.2f} us  缓存命中 {cached_time * per_call:.2f} us")
+
+
+def bench_idle_memory(cycles=8, bound_mb=32):
+    """显示/隐藏循环后空闲常驻内存相对基线的增长（超出上限则断言失败）"""
+    import os
+    import shutil
+    import tempfile
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtCore import QEvent, QRect, QSettings
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication(sys.argv)
+
+    def settle():
+        # 没有进入事件循环，deleteLater 需要手动投递
+        deadline = time.perf_counter() + 0.7
+        while time.perf_counter() < deadline:
+            app.processEvents()
+            app.sendPostedEvents(None, QEvent.DeferredDelete)
+            time.sleep(0.01)
+
+    # 与 test_idle_memory.py 相同：临时目录中的独立设置，不启动溢写恢复、哈希索引等后台服务
+    directory = tempfile.mkdtemp(prefix="bench_idle_")
+    settings = QSettings(os.path.join(directory, "settings.ini"), QSettings.IniFormat)
+    settings.setValue("save_path", os.path.join(directory, "captures"))
+    settings.setValue("capture_backend", "synthetic")
+    tool = screenshot_tool.ScreenshotTool(settings, background_services=False)
+    tool.capture_backend.close()
+    tool.capture_backend = screenshot_tool.SyntheticCaptureBackend(3840, 2160)
+    tool.capture_screen()
+    tool.setGeometry(0, 0, 3840, 2160)
+    tool.show()
+    settle()
+    baseline = None
+    print(f"{'轮次':>4} {'显示时 MB':>10} {'空闲时 MB':>10} {'缓冲 MB':>9}")
+    for cycle in range(cycles):
+        tool.leave_idle_mode()
+        tool.capture_screen()
+        tool.rect = QRect(200, 200, 1600, 900)
+        tool.repaint()
+        app.processEvents()
+        shown = screenshot_tool.process_rss()
+        tool.hide_screenshot_tool()
+        settle()
+        screenshot_tool.release_free_memory()
+        idle = screenshot_tool.process_rss()
+        held = sum(size for _, size in tool.memory_report()[:-1])
+        if baseline is None:
+            baseline = idle
+        print(f"{cycle:>4} {shown / 2**20:>10.1f} {idle / 2**20:>10.1f} {held / 2**20:>9.1f}")
+        assert held == 0, "空闲时仍持有帧缓冲"
+    growth = (idle - baseline) / 2**20
+    print(f"空闲内存相对基线增长 {growth:.1f} MB（上限 {bound_mb} MB）")
+    tool.quit_application()
+    shutil.rmtree(directory, ignore_errors=True)
+    assert growth <= bound_mb, "空闲常驻内存未回到基线附近"
+
+
+def bench_auto_profile():
+    """自动输出格式：判断耗时、选中的格式以及相对 PNG 的体积"""
+    print(f"{'内容':<6} {'MP':>4} {'判断 ms':>8} {'模式':<10} {'格式':<14} {'编码 ms':>8} {'KB':>8} {'PNG KB':>8}")
+    for megapixels in (2, 8.3):
+        ui = make_ui_image(megapixels)
+        photo = make_photo_image(megapixels)
+        mixed = ui.copy()
+        h, w = mixed.shape[:2]
+        mixed[h // 10:h * 6 // 10, w // 10:w * 6 // 10] = photo[h // 10:h * 6 // 10, w // 10:w * 6 // 10]
+        for kind, image in (("界面", ui), ("照片", photo), ("混合", mixed)):
+            elapsed, _ = timeit(lambda: screenshot_tool.classify_content(image), repeat=5)
+            _, png = screenshot_tool.encode_profile(image, "png")
+            for mode in screenshot_tool.AUTO_PROFILES:
+                profile, _ = screenshot_tool.choose_output_profile(image, mode)
+                encode_time, (_, data) = timeit(lambda: screenshot_tool.encode_profile(image, profile), repeat=1)
+                print(f"{kind:<6} {megapixels:>4} {elapsed * 1000:>8.2f} {mode:<10} {profile:<14} "
+                      f"{encode_time * 1000:>8.0f} {len(data) / 1024:>8.0f} {len(png) / 1024:>8.0f}")
+
+
+def bench_png8():
+    """8 位调色板 PNG 与 cv2 24 位 PNG 的体积和耗时对比"""
+    print(f"{'内容':<8} {'MP':>4} {'cv2 ms':>8} {'cv2 KB':>8} {'PNG8 ms':>8} {'PNG8 KB':>8} {'体积比':>6} {'无损':>4} {'平均误差':>8}")
+    for megapixels in (1, 8.3):
+        for kind, image in (("扁平界面", make_flat_ui_image(megapixels)), ("抗锯齿界面", make_ui_image(megapixels)),
+                            ("照片", make_photo_image(megapixels))):
+            cv2_time, cv2_data = timeit(lambda: cv2.imencode(".png", image)[1])
+            png8_time, png8_data = timeit(lambda: screenshot_tool.encode_png8(image))
+            decoded = cv2.imdecode(np.frombuffer(png8_data, np.uint8), cv2.IMREAD_COLOR)
+            lossless = screenshot_tool.exact_palette(image) is not None
+            if lossless:
+                assert np.array_equal(decoded, image), "调色板 PNG 无损路径结果不一致"
+            error = np.abs(decoded.astype(np.int16) - image).mean()
+            print(f"{kind:<8} {megapixels:>4} {cv2_time * 1000:>8.1f} {len(cv2_data) / 1024:>8.0f} "
+                  f"{png8_time * 1000:>8.1f} {len(png8_data) / 1024:>8.0f} {len(cv2_data) / len(png8_data):>6.1f} "
+                  f"{'是' if lossless else '否':>4} {error:>8.2f}")
+
+
+def bench_similarity(counts=(10_000, 100_000), queries=50):
+    """感知哈希索引：加载耗时与相似截图查询延迟"""
+    import json
+    import os
+    import tempfile
+    rng = np.random.default_rng(0)
+    print(f"{'条目数':>8} {'加载 ms':>9} {'查询 ms':>9} {'命中':>5}")
+    for count in counts:
+        ahashes = rng.integers(0, 2 ** 63, count, dtype=np.uint64)
+        dhashes = rng.integers(0, 2 ** 63, count, dtype=np.uint64)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "hash_index.jsonl")
+            with open(path, "w", encoding="utf-8") as f:
+                for i in range(count):
+                    # 指向索引文件本身，查询时不会被当作已删除的文件清理掉
+                    f.write(json.dumps({"path": path if i == count // 2 else f"{path}#{i}", "mtime": 0,
+                                        "ahash": f"{int(ahashes[i]):016x}", "dhash": f"{int(dhashes[i]):016x}"}) + "\n")
+            start = time.perf_counter()
+            index = screenshot_tool.HashIndex(path)
+            load_time = time.perf_counter() - start
+            # 在某个条目上翻转几位作为查询，保证至少命中一条
+            target = (int(ahashes[count // 2]) ^ 0b1011, int(dhashes[count // 2]) ^ 0b110)
+            query_time, results = timeit(lambda: index.query(target, max_distance=8), repeat=queries)
+            index.stop()
+            assert results and results[0][1] == path, "相似截图查询未命中"
+            print(f"{count:>8} {load_time * 1000:>9.1f} {query_time * 1000:>9.2f} {len(results):>5}")
+
+
+def bench_diff(sizes=(2, 8, 33)):
+    """两张截图的分条像素对比（含平移估计）耗时"""
+    print(f"{'百万像素':>8} {'平移估计 ms':>12} {'对比 ms':>9} {'区域':>5}")
+    for megapixels in sizes:
+        before = make_ui_image(megapixels)
+        after = before.copy()
+        height, width = after.shape[:2]
+        for i in range(5):
+            x, y = width * (i + 1) // 7, height * (i + 1) // 7
+            after[y:y + 60, x:x + 200] = (30 * i, 200, 255 - 30 * i)
+        shift_time, shift = timeit(lambda: screenshot_tool.estimate_shift(before, after))
+        diff_time, (_, boxes, _) = timeit(lambda: screenshot_tool.diff_images(before, after, shift=shift))
+        assert len(boxes) == 5, "变化区域数量不正确"
+        print(f"{megapixels:>8} {shift_time * 1000:>12.1f} {diff_time * 1000:>9.1f} {len(boxes):>5}")
+
+
+def bench_region_presets(count=8):
+    """从同一帧按多个预设区域截图：逐个编码与线程池并行编码对比"""
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    frame = cv2.cvtColor(make_ui_image(8), cv2.COLOR_BGR2BGRA)
+    height, width = frame.shape[:2]
+    regions = [(f"r{i}", (i % 4) * width // 4, (i // 4) * height // 2, width // 4, height // 2) for i in range(count)]
+    writer = screenshot_tool.AtomicFileWriter()
+    print(f"{'区域数':>6} {'工作线程':>8} {'耗时 ms':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        for workers in (1, 4):
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                elapsed, manifest = timeit(lambda: screenshot_tool.capture_regions(
+                    frame, regions, directory, "bench", "png", writer, executor))
+            assert all("file" in entry for entry in manifest["regions"]), "区域保存失败"
+            print(f"{count:>6} {workers:>8} {elapsed * 1000:>9.1f}")
+
+
+def bench_scheduler(seconds=5.0, interval=0.05):
+    """定时任务调度：触发延迟分布，以及最后一次触发相对计划时刻是否有累积漂移"""
+    import os
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication(sys.argv)
+    fired = []
+
+    def start_job(job):
+        fired.append(time.time())
+        # 模拟编码耗时，在工作线程中执行
+        return lambda: time.sleep(interval * 0.5)
+
+    scheduler = screenshot_tool.CaptureScheduler(start_job)
+    job = screenshot_tool.CaptureJob("bench", screenshot_tool.IntervalSchedule(interval))
+    scheduler.set_jobs([job])
+    end = time.time() + seconds
+    while time.time() < end:
+        app.processEvents()
+        time.sleep(0.001)
+    scheduler.stop()
+    stats = job.stats()
+    # 触发时刻应落在间隔整数倍附近，偏差不随运行时间增长
+    drift = (fired[-1] % interval) * 1000
+    print(f"触发 {len(fired)} 次 (计划 {int(seconds / interval)} 次), 合并/跳过 {stats['coalesced']} 次")
+    print(f"触发延迟 p50 {stats['lateness_ms']['p50']:.2f} ms, 最大 {stats['lateness_ms']['max']:.2f} ms, "
+          f"最后一次偏离计划 {drift:.2f} ms")
+    del app
+
+
+def bench_retention(count=20000, saves=200):
+    """保存目录保留策略：启动时加载并核对索引的耗时与增量登记 + 清理的单次保存开销"""
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        index_path = os.path.join(directory, "index", "retention_index.jsonl")
+        manager = screenshot_tool.RetentionManager(directory, index_path)
+        writer = screenshot_tool.AtomicFileWriter()
+        writer.on_written = manager.record
+        for i in range(count):
+            writer.write(os.path.join(directory, f"{i:06d}.png"), b"\0" * 1024)
+        while manager.status()["files"] < count:
+            time.sleep(0.05)
+        manager.stop()
+        # 同步调用各步骤
+        manager.stop_event.clear()
+        manager.BATCH_PAUSE = 0
+        load_time, _ = timeit(lambda: (manager.load(), manager.verify()))
+        manager.max_files = count
+        writer.on_written = None
+        # 每次保存一个文件，登记后清理掉最旧的一个
+        paths = [writer.write(os.path.join(directory, f"new_{i}.png"), b"\0" * 1024) for i in range(saves)]
+        start = time.perf_counter()
+        for path in paths:
+            manager._add([path])
+            manager.enforce()
+        per_save = (time.perf_counter() - start) / saves
+        assert manager.status()["files"] == count, "清理后文件数不正确"
+        print(f"{count} 个文件: 加载并核对索引 {load_time * 1000:.1f} ms, 增量登记+清理 {per_save * 1000:.3f} ms/次")
+
+
+def bench_profiling():
+    """按需性能分析的开销：未分析、仅采样、cProfile + 采样三种情况下同一段界面逻辑的耗时"""
+    import tempfile
+    from PyQt5.QtCore import QPoint, QRect
+    model = screenshot_tool.SelectionModel()
+    model.rect = QRect(300, 200, 800, 500)
+    rng = np.random.default_rng(0)
+    points = [QPoint(int(x), int(y)) for x, y in zip(rng.integers(250, 1150, 20000), rng.integers(150, 750, 20000))]
+
+    def workload():
+        return [model.handle_at(p) for p in points]
+
+    with tempfile.TemporaryDirectory() as directory:
+        off_time, _ = timeit(workload, repeat=5)
+        session = screenshot_tool.ProfileSession(directory, deterministic=False)
+        session.start()
+        sampled_time, _ = timeit(workload, repeat=5)
+        session.stop()
+        session = screenshot_tool.ProfileSession(directory)
+        session.start()
+        profiled_time, _ = timeit(workload, repeat=5)
+        session.stop()
+    print(f"未分析 {off_time * 1000:.1f} ms, 仅采样 {sampled_time * 1000:.1f} ms ({sampled_time / off_time:.2f}x), "
+          f"cProfile + 采样 {profiled_time * 1000:.1f} ms ({profiled_time / off_time:.2f}x)")
+
+
+BENCHMARKS = {
+    "png": bench_png,
+    "text_detection": bench_text_detection,
+    "capture": bench_capture_backends,
+    "selection": bench_selection,
+    "idle_memory": bench_idle_memory,
+    "auto_profile": bench_auto_profile,
+    "png8": bench_png8,
+    "similarity": bench_similarity,
+    "diff": bench_diff,
+    "region_presets": bench_region_presets,
+    "scheduler": bench_scheduler,
+    "retention": bench_retention,
+    "profiling": bench_profiling,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"== {name}: {BENCHMARKS[name].__doc__}")
+        BENCHMARKS[name]()
@@ -1,19 +1,532 @@
 import re
 import sys
+import abc
+import ctypes
+import ctypes.util
+import gc
 import os
+import json
+import socket
+import struct
+import time
+import queue
+import argparse
+import cProfile
+import pstats
+import io
+import collections
+import bisect
+import errno
+import math
+import heapq
+import itertools
+import shutil
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
 import cv2
 import numpy as np
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QLabel, QShortcut,
                              QLineEdit, QPushButton, QVBoxLayout, QHBoxLayout,
                              QWidget, QDialog, QDialogButtonBox, QSizePolicy,
                              QFileDialog, QMessageBox, QComboBox, QMenu, QAction,
-                             QStyleFactory, QGridLayout, QFrame, QSizeGrip, QCheckBox, QSystemTrayIcon)
-from PyQt5.QtCore import Qt, QPoint, QRect, QSize, QSettings, QTimer
+                             QStyleFactory, QGridLayout, QFrame, QSizeGrip, QCheckBox, QSystemTrayIcon,
+                             QInputDialog, QActionGroup, QListWidget, QListWidgetItem)
+from PyQt5.QtCore import (Qt, QPoint, QPointF, QRect, QSize, QSettings, QTimer, QStandardPaths,
+                          QObject, QEvent, QUrl, pyqtSignal)
 from PyQt5.QtGui import (QPixmap, QImage, QPainter, QPen, QColor, QScreen,
                          QKeySequence, QFont, QFontMetrics, QValidator,
-                         QCursor, QBrush, QIcon, QPalette)
+                         QCursor, QBrush, QIcon, QPalette, QMouseEvent, QKeyEvent, QDesktopServices)
 from loguru import logger
 
+def qimage_to_ndarray(qimage):
+    """把 QImage 包装为 numpy 视图（不复制数据），按行字节数处理内存对齐"""
+    channels = {
+        QImage.Format_Grayscale8: 1,
+        QImage.Format_RGB888: 3,
+        QImage.Format_RGB32: 4,
+        QImage.Format_ARGB32: 4,
+        QImage.Format_ARGB32_Premultiplied: 4,
+    }[qimage.format()]
+    width = qimage.width()
+    height = qimage.height()
+    bytes_per_line = qimage.bytesPerLine()
+
+    ptr = qimage.bits()
+    ptr.setsize(bytes_per_line * height)
+    arr = np.frombuffer(ptr, dtype=np.uint8).reshape(height, bytes_per_line)
+    # 去掉行尾的填充字节，仍然是原缓冲区上的视图
+    return arr[:, :width * channels].reshape(height, width, channels)
+
+
+# 超过该像素数且至少有 2 个可用 CPU 时，PNG 使用多线程压缩
+PARALLEL_PNG_MIN_PIXELS = 2000000
+
+_png_executor = None
+
+
+def png_worker_count():
+    """可用于 PNG 压缩的 CPU 数（支持时按进程的 CPU 亲和性计算）"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _adler32_combine(adler1, adler2, len2):
+    """合并两段数据的 adler32 校验值（zlib 的 adler32_combine）"""
+    base = 65521
+    rem = len2 % base
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % base
+    sum1 += (adler2 & 0xffff) + base - 1
+    sum2 += ((adler1 >> 16) & 0xffff) + ((adler2 >> 16) & 0xffff) + base - rem
+    if sum1 >= base:
+        sum1 -= base
+    if sum1 >= base:
+        sum1 -= base
+    if sum2 >= base << 1:
+        sum2 -= base << 1
+    if sum2 >= base:
+        sum2 -= base
+    return sum1 | (sum2 << 16)
+
+
+def _png_chunk(chunk_type, data):
+    """生成一个 PNG 数据块：长度 + 类型 + 数据 + CRC"""
+    return (struct.pack(">I", len(data)) + chunk_type + data
+            + struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff))
+
+
+def _png_filter_rows(pixels, filtered, start, stop, filter_type=2):
+    """对 [start, stop) 行做 Up 滤波（filter_type=0 时不滤波），写入 filtered 的对应行（首字节为滤波类型）"""
+    rows = pixels[start:stop].reshape(stop - start, -1)
+    filtered[start:stop, 0] = filter_type
+    filtered[start:stop, 1:] = rows
+    if filter_type == 0:
+        return start, stop
+    filtered[start + 1:stop, 1:] -= rows[:-1]
+    if start > 0:
+        filtered[start, 1:] -= pixels[start - 1].reshape(-1)
+    return start, stop
+
+
+def _png_deflate_chunk(data, dictionary, level, last):
+    """压缩一段滤波后的数据，以前一段末尾 32KB 作为预置字典（与 pigz 相同）"""
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9)
+    compressed = compressor.compress(data)
+    compressed += compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return compressed, zlib.adler32(data)
+
+
+def write_png_parallel(pixels, color_type, extra_chunks=(), level=3, chunk_bytes=1 << 20, filter_type=2):
+    """多线程编码 PNG
+
+    pixels 为 PNG 通道顺序的 (高, 宽[, 通道]) uint8 数组。扫描线滤波后按行切分，
+    各段在共享线程池（线程数为 png_worker_count()）中独立压缩（zlib 压缩时释放 GIL），拼接成一个合法的 zlib 流。
+    调色板图像的索引值没有连续性，应传 filter_type=0 不做滤波。
+    """
+    global _png_executor
+    if _png_executor is None:
+        _png_executor = ThreadPoolExecutor(max_workers=png_worker_count(), thread_name_prefix="PngDeflate")
+
+    height, width = pixels.shape[:2]
+    row_bytes = pixels[0].size
+    rows_per_chunk = max(1, chunk_bytes // (row_bytes + 1))
+    bounds = [(start, min(start + rows_per_chunk, height)) for start in range(0, height, rows_per_chunk)]
+
+    # 第一阶段：并行滤波
+    filtered = np.empty((height, row_bytes + 1), dtype=np.uint8)
+    list(_png_executor.map(lambda b: _png_filter_rows(pixels, filtered, *b, filter_type), bounds))
+    flat = filtered.reshape(-1)
+
+    # 第二阶段：并行压缩
+    futures = []
+    for index, (start, stop) in enumerate(bounds):
+        begin = start * (row_bytes + 1)
+        end = stop * (row_bytes + 1)
+        dictionary = flat[max(0, begin - 32768):begin].tobytes()
+        futures.append((end - begin, _png_executor.submit(
+            _png_deflate_chunk, flat[begin:end].data, dictionary, level, index == len(bounds) - 1)))
+
+    out = [b"\x89PNG\r\n\x1a\n",
+           _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0))]
+    out.extend(extra_chunks)
+
+    adler = 1
+    for index, (length, future) in enumerate(futures):
+        compressed, chunk_adler = future.result()
+        adler = _adler32_combine(adler, chunk_adler, length)
+        if index == 0:
+            # zlib 头：deflate、32K 窗口
+            compressed = b"\x78\x9c" + compressed
+        if index == len(futures) - 1:
+            compressed += struct.pack(">I", adler)
+        out.append(_png_chunk(b"IDAT", compressed))
+    out.append(_png_chunk(b"IEND", b""))
+    return b"".join(out)
+
+
+def encode_png_parallel(image, level=3):
+    """把 OpenCV 的 BGR/BGRA/灰度图像编码为 PNG 字节"""
+    if image.ndim == 2:
+        return write_png_parallel(image, 0, level=level)
+    if image.shape[2] == 3:
+        return write_png_parallel(image[:, :, ::-1], 2, level=level)
+    return write_png_parallel(image[:, :, [2, 1, 0, 3]], 6, level=level)
+
+
+# 8x8 Bayer 有序抖动矩阵（0-63）
+BAYER_8X8 = np.array([
+    [0, 32, 8, 40, 2, 34, 10, 42],
+    [48, 16, 56, 24, 50, 18, 58, 26],
+    [12, 44, 4, 36, 14, 46, 6, 38],
+    [60, 28, 52, 20, 62, 30, 54, 22],
+    [3, 35, 11, 43, 1, 33, 9, 41],
+    [51, 19, 59, 27, 49, 17, 57, 25],
+    [15, 47, 7, 39, 13, 45, 5, 37],
+    [63, 31, 55, 23, 61, 29, 53, 21],
+], dtype=np.int32)
+
+
+def exact_palette(image, max_colors=256, sample_pixels=65536):
+    """颜色不超过 max_colors 种时返回 (调色板 RGB 数组, 索引图)，否则返回 None
+
+    先在采样像素上统计颜色，再用 2^24 项的查找表把整幅图像一次性映射为索引；
+    表中未登记的颜色都映射为 0，只需核对索引为 0 的像素即可发现遗漏的颜色，
+    补进调色板后重新映射。全程向量化，不对整幅图像排序。
+    """
+    keys = image[..., 0].astype(np.uint32)
+    keys <<= 8
+    keys |= image[..., 1]
+    keys <<= 8
+    keys |= image[..., 2]
+    flat = keys.reshape(-1)
+    palette = np.unique(flat[::max(1, flat.size // sample_pixels)])
+    lut = np.zeros(1 << 24, dtype=np.uint8)
+    for _ in range(2):
+        if palette.size > max_colors:
+            return None
+        lut[palette] = np.arange(palette.size)
+        indices = lut[flat]
+        missing = (indices == 0) & (flat != palette[0])
+        if not missing.any():
+            rgb = np.stack([palette & 0xff, (palette >> 8) & 0xff, palette >> 16], axis=1).astype(np.uint8)
+            return rgb, indices.reshape(keys.shape)
+        palette = np.union1d(palette, np.unique(flat[missing]))
+    return None
+
+
+def quantize_palette(image, dither=True, colors=256, sample_pixels=262144):
+    """自适应量化，返回 (调色板 RGB 数组, 索引图)
+
+    在采样像素上按每通道 4 位分桶统计，取最常见的 colors 个桶的均值作为调色板；
+    再为每通道 5 位的 32768 个格点预先算出最近的调色板颜色，整幅图像查表映射。
+    抖动时映射前按 8x8 Bayer 矩阵给像素加 ±4 的偏移（约半个格点）。
+    """
+    height, width = image.shape[:2]
+    step = max(1, int((height * width / sample_pixels) ** 0.5))
+    sample = image[::step, ::step].reshape(-1, 3).astype(np.int32)
+    bins = ((sample[:, 2] >> 4) << 8) | ((sample[:, 1] >> 4) << 4) | (sample[:, 0] >> 4)
+    counts = np.bincount(bins, minlength=4096)
+    top = np.argsort(counts)[::-1][:colors]
+    top = top[counts[top] > 0]
+    palette = np.stack([np.bincount(bins, weights=sample[:, channel], minlength=4096)[top] / counts[top]
+                        for channel in (2, 1, 0)], axis=1)
+    palette = np.round(palette).astype(np.int32)
+
+    # 5 位格点中心到调色板的最近颜色查找表：|g-p|^2 = |p|^2 - 2g·p + |g|^2，最后一项不影响比较
+    centers = np.arange(32, dtype=np.float32) * 8 + 4
+    grid = np.stack(np.meshgrid(centers, centers, centers, indexing="ij"), axis=-1).reshape(-1, 3)
+    colors_f = palette.astype(np.float32)
+    distance = (colors_f ** 2).sum(axis=1)[None, :] - 2 * grid @ colors_f.T
+    lut = distance.argmin(axis=1).astype(np.uint8)
+
+    if dither:
+        offset = np.tile((BAYER_8X8 - 32) // 8, (height // 8 + 1, width // 8 + 1))[:height, :width]
+    index = np.zeros((height, width), dtype=np.int32)
+    for channel in (2, 1, 0):
+        values = image[..., channel].astype(np.int32)
+        if dither:
+            values = np.clip(values + offset, 0, 255)
+        index <<= 5
+        index |= values >> 3
+    return palette.astype(np.uint8), lut[index]
+
+
+def encode_png8(image, dither=True, level=6):
+    """编码为 8 位调色板 PNG：不超过 256 色时无损，否则量化（可选抖动）
+
+    输入为 BGR 图像；灰度图直接写 8 位灰度 PNG，BGRA 图像忽略透明通道。
+    """
+    if image.ndim == 2:
+        return write_png_parallel(image, 0, level=level)
+    if image.shape[2] == 4:
+        image = image[:, :, :3]
+    result = exact_palette(image)
+    if result is None:
+        result = quantize_palette(image, dither)
+    palette, indices = result
+    return write_png_parallel(indices, 3, extra_chunks=[_png_chunk(b"PLTE", palette.tobytes())],
+                              level=level, filter_type=0)
+
+
+# 非 OpenCV 参数：写 8 位调色板 PNG，值为 1 时颜色超过 256 种用有序抖动量化
+IMWRITE_PNG_PALETTE = 0x10001
+
+
+def encode_image(image, ext=".png", params=()):
+    """编码图像，调色板 PNG 和多核下的大尺寸 PNG 走自己的写入器，其余交给 cv2.imencode
+
+    只有一个可用 CPU 时分段压缩没有并行收益，反而比 cv2.imencode 慢。
+    """
+    options = dict(zip(params[::2], params[1::2]))
+    if ext == ".png" and IMWRITE_PNG_PALETTE in options:
+        return encode_png8(image, dither=bool(options[IMWRITE_PNG_PALETTE]),
+                           level=options.get(cv2.IMWRITE_PNG_COMPRESSION, 6))
+    if (ext == ".png" and image.shape[0] * image.shape[1] >= PARALLEL_PNG_MIN_PIXELS
+            and png_worker_count() >= 2):
+        level = options.get(cv2.IMWRITE_PNG_COMPRESSION, 3)
+        return encode_png_parallel(image, level=level)
+    success, buffer = cv2.imencode(ext, image, list(params))
+    if not success:
+        raise ValueError(f"图像编码失败: {ext}")
+    return buffer.tobytes()
+
+
+# 输出编码配置：名称 -> (扩展名, cv2.imencode 参数)
+ENCODE_PROFILES = {
+    "png": (".png", []),
+    "png_small": (".png", [cv2.IMWRITE_PNG_COMPRESSION, 9]),
+    "png8": (".png", [IMWRITE_PNG_PALETTE, 1]),
+    "png8_nodither": (".png", [IMWRITE_PNG_PALETTE, 0]),
+    "jpeg": (".jpg", [cv2.IMWRITE_JPEG_QUALITY, 92]),
+    "jpeg_web": (".jpg", [cv2.IMWRITE_JPEG_QUALITY, 80]),
+    "webp": (".webp", [cv2.IMWRITE_WEBP_QUALITY, 90]),
+    "webp_lossless": (".webp", [cv2.IMWRITE_WEBP_QUALITY, 101]),
+}
+
+
+# 自动输出配置：内容类别 -> 具体配置；auto 优先编码速度，auto_small 优先文件体积
+AUTO_PROFILES = {
+    "auto": {"ui": "png", "photo": "jpeg", "mixed_text": "png", "mixed": "webp"},
+    "auto_small": {"ui": "webp_lossless", "photo": "webp", "mixed_text": "webp_lossless", "mixed": "webp"},
+}
+CONTENT_KINDS = {
+    "ui": "界面/文字",
+    "photo": "照片/视频画面",
+    "mixed_text": "界面与图片混合且含文字",
+    "mixed": "界面与图片混合",
+}
+
+
+def analyze_content(image, samples=65536, color_samples=8192):
+    """在子采样视图上估计内容特征：相同相邻像素比例、硬边缘比例、颜色数和亮度熵
+
+    按行等间隔抽取整行（保留真实的相邻像素关系），总采样约 samples 个像素，
+    4K 截图也只需几毫秒。
+    """
+    height, width = image.shape[:2]
+    step = max(1, height // max(1, samples // width))
+    strip = image[step // 2::step]
+    if strip.ndim == 2:
+        keys = strip.astype(np.uint32)
+        luma = strip
+    else:
+        keys = (strip[..., 0].astype(np.uint32) << 16) | (strip[..., 1].astype(np.uint32) << 8) | strip[..., 2]
+        luma = strip[..., 1]
+    pairs = keys[:, 1:].size or 1
+    flat = np.count_nonzero(keys[:, 1:] == keys[:, :-1]) / pairs
+    hard = np.count_nonzero(cv2.absdiff(luma[:, 1:], luma[:, :-1]) > 48) / pairs
+    keys = keys.ravel()
+    sampled = keys[::max(1, keys.size // color_samples)]
+    colors = len(np.unique(sampled))
+    hist = np.bincount(luma.ravel(), minlength=256) / luma.size
+    hist = hist[hist > 0]
+    return {
+        "flat": float(flat),
+        "hard_edges": float(hard),
+        "colors": colors,
+        "color_ratio": colors / sampled.size,
+        "entropy": float(-(hist * np.log2(hist)).sum()),
+    }
+
+
+def classify_content(image):
+    """估计内容类别，返回 (类别, 依据说明)"""
+    height, width = image.shape[:2]
+    if width * height < 4096:
+        return "ui", "图像过小"
+    stats = analyze_content(image)
+    summary = (f"相同相邻像素 {stats['flat']:.0%}, 硬边缘 {stats['hard_edges']:.1%}, "
+               f"颜色 {stats['colors']} 种, 亮度熵 {stats['entropy']:.2f}")
+    if stats["flat"] >= 0.6 and stats["color_ratio"] < 0.2:
+        return "ui", summary
+    if stats["flat"] < 0.15 and stats["entropy"] >= 6.0:
+        return "photo", summary
+    if stats["hard_edges"] >= 0.01:
+        return "mixed_text", summary
+    return "mixed", summary
+
+
+def choose_output_profile(image, mode="auto"):
+    """按内容选择输出配置，返回 (配置名, 依据说明)"""
+    kind, summary = classify_content(image)
+    return AUTO_PROFILES[mode][kind], f"{CONTENT_KINDS[kind]} ({summary})"
+
+
+def resolve_profile(image, profile):
+    """自动输出配置按内容选择具体配置并记录依据，其余原样返回"""
+    if profile not in AUTO_PROFILES:
+        return profile
+    start = time.perf_counter()
+    chosen, reason = choose_output_profile(image, profile)
+    logger.info(f"自动选择输出格式({profile}): {chosen}，{reason}，耗时 {(time.perf_counter() - start) * 1000:.1f} ms")
+    return chosen
+
+
+def is_valid_profile(profile):
+    return profile in AUTO_PROFILES or profile in ENCODE_PROFILES
+
+
+def encode_profile(image, profile="png"):
+    """按输出配置编码，返回 (扩展名, 字节)；自动配置先按内容选择具体配置"""
+    profile = resolve_profile(image, profile)
+    if profile not in ENCODE_PROFILES:
+        raise ValueError(f"未知的输出配置: {profile}")
+    ext, params = ENCODE_PROFILES[profile]
+    return ext, encode_image(image, ext, params)
+
+
+def _stage_resize(image, stage):
+    """按比例或指定宽高缩放，缩小时使用 INTER_AREA"""
+    height, width = image.shape[:2]
+    if "scale" in stage:
+        size = (max(1, round(width * stage["scale"])), max(1, round(height * stage["scale"])))
+    else:
+        target_width = stage.get("width") or round(width * stage["height"] / height)
+        target_height = stage.get("height") or round(height * target_width / width)
+        size = (int(target_width), int(target_height))
+    interpolation = cv2.INTER_AREA if size[0] < width else cv2.INTER_CUBIC
+    return cv2.resize(image, size, interpolation=interpolation)
+
+
+def _stage_max_dimension(image, stage):
+    """长边超过限制时等比缩小"""
+    height, width = image.shape[:2]
+    scale = stage["size"] / max(height, width)
+    if scale >= 1:
+        return image
+    return _stage_resize(image, {"scale": scale})
+
+
+def _stage_crop(image, stage):
+    """四周裁掉指定像素"""
+    margin = int(stage.get("margin", 0))
+    height, width = image.shape[:2]
+    if margin <= 0 or margin * 2 >= min(height, width):
+        return image
+    return image[margin:height - margin, margin:width - margin]
+
+
+def _stage_pad(image, stage):
+    """四周填充纯色边框"""
+    size = int(stage.get("size", 10))
+    color = stage.get("color", [255, 255, 255])
+    return cv2.copyMakeBorder(image, size, size, size, size, cv2.BORDER_CONSTANT, value=color)
+
+
+def _stage_watermark(image, stage):
+    """在右下角叠加半透明文字水印，只在水印区域内混合"""
+    text = stage.get("text", "")
+    if not text:
+        return image
+    scale = stage.get("font_scale", 0.8)
+    thickness = max(1, int(scale * 2))
+    opacity = stage.get("opacity", 0.5)
+    (text_width, text_height), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, thickness)
+    height, width = image.shape[:2]
+    x0 = max(0, width - text_width - 10)
+    y0 = max(0, height - text_height - baseline - 10)
+    image = image.copy()
+    roi = image[y0:height, x0:width]
+    overlay = roi.copy()
+    cv2.putText(overlay, text, (0, text_height), cv2.FONT_HERSHEY_SIMPLEX, scale,
+                stage.get("color", [255, 255, 255]), thickness, cv2.LINE_AA)
+    cv2.addWeighted(overlay, opacity, roi, 1 - opacity, 0, dst=roi)
+    return image
+
+
+PIPELINE_STAGES = {
+    "resize": _stage_resize,
+    "max_dimension": _stage_max_dimension,
+    "crop": _stage_crop,
+    "pad": _stage_pad,
+    "watermark": _stage_watermark,
+}
+
+
+# 各阶段的数值参数：(必填参数, 可选参数)；resize 需要 scale、width、height 中的至少一个
+PIPELINE_STAGE_PARAMS = {
+    "resize": ((), ("scale", "width", "height")),
+    "max_dimension": (("size",), ()),
+    "crop": ((), ("margin",)),
+    "pad": ((), ("size",)),
+    "watermark": ((), ("font_scale", "opacity")),
+}
+
+
+def validate_pipeline_stage(stage):
+    """检查单个处理阶段的类型和参数，无效时抛出 ValueError"""
+    if not isinstance(stage, dict):
+        raise ValueError(f"处理阶段必须是对象: {stage!r}")
+    kind = stage.get("type")
+    if kind not in PIPELINE_STAGES:
+        raise ValueError(f"未知的处理阶段: {kind}")
+    required, optional = PIPELINE_STAGE_PARAMS[kind]
+    for key in required:
+        if key not in stage:
+            raise ValueError(f"处理阶段 {kind} 缺少参数 {key}")
+    for key in required + optional:
+        if key not in stage:
+            continue
+        value = stage[key]
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise ValueError(f"处理阶段 {kind} 的参数 {key} 必须是数值: {value!r}")
+        # 边距、边框和不透明度可以为 0，其余参数必须为正数
+        allow_zero = (kind, key) in (("crop", "margin"), ("pad", "size"), ("watermark", "opacity"))
+        if value < 0 or value == 0 and not allow_zero:
+            raise ValueError(f"处理阶段 {kind} 的参数 {key} 超出范围: {value!r}")
+    if kind == "resize" and not any(stage.get(key) for key in optional):
+        raise ValueError("处理阶段 resize 需要 scale、width 或 height")
+    if kind == "watermark":
+        if not isinstance(stage.get("text", ""), str):
+            raise ValueError("处理阶段 watermark 的参数 text 必须是字符串")
+        if stage.get("opacity", 0.5) > 1:
+            raise ValueError(f"处理阶段 watermark 的参数 opacity 超出范围: {stage['opacity']!r}")
+    if "color" in stage:
+        color = stage["color"]
+        if (not isinstance(color, list) or len(color) not in (3, 4)
+                or not all(isinstance(c, (int, float)) and not isinstance(c, bool) for c in color)):
+            raise ValueError(f"处理阶段 {kind} 的参数 color 必须是 3 或 4 个数值: {color!r}")
+
+
+def run_pipeline_stages(image, stages):
+    """依次执行处理阶段，返回处理后的图像"""
+    for stage in stages:
+        image = PIPELINE_STAGES[stage["type"]](image, stage)
+    return image
+
+
+def render_pipeline_variant(image, stages, profile):
+    """进程池任务：执行衍生版本的处理阶段并编码，返回 (扩展名, 字节)"""
+    return encode_profile(run_pipeline_stages(image, stages), profile)
+
+
 class SizeValidator(QValidator):
     def validate(self, input_text, pos):
         """验证输入是否为有效的整数"""
@@ -222,6 +735,78 @@ class HotkeyEdit(QLineEdit):
         return self.hotkey
 
 
+class SimilarCapturesDialog(QDialog):
+    """相似截图查询结果，双击打开文件"""
+
+    def __init__(self, source, results, elapsed, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("相似截图")
+        self.resize(760, 480)
+        layout = QVBoxLayout(self)
+        summary = QLabel(f"{os.path.basename(source)}: 找到 {len(results)} 张相似截图 (查询 {elapsed * 1000:.1f} ms)")
+        summary.setStyleSheet("font-size: 14px; padding: 5px;")
+        layout.addWidget(summary)
+        self.list_widget = QListWidget()
+        for distance, path in results:
+            item = QListWidgetItem(f"距离 {distance:>3}    {path}")
+            item.setData(Qt.UserRole, path)
+            self.list_widget.addItem(item)
+        self.list_widget.itemDoubleClicked.connect(self.open_item)
+        layout.addWidget(self.list_widget, 1)
+        buttons = QDialogButtonBox(QDialogButtonBox.Close)
+        buttons.rejected.connect(self.reject)
+        # 与所选截图做像素对比
+        self.source = source
+        if parent is not None and hasattr(parent, "compare_captures"):
+            compare_btn = buttons.addButton("对比差异", QDialogButtonBox.ActionRole)
+            compare_btn.clicked.connect(self.compare_selected)
+        layout.addWidget(buttons)
+
+    def open_item(self, item):
+        QDesktopServices.openUrl(QUrl.fromLocalFile(item.data(Qt.UserRole)))
+
+    def compare_selected(self):
+        item = self.list_widget.currentItem()
+        if item is not None:
+            # 较早的文件作为对比基准
+            paths = sorted((self.source, item.data(Qt.UserRole)), key=os.path.getmtime)
+            self.parent().compare_captures(*paths)
+
+
+class CaptureDiffDialog(QDialog):
+    """截图对比结果：叠加图和变化区域列表"""
+
+    def __init__(self, overlay_path, boxes, summary, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("截图对比")
+        self.resize(1000, 760)
+        self.overlay_path = overlay_path
+        layout = QVBoxLayout(self)
+        text = (f"{os.path.basename(summary['before'])} → {os.path.basename(summary['after'])}: "
+                f"变化 {summary['changed_ratio'] * 100:.2f}%, {len(boxes)} 个区域")
+        if summary["shift"] != [0, 0]:
+            text += f", 已按平移 {tuple(summary['shift'])} 对齐"
+        summary_label = QLabel(text)
+        summary_label.setStyleSheet("font-size: 14px; padding: 5px;")
+        layout.addWidget(summary_label)
+        preview = QLabel()
+        preview.setAlignment(Qt.AlignCenter)
+        pixmap = QPixmap(overlay_path)
+        if not pixmap.isNull():
+            preview.setPixmap(pixmap.scaled(960, 520, Qt.KeepAspectRatio, Qt.SmoothTransformation))
+        layout.addWidget(preview, 1)
+        box_list = QListWidget()
+        box_list.setMaximumHeight(140)
+        for x, y, w, h in boxes:
+            box_list.addItem(f"({x}, {y})  {w}x{h}")
+        layout.addWidget(box_list)
+        buttons = QDialogButtonBox(QDialogButtonBox.Close)
+        open_btn = buttons.addButton("打开叠加图", QDialogButtonBox.ActionRole)
+        open_btn.clicked.connect(lambda: QDesktopServices.openUrl(QUrl.fromLocalFile(self.overlay_path)))
+        buttons.rejected.connect(self.reject)
+        layout.addWidget(buttons)
+
+
 class SettingsDialog(QDialog):
     def __init__(self, save_path, hotkeys, parent=None):
         super().__init__(parent)
@@ -386,9 +971,3064 @@ class SettingsDialog(QDialog):
         return conflicts
 
 
-class ScreenshotTool(QMainWindow):
+class CaptureBackend(abc.ABC):
+    """屏幕抓取后端基类，grab() 返回 QImage，失败时返回空 QImage"""
+
+    name = ""
+
+    @abc.abstractmethod
+    def grab(self, rect=None):
+        """抓取整屏或 rect 区域"""
+
+    def buffer_bytes(self):
+        """后端自身持有的帧缓冲字节数"""
+        return 0
+
+    def release(self):
+        """空闲时释放帧缓冲，下次 grab() 时按需重建"""
+        pass
+
+    def close(self):
+        pass
+
+
+class QtCaptureBackend(CaptureBackend):
+    """使用 QScreen.grabWindow 抓屏，适用于所有平台"""
+
+    name = "qt"
+
+    def grab(self, rect=None):
+        screen = QApplication.primaryScreen()
+        if not screen:
+            return QImage()
+        if rect is None:
+            return screen.grabWindow(0).toImage()
+        return screen.grabWindow(0, rect.x(), rect.y(), rect.width(), rect.height()).toImage()
+
+
+class _XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [("shmseg", ctypes.c_ulong), ("shmid", ctypes.c_int),
+                ("shmaddr", ctypes.c_void_p), ("readOnly", ctypes.c_int)]
+
+
+class _XImage(ctypes.Structure):
+    # 只声明需要读取的前部字段，结构体始终由 Xlib 分配
+    _fields_ = [("width", ctypes.c_int), ("height", ctypes.c_int), ("xoffset", ctypes.c_int),
+                ("format", ctypes.c_int), ("data", ctypes.c_void_p), ("byte_order", ctypes.c_int),
+                ("bitmap_unit", ctypes.c_int), ("bitmap_bit_order", ctypes.c_int),
+                ("bitmap_pad", ctypes.c_int), ("depth", ctypes.c_int),
+                ("bytes_per_line", ctypes.c_int), ("bits_per_pixel", ctypes.c_int)]
+
+
+class XShmCaptureBackend(CaptureBackend):
+    """X11 共享内存抓屏（Linux）
+
+    X 服务器直接把根窗口像素写入共享内存段，省去经套接字传输整帧的开销；
+    共享段在创建时分配一次，之后每次抓取不再分配内存。
+    """
+
+    name = "xshm"
+    ZPIXMAP = 2
+    IPC_PRIVATE = 0
+    IPC_CREAT = 0o1000
+    IPC_RMID = 0
+
     def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise RuntimeError("XShm 仅支持 Linux")
+        x11_path = ctypes.util.find_library("X11")
+        xext_path = ctypes.util.find_library("Xext")
+        if not x11_path or not xext_path:
+            raise RuntimeError("未找到 libX11/libXext")
+        self.xlib = ctypes.CDLL(x11_path)
+        self.xext = ctypes.CDLL(xext_path)
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._declare()
+        self.display = None
+        self.ximage = None
+        self.attached = False
+        self._open()
+
+    def _open(self):
+        """连接 X 服务器并挂上共享内存段"""
+        self.display = self.xlib.XOpenDisplay(None)
+        if not self.display:
+            raise RuntimeError("无法连接 X 服务器")
+        self.shminfo = _XShmSegmentInfo()
+        self.shminfo.shmid = -1
+        try:
+            self._attach()
+        except Exception:
+            self.close()
+            raise
+
+    def _declare(self):
+        """声明用到的 Xlib/XShm/libc 函数签名"""
+        xlib, xext, libc = self.xlib, self.xext, self.libc
+        xlib.XOpenDisplay.restype = ctypes.c_void_p
+        xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        xlib.XDefaultScreen.argtypes = [ctypes.c_void_p]
+        xlib.XRootWindow.restype = ctypes.c_ulong
+        xlib.XRootWindow.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDefaultVisual.restype = ctypes.c_void_p
+        xlib.XDefaultVisual.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDefaultDepth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDisplayWidth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDisplayHeight.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XFree.argtypes = [ctypes.c_void_p]
+        xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+        xext.XShmCreateImage.restype = ctypes.POINTER(_XImage)
+        xext.XShmCreateImage.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int,
+                                         ctypes.c_char_p, ctypes.POINTER(_XShmSegmentInfo),
+                                         ctypes.c_uint, ctypes.c_uint]
+        xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        xext.XShmGetImage.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(_XImage),
+                                      ctypes.c_int, ctypes.c_int, ctypes.c_ulong]
+        libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        libc.shmat.restype = ctypes.c_void_p
+        libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        libc.shmdt.argtypes = [ctypes.c_void_p]
+        libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+    def _attach(self):
+        """创建整屏大小的共享内存 XImage 并挂到 X 服务器"""
+        if not self.xext.XShmQueryExtension(self.display):
+            raise RuntimeError("X 服务器不支持 MIT-SHM")
+        screen = self.xlib.XDefaultScreen(self.display)
+        self.root = self.xlib.XRootWindow(self.display, screen)
+        self.width = self.xlib.XDisplayWidth(self.display, screen)
+        self.height = self.xlib.XDisplayHeight(self.display, screen)
+        self.ximage = self.xext.XShmCreateImage(
+            self.display, self.xlib.XDefaultVisual(self.display, screen),
+            self.xlib.XDefaultDepth(self.display, screen), self.ZPIXMAP, None,
+            ctypes.byref(self.shminfo), self.width, self.height)
+        if not self.ximage:
+            raise RuntimeError("XShmCreateImage 失败")
+        image = self.ximage.contents
+        if image.bits_per_pixel != 32:
+            raise RuntimeError(f"不支持 {image.bits_per_pixel} 位像素格式")
+        self.bytes_per_line = image.bytes_per_line
+        size = image.bytes_per_line * image.height
+        self.shminfo.shmid = self.libc.shmget(self.IPC_PRIVATE, size, self.IPC_CREAT | 0o600)
+        if self.shminfo.shmid < 0:
+            raise OSError(ctypes.get_errno(), "shmget 失败")
+        address = self.libc.shmat(self.shminfo.shmid, None, 0)
+        if address is None or address == ctypes.c_void_p(-1).value:
+            raise OSError(ctypes.get_errno(), "shmat 失败")
+        self.shminfo.shmaddr = address
+        self.shminfo.readOnly = 0
+        image.data = address
+        if not self.xext.XShmAttach(self.display, ctypes.byref(self.shminfo)):
+            raise RuntimeError("XShmAttach 失败")
+        self.xlib.XSync(self.display, 0)
+        self.attached = True
+        # 双方都挂上后即标记删除，进程异常退出时段也会被系统回收
+        self.libc.shmctl(self.shminfo.shmid, self.IPC_RMID, None)
+        self.buffer = (ctypes.c_ubyte * size).from_address(address)
+        logger.info(f"XShm 抓屏已初始化: {self.width}x{self.height}")
+
+    def grab(self, rect=None):
+        if not self.display:
+            self._open()
+        if not self.xext.XShmGetImage(self.display, self.root, self.ximage, 0, 0, 0xFFFFFFFF):
+            return QImage()
+        # 24 位深度的 32 位像素在内存中为 BGRX，与 Format_RGB32 一致
+        full = QImage(self.buffer, self.width, self.height, self.bytes_per_line, QImage.Format_RGB32)
+        if rect is None:
+            return full.copy()
+        return full.copy(rect)
+
+    def buffer_bytes(self):
+        return self.bytes_per_line * self.height if self.attached else 0
+
+    def release(self):
+        self.close()
+
+    def close(self):
+        if self.attached:
+            self.xext.XShmDetach(self.display, ctypes.byref(self.shminfo))
+            self.attached = False
+        if self.shminfo.shmaddr:
+            self.libc.shmdt(self.shminfo.shmaddr)
+            self.shminfo.shmaddr = None
+        if self.ximage:
+            # data 指向共享段，只释放结构体本身
+            self.ximage.contents.data = None
+            self.xlib.XFree(self.ximage)
+            self.ximage = None
+        if self.display:
+            self.xlib.XCloseDisplay(self.display)
+            self.display = None
+
+
+class SyntheticCaptureBackend(CaptureBackend):
+    """合成画面后端：按帧序号生成确定性画面，无需显示器，用于测试和基准
+
+    背景在首次抓取时生成，每帧复制背景并按帧序号移动一个色块、写入帧号。
+    """
+
+    name = "synthetic"
+
+    def __init__(self, width=1920, height=1080, seed=0):
+        self.width = width
+        self.height = height
+        self.seed = seed
+        self.frame_index = 0
+        self.base = None
+
+    def _create_base(self):
+        width, height = self.width, self.height
+        rng = np.random.default_rng(self.seed)
+        base = np.full((height, width, 4), 240, dtype=np.uint8)
+        for _ in range(60):
+            x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+            color = tuple(int(c) for c in rng.integers(0, 256, 3)) + (255,)
+            cv2.rectangle(base, (x, y), (x + int(rng.integers(40, 400)), y + int(rng.integers(20, 240))), color, -1)
+        for row in range(30, height, 40):
+            cv2.putText(base, "Synthetic capture frame 0123456789", (20, row),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (20, 20, 20, 255), 1, cv2.LINE_AA)
+        return base
+
+    def buffer_bytes(self):
+        return self.base.nbytes if self.base is not None else 0
+
+    def release(self):
+        self.base = None
+
+    def grab(self, rect=None):
+        if self.base is None:
+            self.base = self._create_base()
+        frame = self.base.copy()
+        index = self.frame_index
+        self.frame_index += 1
+        x = (index * 16) % max(1, self.width - 120)
+        y = (index * 9) % max(1, self.height - 120)
+        cv2.rectangle(frame, (x, y), (x + 120, y + 120), (0, 0, 255, 255), -1)
+        cv2.putText(frame, f"#{index}", (x + 8, y + 70), cv2.FONT_HERSHEY_SIMPLEX, 1.2,
+                    (255, 255, 255, 255), 2, cv2.LINE_AA)
+        if rect is not None:
+            rect = rect.intersected(QRect(0, 0, self.width, self.height))
+            frame = np.ascontiguousarray(frame[rect.y():rect.bottom() + 1, rect.x():rect.right() + 1])
+        height, width = frame.shape[:2]
+        # QImage 不持有 numpy 内存，copy() 后再返回
+        return QImage(frame.data, width, height, frame.strides[0], QImage.Format_RGB32).copy()
+
+
+class FileCaptureBackend(CaptureBackend):
+    """文件后端：依次循环返回单个文件或目录中的图片，用于回放真实截图
+
+    图片在首次用到时解码并缓存，之后的抓取只复制像素。
+    """
+
+    name = "file"
+
+    def __init__(self, path):
+        if os.path.isdir(path):
+            self.paths = sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            self.paths = [path]
+        if not self.paths:
+            raise RuntimeError(f"{path} 中没有图片")
+        self.cache = {}
+        self.frame_index = 0
+
+    def grab(self, rect=None):
+        path = self.paths[self.frame_index % len(self.paths)]
+        self.frame_index += 1
+        image = self.cache.get(path)
+        if image is None:
+            image = QImage(path)
+            if image.isNull():
+                logger.error(f"无法读取图片: {path}")
+                return QImage()
+            image = image.convertToFormat(QImage.Format_RGB32)
+            self.cache[path] = image
+        if rect is None:
+            return image.copy()
+        return image.copy(rect)
+
+    def buffer_bytes(self):
+        return sum(image.sizeInBytes() for image in self.cache.values())
+
+    def release(self):
+        self.cache.clear()
+
+
+CAPTURE_BACKENDS = {
+    "qt": QtCaptureBackend,
+    "xshm": XShmCaptureBackend,
+    "synthetic": SyntheticCaptureBackend,
+}
+
+
+def create_capture_backend(spec):
+    """按设置创建抓屏后端："qt"、"xshm"、"synthetic" 或 "file:<路径>"，失败时退回 Qt"""
+    spec = (spec or "qt").strip()
+    try:
+        if spec.startswith("file:"):
+            backend = FileCaptureBackend(spec[len("file:"):])
+        elif spec in CAPTURE_BACKENDS:
+            backend = CAPTURE_BACKENDS[spec]()
+        else:
+            raise RuntimeError(f"未知的抓屏后端 {spec}")
+    except Exception as e:
+        logger.warning(f"抓屏后端 {spec} 不可用，改用 Qt: {e}")
+        return QtCaptureBackend()
+    logger.info(f"抓屏后端: {backend.name}")
+    return backend
+
+
+class CaptureFrame:
+    """一次截图的输出数据：BGR 图像、文件名和按输出配置缓存的编码结果
+
+    多个输出共享同一个 CaptureFrame，同一输出配置只编码一次；自动配置每帧只判断一次，
+    选中的配置与显式使用该配置的输出共用编码结果。
+    """
+
+    def __init__(self, image, name, timestamp=None):
+        self.image = image
+        self.name = name
+        self.timestamp = timestamp if timestamp is not None else time.time()
+        self._encoded = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._auto_profiles = {}
+
+    def resolved_profile(self, profile):
+        """自动输出配置对应的具体配置"""
+        if profile not in AUTO_PROFILES:
+            return profile
+        with self._lock:
+            if profile not in self._auto_profiles:
+                self._auto_profiles[profile] = resolve_profile(self.image, profile)
+            return self._auto_profiles[profile]
+
+    def encoded(self, profile):
+        """返回 (扩展名, 字节)，并发请求同一配置时只有第一个请求真正编码"""
+        profile = self.resolved_profile(profile)
+        with self._lock:
+            lock = self._locks.setdefault(profile, threading.Lock())
+        with lock:
+            if profile not in self._encoded:
+                self._encoded[profile] = encode_profile(self.image, profile)
+            return self._encoded[profile]
+
+
+class FrameSink(abc.ABC):
+    """截图输出的基类"""
+    name = "输出"
+    # 需要在界面线程执行的输出（如剪贴板）
+    gui_thread = False
+
+    @abc.abstractmethod
+    def publish(self, frame):
+        """输出一帧，返回用于日志的结果描述"""
+
+    def close(self):
+        pass
+
+
+class SharedMemoryFrameSink(FrameSink):
+    """共享内存帧导出：把截图的原始像素写入命名共享内存，并通过本地UDP通知消费者
+
+    内存布局为 64 字节头部 + 紧密排列的像素数据。写入时先把序号清零，
+    像素写完后再写入新序号，消费者读取前后序号一致即表示帧完整。
+    """
+    MAGIC = b"SSTF"
+    VERSION = 1
+    # 魔数, 版本, 宽, 高, 行字节数, 通道数, 像素格式, 序号, 数据长度
+    HEADER = struct.Struct("<4sHIIIBBQQ")
+    HEADER_SIZE = 64
+    # 像素格式编号
+    FORMAT_GRAY8 = 0
+    FORMAT_BGR888 = 1
+    FORMAT_BGRA8888 = 2
+
+    name = "共享内存"
+
+    def __init__(self, segment_name="screenshot_tool_frame", notify_port=47800, capacity=0):
+        self.segment_name = segment_name
+        self.notify_port = notify_port
+        self.capacity = capacity
+        self.sequence = 0
+        self.shm = None
+        self.notify_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _ensure_capacity(self, needed):
+        """确保共享内存段足够容纳当前帧"""
+        if self.shm is not None and self.shm.size >= needed:
+            return
+        self._release()
+        size = max(needed, self.capacity)
+        try:
+            self.shm = shared_memory.SharedMemory(name=self.segment_name, create=True, size=size)
+        except FileExistsError:
+            # 上次异常退出残留的同名段，大小足够则直接复用
+            self.shm = shared_memory.SharedMemory(name=self.segment_name)
+            if self.shm.size < needed:
+                self.shm.close()
+                self.shm = None
+                raise RuntimeError(f"共享内存段 {self.segment_name} 已被占用且容量不足")
+        self.capacity = self.shm.size
+        logger.debug(f"共享内存段 {self.segment_name} 已创建, 容量 {self.capacity} 字节")
+
+    def publish(self, frame):
+        """输出接口：发布 CaptureFrame 中的图像"""
+        return f"帧 #{self.publish_image(frame.image)}"
+
+    def publish_image(self, image):
+        """发布一帧图像（BGR/BGRA/灰度 numpy 数组），返回帧序号"""
+        height, width = image.shape[:2]
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        pixel_format = {1: self.FORMAT_GRAY8, 3: self.FORMAT_BGR888, 4: self.FORMAT_BGRA8888}[channels]
+        stride = width * channels
+        data_size = stride * height
+        self._ensure_capacity(self.HEADER_SIZE + data_size)
+
+        buf = self.shm.buf
+        self.sequence += 1
+
+        # 写入期间序号为0，表示帧不完整
+        self.HEADER.pack_into(buf, 0, self.MAGIC, self.VERSION, width, height, stride,
+                              channels, pixel_format, 0, data_size)
+        target = np.ndarray((height, width, channels), dtype=np.uint8,
+                            buffer=buf, offset=self.HEADER_SIZE)
+        target[...] = image.reshape(height, width, channels)
+        self.HEADER.pack_into(buf, 0, self.MAGIC, self.VERSION, width, height, stride,
+                              channels, pixel_format, self.sequence, data_size)
+
+        self._notify(width, height, stride, channels, pixel_format)
+        return self.sequence
+
+    def _notify(self, width, height, stride, channels, pixel_format):
+        """通过本地UDP广播新帧信息"""
+        message = json.dumps({
+            "name": self.segment_name,
+            "sequence": self.sequence,
+            "width": width,
+            "height": height,
+            "stride": stride,
+            "channels": channels,
+            "format": pixel_format,
+            "offset": self.HEADER_SIZE,
+        }).encode("utf-8")
+        try:
+            self.notify_socket.sendto(message, ("127.0.0.1", self.notify_port))
+        except OSError as e:
+            logger.debug(f"共享内存通知发送失败: {e}")
+
+    def _release(self):
+        """释放共享内存段"""
+        if self.shm is None:
+            return
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+        self.shm = None
+
+    def close(self):
+        """关闭导出，删除共享内存段"""
+        self._release()
+        self.notify_socket.close()
+
+
+class RawFrameStreamer:
+    """原始帧推流：按固定帧率抓取选定区域，把 BGR/BGRA 原始帧写入标准输出或命名管道
+
+    帧几何参数在开始时确定并输出到日志（命名管道额外写一份 .json 描述文件），
+    之后每帧尺寸固定，便于直接交给 ffmpeg 的 rawvideo 输入。
+    """
+
+    def __init__(self, grab, rect, target="-", fps=30, pixel_format="bgra", parent=None):
+        self.grab = grab
+        self.rect = QRect(rect)
+        self.target = target
+        self.fps = fps
+        self.pixel_format = pixel_format
+        self.frame_size = QSize()
+
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.started_at = 0.0
+        self.last_report_at = 0.0
+        self.error = None
+
+        self.queue = queue.Queue(maxsize=3)
+        self.writer_thread = None
+        self.timer = QTimer(parent)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.grab_frame)
+
+    def is_running(self):
+        return self.timer.isActive()
+
+    def start(self):
+        """确定帧几何参数并开始推流"""
+        # 先抓一帧确定实际像素尺寸（高DPI下可能与逻辑尺寸不同）
+        image = self._grab_image()
+        if image is None:
+            raise RuntimeError("无法抓取推流区域")
+        self.frame_size = image.size()
+
+        geometry = {
+            "width": self.frame_size.width(),
+            "height": self.frame_size.height(),
+            "pixel_format": self.pixel_format,
+            "fps": self.fps,
+        }
+        logger.info(f"推流几何参数: {geometry}")
+        ffmpeg_pix_fmt = {"bgr": "bgr24", "bgra": "bgra"}[self.pixel_format]
+        logger.info(f"ffmpeg 输入参数: -f rawvideo -pix_fmt {ffmpeg_pix_fmt} "
+                    f"-video_size {geometry['width']}x{geometry['height']} "
+                    f"-framerate {self.fps} -i {self.target}")
+        if self.target != "-":
+            with open(self.target + ".json", "w", encoding="utf-8") as f:
+                json.dump(geometry, f)
+
+        self.writer_thread = threading.Thread(target=self._write_loop, name="RawFrameWriter", daemon=True)
+        self.writer_thread.start()
+
+        self.started_at = self.last_report_at = time.perf_counter()
+        self._enqueue(image)
+        self.timer.start(max(1, round(1000 / self.fps)))
+
+    def stop(self):
+        """停止推流，返回统计信息"""
+        self.timer.stop()
+        try:
+            self.queue.put(None, timeout=1)
+        except queue.Full:
+            pass
+        if self.writer_thread:
+            self.writer_thread.join(timeout=2)
+            self.writer_thread = None
+        stats = self.stats()
+        logger.info(f"推流结束: {stats}")
+        return stats
+
+    def stats(self):
+        """返回已写帧数、丢帧数和实际帧率"""
+        elapsed = time.perf_counter() - self.started_at if self.started_at else 0.0
+        return {
+            "frames": self.frames_written,
+            "dropped": self.frames_dropped,
+            "seconds": round(elapsed, 2),
+            "fps": round(self.frames_written / elapsed, 2) if elapsed > 0 else 0.0,
+        }
+
+    def _grab_image(self):
+        """抓取区域并转换为 32 位格式（内存中即为 BGRA），通常无需转换"""
+        image = self.grab(self.rect)
+        if image.isNull():
+            return None
+        if image.format() not in (QImage.Format_RGB32, QImage.Format_ARGB32, QImage.Format_ARGB32_Premultiplied):
+            image = image.convertToFormat(QImage.Format_RGB32)
+        return image
+
+    def grab_frame(self):
+        """定时器回调：抓取一帧放入写队列"""
+        if self.error:
+            self.timer.stop()
+            return
+        image = self._grab_image()
+        if image is None or image.size() != self.frame_size:
+            self.frames_dropped += 1
+            return
+        self._enqueue(image)
+
+        now = time.perf_counter()
+        if now - self.last_report_at >= 5:
+            self.last_report_at = now
+            logger.info(f"推流中: {self.stats()}")
+
+    def _enqueue(self, image):
+        """写线程跟不上时丢弃新帧，而不是无限堆积"""
+        frame = qimage_to_ndarray(image)
+        if self.pixel_format == "bgr":
+            frame = np.ascontiguousarray(frame[:, :, :3])
+        try:
+            # 保留 QImage 引用，保证写出前缓冲区有效
+            self.queue.put_nowait((image, frame))
+        except queue.Full:
+            self.frames_dropped += 1
+
+    def _open_target(self):
+        if self.target == "-":
+            if sys.stdout is None:
+                raise RuntimeError("标准输出不可用")
+            return sys.stdout.buffer
+        if not os.path.exists(self.target) and hasattr(os, "mkfifo"):
+            os.mkfifo(self.target)
+        # 打开命名管道会阻塞到读端连接
+        return open(self.target, "wb", buffering=0)
+
+    def _write_loop(self):
+        """写线程：直接写出像素缓冲区，不做任何编码"""
+        stream = None
+        try:
+            stream = self._open_target()
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                stream.write(np.ascontiguousarray(item[1]).data)
+                self.frames_written += 1
+            stream.flush()
+        except (OSError, RuntimeError) as e:
+            # 读端退出（BrokenPipe）等情况，由定时器回调停止抓帧
+            self.error = e
+            logger.error(f"推流写出失败: {e}")
+        finally:
+            if stream is not None and stream is not getattr(sys.stdout, "buffer", None):
+                stream.close()
+
+
+class AtomicFileWriter:
+    """原子写入：先写同目录临时文件再改名，目标已存在时追加序号，不覆盖已有截图
+
+    fsync 策略: "none" 不刷盘, "file" 刷新文件内容, "full" 同时刷新所在目录
+    """
+    FSYNC_POLICIES = ("none", "file", "full")
+
+    def __init__(self, fsync="none"):
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError(f"无效的 fsync 策略: {fsync}")
+        self.fsync = fsync
+        self.known_dirs = set()
+        self.lock = threading.Lock()
+        # 同一秒内连续保存时，从上次用过的序号继续尝试
+        self.last_target = None
+        self.last_sequence = 0
+        # 写入完成回调 on_written(路径, 字节数)，用于增量维护保存目录的索引
+        self.on_written = None
+
+    def ensure_dir(self, directory):
+        """创建目录，同一目录只检查一次"""
+        if directory not in self.known_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self.known_dirs.add(directory)
+
+    def reserve(self, path):
+        """以空文件占用一个文件名，返回实际占用的路径；之后用 write(路径, 数据, replace=True) 写入内容"""
+        return self.write(path, b"")
+
+    def write(self, path, data, replace=False):
+        """写入数据，返回实际使用的文件路径（可能带 _序号 后缀）；replace=True 时原子替换已占用的文件"""
+        directory = os.path.dirname(path) or "."
+        self.ensure_dir(directory)
+        tmp_path = os.path.join(directory, f".{os.path.basename(path)}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            self._write_tmp(tmp_path, data)
+        except FileNotFoundError:
+            # 目录被外部删除，重新创建后再试一次
+            self.known_dirs.discard(directory)
+            self.ensure_dir(directory)
+            self._write_tmp(tmp_path, data)
+
+        try:
+            if replace:
+                os.replace(tmp_path, path)
+                final_path = path
+            else:
+                final_path = self._commit(tmp_path, path)
+        except OSError:
+            os.remove(tmp_path)
+            raise
+        if self.fsync == "full":
+            self._fsync_dir(directory)
+        if self.on_written is not None:
+            self.on_written(final_path, len(data))
+        return final_path
+
+    def _write_tmp(self, tmp_path, data):
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            if self.fsync != "none":
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _commit(self, tmp_path, path):
+        """把临时文件改名为第一个未被占用的文件名"""
+        stem, ext = os.path.splitext(path)
+        with self.lock:
+            sequence = self.last_sequence + 1 if path == self.last_target else 0
+        while True:
+            candidate = path if sequence == 0 else f"{stem}_{sequence}{ext}"
+            try:
+                self._link(tmp_path, candidate)
+                break
+            except FileExistsError:
+                sequence += 1
+        with self.lock:
+            self.last_target = path
+            self.last_sequence = sequence
+        return candidate
+
+    def _link(self, tmp_path, path):
+        """不覆盖地把临时文件移动到目标路径，目标已存在时抛出 FileExistsError"""
+        if os.name == "nt":
+            # Windows 下 rename 遇到已存在的目标会失败
+            os.rename(tmp_path, path)
+            return
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            raise
+        except OSError as e:
+            # 不支持硬链接的文件系统（FAT、部分网络盘）退回到检查后替换
+            if e.errno not in (errno.EPERM, errno.EXDEV, errno.ENOTSUP, errno.EOPNOTSUPP):
+                raise
+            with self.lock:
+                if os.path.exists(path):
+                    raise FileExistsError(errno.EEXIST, "文件已存在", path)
+                os.replace(tmp_path, path)
+            return
+        os.remove(tmp_path)
+
+    def _fsync_dir(self, directory):
+        if os.name == "nt":
+            return
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def lower_current_thread_priority():
+    """降低当前线程的调度优先级，让后台任务不抢占界面和截图"""
+    try:
+        if os.name == "nt":
+            kernel32 = ctypes.windll.kernel32
+            kernel32.SetThreadPriority(kernel32.GetCurrentThread(), -2)  # THREAD_PRIORITY_LOWEST
+        elif hasattr(os, "setpriority"):
+            # Linux 下以线程ID调用 setpriority 只影响当前线程
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+    except (OSError, AttributeError) as e:
+        logger.debug(f"无法降低线程优先级: {e}")
+
+
+class _ProcessMemoryCounters(ctypes.Structure):
+    # Windows PROCESS_MEMORY_COUNTERS
+    _fields_ = [("cb", ctypes.c_ulong), ("PageFaultCount", ctypes.c_ulong),
+                ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+
+def process_rss():
+    """当前进程的常驻内存（字节），无法获取时返回 None"""
+    try:
+        if os.name == "nt":
+            kernel32 = ctypes.windll.kernel32
+            psapi = ctypes.windll.psapi
+            kernel32.GetCurrentProcess.restype = ctypes.c_void_p
+            psapi.GetProcessMemoryInfo.argtypes = [ctypes.c_void_p, ctypes.POINTER(_ProcessMemoryCounters),
+                                                   ctypes.c_ulong]
+            counters = _ProcessMemoryCounters()
+            counters.cb = ctypes.sizeof(counters)
+            if psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+                return counters.WorkingSetSize
+            return None
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, AttributeError, ValueError):
+        return None
+
+
+def release_free_memory():
+    """回收垃圾对象，并在 glibc 下用 malloc_trim 把空闲堆内存归还给系统"""
+    gc.collect()
+    if sys.platform.startswith("linux"):
+        try:
+            ctypes.CDLL(ctypes.util.find_library("c")).malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+
+
+class SpillTranscoder:
+    """溢写转码：连续截图时先把原始像素直接落盘，再由低优先级后台线程转码为目标格式
+
+    溢写文件由头部、目标文件路径、输出配置名和紧密排列的像素组成，写完并改名为 .sraw 后即视为持久化。
+    转码成功后删除溢写文件；程序崩溃或重启后 resume() 会继续处理遗留文件。
+    """
+    MAGIC = b"SSPL"
+    # 版本 2 在目标路径后增加输出配置名（1 字节长度 + 名称）；版本 1 的遗留文件按扩展名编码
+    VERSION = 2
+    # 魔数, 版本, 宽, 高, 通道数, 目标路径字节数
+    HEADER = struct.Struct("<4sHIIBH")
+    SUFFIX = ".sraw"
+
+    def __init__(self, spill_dir, writer, fsync=True):
+        self.spill_dir = spill_dir
+        self.writer = writer
+        self.fsync = fsync
+        self.queue = queue.Queue()
+        # 溢写文件名序号，与时间戳和进程号一起保证唯一
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        # 后台线程在第一次有文件要转码时才启动，未启用溢写时不占用线程
+        self.thread = None
+
+    def _submit(self, spill_path):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="SpillTranscoder", daemon=True)
+                self.thread.start()
+        self.queue.put(spill_path)
+
+    def pending(self):
+        """尚未完成转码的文件数"""
+        return self.queue.qsize()
+
+    def spill(self, image, target_path, profile="png"):
+        """把 BGR/BGRA/灰度图像原样写入溢写目录，返回溢写文件路径；profile 为转码时使用的具体输出配置"""
+        os.makedirs(self.spill_dir, exist_ok=True)
+        image = np.ascontiguousarray(image)
+        height, width = image.shape[:2]
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        target = os.path.abspath(target_path).encode("utf-8")
+        profile_name = profile.encode("utf-8")
+
+        # 时钟精度较粗时（如 Windows）连续截图的时间戳可能相同，加上进程号和序号；
+        # 以独占方式创建，名字冲突时报错而不会覆盖已有的溢写文件
+        spill_path = os.path.join(self.spill_dir,
+                                  f"{time.time_ns():020d}_{os.getpid()}_{next(self.sequence):06d}{self.SUFFIX}")
+        part_path = spill_path + ".part"
+        with open(part_path, "xb", buffering=0) as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, width, height, channels, len(target)) + target
+                    + bytes([len(profile_name)]) + profile_name)
+            f.write(image.data)
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(part_path, spill_path)
+
+        self._submit(spill_path)
+        return spill_path
+
+    def resume(self):
+        """重新排队上次未完成的溢写文件，清理写了一半的临时文件"""
+        if not os.path.isdir(self.spill_dir):
+            return 0
+        count = 0
+        for name in sorted(os.listdir(self.spill_dir)):
+            path = os.path.join(self.spill_dir, name)
+            if name.endswith(self.SUFFIX):
+                self._submit(path)
+                count += 1
+            elif name.endswith(self.SUFFIX + ".part"):
+                os.remove(path)
+        if count:
+            logger.info(f"恢复 {count} 个待转码的溢写文件")
+        return count
+
+    def stop(self):
+        """通知后台线程退出，未处理的文件留待下次启动恢复"""
+        if self.thread is not None:
+            self.queue.put(None)
+
+    def read(self, spill_path):
+        """读取溢写文件，返回 (图像, 目标路径, 输出配置)；版本 1 的文件没有输出配置，返回 None"""
+        with open(spill_path, "rb") as f:
+            magic, version, width, height, channels, name_length = self.HEADER.unpack(f.read(self.HEADER.size))
+            if magic != self.MAGIC or version not in (1, 2):
+                raise ValueError(f"无效的溢写文件: {spill_path}")
+            target = f.read(name_length).decode("utf-8")
+            offset = self.HEADER.size + name_length
+            profile = None
+            if version >= 2:
+                profile_length = f.read(1)[0]
+                profile = f.read(profile_length).decode("utf-8")
+                offset += 1 + profile_length
+        image = np.fromfile(spill_path, dtype=np.uint8, count=width * height * channels, offset=offset)
+        shape = (height, width) if channels == 1 else (height, width, channels)
+        return image.reshape(shape), target, profile
+
+    def _transcode(self, spill_path):
+        image, target, profile = self.read(spill_path)
+        if profile is not None and os.path.exists(target) and os.path.getsize(target) > 0:
+            # 版本 2 的目标文件名已用空文件占用且原子替换，非空说明上次已转码完成、
+            # 只是删除溢写文件前程序退出了；再写一次会生成重复的 name_1 文件
+            os.remove(spill_path)
+            logger.debug(f"转码已完成，删除遗留的溢写文件: {target}")
+            return
+        # 按溢写时解析出的输出配置编码，保留 JPEG 质量、调色板量化等参数
+        if profile is not None:
+            data = encode_profile(image, profile)[1]
+        else:
+            data = encode_image(image, os.path.splitext(target)[1] or ".png")
+        # 目标文件名在溢写时已用空文件占用
+        replace = os.path.exists(target) and os.path.getsize(target) == 0
+        target = self.writer.write(target, data, replace=replace)
+        os.remove(spill_path)
+        logger.debug(f"转码完成: {target}")
+
+    def _run(self):
+        lower_current_thread_priority()
+        while True:
+            spill_path = self.queue.get()
+            if spill_path is None:
+                break
+            try:
+                self._transcode(spill_path)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                # 保留溢写文件，下次启动时重试
+                logger.error(f"转码失败 {spill_path}: {e}")
+
+
+def apply_redactions(image, regions, block_size=12, blur_size=25):
+    """在图像上原地打码
+
+    regions 为 (x, y, 宽, 高, 类型) 列表，类型为 "mosaic" 或 "blur"。
+    每个区域只在对应的视图上运算，耗时与打码面积成正比，不复制整幅图像。
+    """
+    height, width = image.shape[:2]
+    for x, y, w, h, kind in regions:
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(width, x + w), min(height, y + h)
+        if x1 <= x0 or y1 <= y0:
+            continue
+        roi = image[y0:y1, x0:x1]
+        if kind == "mosaic":
+            # 先缩小再最近邻放大得到马赛克块
+            small = cv2.resize(roi, (max(1, (x1 - x0) // block_size), max(1, (y1 - y0) // block_size)),
+                               interpolation=cv2.INTER_AREA)
+            roi[...] = cv2.resize(small, (x1 - x0, y1 - y0), interpolation=cv2.INTER_NEAREST)
+        elif kind == "blur":
+            roi[...] = cv2.blur(roi, (blur_size, blur_size))
+    return image
+
+
+def detect_text_regions(image, min_height=6, max_height=120):
+    """查找可能包含文字或密码的区域，返回 (x, y, 宽, 高) 列表
+
+    形态学梯度突出笔画边缘，Otsu 二值化后用横向闭运算把字符连成文本行，
+    再按连通域的尺寸、宽高比和填充率筛选。输入为 BGR/BGRA/灰度图像。
+    """
+    if image.ndim == 2:
+        gray = image
+    elif image.shape[2] == 4:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
+    else:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    gradient = cv2.morphologyEx(gray, cv2.MORPH_GRADIENT, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)))
+    _, binary = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    connected = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (9, 1)))
+    _, _, stats, _ = cv2.connectedComponentsWithStats(connected, connectivity=8)
+
+    stats = stats[1:]
+    widths = stats[:, cv2.CC_STAT_WIDTH]
+    heights = stats[:, cv2.CC_STAT_HEIGHT]
+    fill = stats[:, cv2.CC_STAT_AREA] / np.maximum(widths * heights, 1)
+    keep = ((heights >= min_height) & (heights <= max_height)
+            & (widths >= heights * 1.5) & (fill >= 0.4))
+    return [tuple(int(v) for v in row[:4]) for row in stats[keep]]
+
+
+def find_snap_candidates(image, min_size=16):
+    """用边缘和轮廓检测找出界面元素/窗口的候选矩形，返回 (x, y, 宽, 高) 列表"""
+    if image.ndim == 2:
+        gray = image
+    elif image.shape[2] == 4:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
+    else:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    edges = cv2.Canny(gray, 50, 150)
+    edges = cv2.dilate(edges, cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3)))
+    contours, _ = cv2.findContours(edges, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    candidates = set()
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if w >= min_size and h >= min_size:
+            candidates.add((x, y, w, h))
+    return list(candidates)
+
+
+class SnapIndex:
+    """候选矩形的空间索引
+
+    候选矩形按网格分桶（桶内按面积从小到大），悬停查询只检查光标所在格子；
+    边缘吸附在排好序的边坐标上二分查找，每次鼠标移动都是 O(log n)。
+    """
+
+    def __init__(self, rects, cell_size=64):
+        self.cell_size = cell_size
+        self.rects = sorted(rects, key=lambda r: r[2] * r[3])
+        self.buckets = {}
+        for index, (x, y, w, h) in enumerate(self.rects):
+            for cx in range(x // cell_size, (x + w - 1) // cell_size + 1):
+                for cy in range(y // cell_size, (y + h - 1) // cell_size + 1):
+                    self.buckets.setdefault((cx, cy), []).append(index)
+        self.x_edges = sorted({x for x, _, _, _ in self.rects} | {x + w for x, _, w, _ in self.rects})
+        self.y_edges = sorted({y for _, y, _, _ in self.rects} | {y + h for _, y, _, h in self.rects})
+
+    def __len__(self):
+        return len(self.rects)
+
+    def candidate_at(self, x, y):
+        """返回包含该点的最小候选矩形，没有则返回 None"""
+        for index in self.buckets.get((x // self.cell_size, y // self.cell_size), ()):
+            rx, ry, rw, rh = self.rects[index]
+            if rx <= x < rx + rw and ry <= y < ry + rh:
+                return QRect(rx, ry, rw, rh)
+        return None
+
+    @staticmethod
+    def _nearest(edges, value, distance):
+        index = bisect.bisect_left(edges, value)
+        best = value
+        best_distance = distance + 1
+        for candidate in edges[max(0, index - 1):index + 1]:
+            if abs(candidate - value) < best_distance:
+                best = candidate
+                best_distance = abs(candidate - value)
+        return best
+
+    def snap_x(self, x, distance=8):
+        """吸附到距离不超过 distance 的最近竖直边"""
+        return self._nearest(self.x_edges, x, distance)
+
+    def snap_y(self, y, distance=8):
+        """吸附到距离不超过 distance 的最近水平边"""
+        return self._nearest(self.y_edges, y, distance)
+
+
+class BackgroundRunner(QObject):
+    """在线程池中执行任务，并把结果投递回界面线程"""
+    finished = pyqtSignal(object, object)
+
+    def __init__(self, max_workers=2, parent=None):
+        super().__init__(parent)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="Background")
+        self.finished.connect(self._deliver)
+
+    def submit(self, func, *args, callback=None):
+        """提交任务，callback 在界面线程中以任务结果为参数调用"""
+        future = self.executor.submit(func, *args)
+        if callback:
+            future.add_done_callback(lambda f: self.finished.emit(callback, f))
+        return future
+
+    def _deliver(self, callback, future):
+        if future.cancelled():
+            return
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(f"后台任务失败: {e}")
+            return
+        callback(result)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class Annotation:
+    """矢量标注（矩形、箭头、高亮、文字）和打码区域，坐标相对于选择框左上角"""
+    KINDS = {
+        "rect": "矩形",
+        "arrow": "箭头",
+        "highlight": "高亮",
+        "text": "文字",
+        "mosaic": "马赛克",
+        "blur": "模糊",
+    }
+    # 打码区域在保存时作用于像素，编辑时只显示预览框
+    REDACTION_KINDS = ("mosaic", "blur")
+    ARROW_HEAD = 14
+    FONT = QFont("Arial", 16)
+
+    def __init__(self, kind, start, end=None, text="", color=None, width=3):
+        self.kind = kind
+        self.start = QPoint(start)
+        self.end = QPoint(end if end is not None else start)
+        self.text = text
+        self.color = QColor(color) if color is not None else QColor(Qt.red)
+        self.width = width
+
+    def is_redaction(self):
+        return self.kind in self.REDACTION_KINDS
+
+    def is_empty(self):
+        """拖动距离过小的图形视为无效"""
+        if self.kind == "text":
+            return not self.text
+        return (self.end - self.start).manhattanLength() < 3
+
+    def bounds(self):
+        """标注的重绘范围（含线宽和箭头）"""
+        if self.kind == "text":
+            rect = QFontMetrics(self.FONT).boundingRect(self.text)
+            rect.moveTo(self.start.x(), self.start.y() - rect.height())
+            return rect.adjusted(-2, -2, 2, 2)
+        margin = self.width + (self.ARROW_HEAD if self.kind == "arrow" else 0)
+        return QRect(self.start, self.end).normalized().adjusted(-margin, -margin, margin, margin)
+
+    def paint(self, painter):
+        """绘制标注"""
+        if self.is_redaction():
+            painter.setPen(QPen(Qt.white, 1, Qt.DashLine))
+            painter.setBrush(QBrush(QColor(128, 128, 128, 160), Qt.BDiagPattern))
+            painter.drawRect(QRect(self.start, self.end).normalized())
+        elif self.kind == "highlight":
+            highlight = QColor(255, 255, 0, 90)
+            painter.setPen(Qt.NoPen)
+            painter.setBrush(highlight)
+            painter.drawRect(QRect(self.start, self.end).normalized())
+        elif self.kind == "rect":
+            painter.setPen(QPen(self.color, self.width))
+            painter.setBrush(Qt.NoBrush)
+            painter.drawRect(QRect(self.start, self.end).normalized())
+        elif self.kind == "arrow":
+            painter.setPen(QPen(self.color, self.width, Qt.SolidLine, Qt.RoundCap))
+            painter.drawLine(self.start, self.end)
+            angle = math.atan2(self.end.y() - self.start.y(), self.end.x() - self.start.x())
+            for offset in (math.pi - 0.45, math.pi + 0.45):
+                head = QPoint(int(self.end.x() + self.ARROW_HEAD * math.cos(angle + offset)),
+                              int(self.end.y() + self.ARROW_HEAD * math.sin(angle + offset)))
+                painter.drawLine(self.end, head)
+        elif self.kind == "text":
+            painter.setFont(self.FONT)
+            painter.setPen(self.color)
+            painter.drawText(self.start, self.text)
+
+
+class AnnotationLayer:
+    """标注显示列表
+
+    编辑时标注绘制在与选择框同尺寸的透明缓存层上，只重绘与脏区域相交的标注；
+    保存时由 render() 一次性栅格化到输出图像。
+    """
+
+    def __init__(self):
+        self.items = []
+        self.cache = QPixmap()
+
+    def is_empty(self):
+        return not self.items
+
+    def resize(self, size):
+        """选择框尺寸变化时重建缓存层"""
+        if self.cache.size() == size:
+            return
+        self.cache = QPixmap(size)
+        self.repaint_region(QRect(QPoint(0, 0), size))
+
+    def repaint_region(self, region):
+        """清空缓存层的脏区域，只重绘与之相交的标注"""
+        if self.cache.isNull():
+            return
+        painter = QPainter(self.cache)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.fillRect(region, Qt.transparent)
+        painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setClipRect(region)
+        for item in self.items:
+            if item.bounds().intersects(region):
+                item.paint(painter)
+        painter.end()
+
+    def add(self, item):
+        """添加标注，返回脏区域"""
+        self.items.append(item)
+        dirty = item.bounds()
+        self.repaint_region(dirty)
+        return dirty
+
+    def update_item(self, item, old_bounds):
+        """标注几何变化后重绘，返回脏区域"""
+        dirty = old_bounds.united(item.bounds())
+        self.repaint_region(dirty)
+        return dirty
+
+    def remove(self, item):
+        """删除标注，返回脏区域"""
+        self.items.remove(item)
+        dirty = item.bounds()
+        self.repaint_region(dirty)
+        return dirty
+
+    def undo(self):
+        """撤销最后一个标注，返回脏区域"""
+        if not self.items:
+            return QRect()
+        return self.remove(self.items[-1])
+
+    def clear(self):
+        self.items = []
+        if not self.cache.isNull():
+            self.cache.fill(Qt.transparent)
+
+    def release(self):
+        """清空标注并释放缓存层"""
+        self.items = []
+        self.cache = QPixmap()
+
+    def redactions(self):
+        """返回打码区域列表 (x, y, 宽, 高, 类型)"""
+        regions = []
+        for item in self.items:
+            if item.is_redaction():
+                rect = QRect(item.start, item.end).normalized()
+                regions.append((rect.x(), rect.y(), rect.width(), rect.height(), item.kind))
+        return regions
+
+    def render(self, painter):
+        """把矢量标注栅格化到 painter 所在的设备（坐标原点为选择框左上角），打码区域除外"""
+        painter.setRenderHint(QPainter.Antialiasing)
+        for item in self.items:
+            if not item.is_redaction():
+                item.paint(painter)
+
+
+class PixelLoupe(QLabel):
+    """像素放大镜：在光标旁显示放大的像素网格和光标处的颜色值
+
+    只取光标周围的小块源像素，用最近邻放大后叠加预先绘制好的网格，
+    光标跨过像素边界时才重新渲染。
+    """
+
+    def __init__(self, parent=None, radius=7, zoom=10):
+        super().__init__(parent)
+        self.radius = radius
+        self.zoom = zoom
+        self.zoom_size = (2 * radius + 1) * zoom
+        self.text_height = 36
+        self.last_pixel = None
+
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.setFixedSize(self.zoom_size, self.zoom_size + self.text_height)
+        self.grid = self._create_grid()
+        self.hide()
+
+    def _create_grid(self):
+        """预先绘制像素网格和中心框"""
+        grid = QPixmap(self.zoom_size, self.zoom_size)
+        grid.fill(Qt.transparent)
+        painter = QPainter(grid)
+        painter.setPen(QPen(QColor(0, 0, 0, 60), 1))
+        for i in range(0, self.zoom_size + 1, self.zoom):
+            painter.drawLine(i, 0, i, self.zoom_size)
+            painter.drawLine(0, i, self.zoom_size, i)
+        painter.setPen(QPen(Qt.red, 2))
+        painter.setBrush(Qt.NoBrush)
+        center = self.radius * self.zoom
+        painter.drawRect(center, center, self.zoom, self.zoom)
+        painter.setPen(QPen(QColor(52, 152, 219), 2))
+        painter.drawRect(1, 1, self.zoom_size - 2, self.zoom_size - 2)
+        painter.end()
+        return grid
+
+    def reset(self):
+        self.last_pixel = None
+        self.hide()
+
+    def update_at(self, image, pos):
+        """光标移到新像素时重新渲染并移动放大镜"""
+        if pos == self.last_pixel:
+            return
+        self.last_pixel = QPoint(pos)
+        x, y = pos.x(), pos.y()
+        if not image.valid(x, y):
+            self.hide()
+            return
+
+        # 取出光标周围的小块源像素，最近邻放大
+        patch = image.copy(x - self.radius, y - self.radius, 2 * self.radius + 1, 2 * self.radius + 1)
+        scaled = patch.scaled(self.zoom_size, self.zoom_size, Qt.IgnoreAspectRatio, Qt.FastTransformation)
+        color = QColor(image.pixel(x, y))
+
+        pixmap = QPixmap(self.width(), self.height())
+        pixmap.fill(QColor(44, 62, 80))
+        painter = QPainter(pixmap)
+        painter.drawImage(0, 0, scaled)
+        painter.drawPixmap(0, 0, self.grid)
+        painter.setPen(Qt.white)
+        painter.setFont(QFont("Consolas", 9))
+        painter.drawText(QRect(0, self.zoom_size, self.width(), self.text_height), Qt.AlignCenter,
+                         f"({x}, {y})  {color.name().upper()}\n"
+                         f"RGB({color.red()}, {color.green()}, {color.blue()})")
+        painter.end()
+        self.setPixmap(pixmap)
+
+        # 放在光标右下方，超出屏幕时翻到另一侧
+        parent = self.parentWidget()
+        left = x + 20 if x + 20 + self.width() <= parent.width() else x - 20 - self.width()
+        top = y + 20 if y + 20 + self.height() <= parent.height() else y - 20 - self.height()
+        self.move(left, top)
+        if not self.isVisible():
+            self.show()
+            self.raise_()
+
+
+class CapturePipeline:
+    """截图后处理流水线
+
+    配置以 JSON 保存在 QSettings 的 "pipeline" 键中，例如:
+        {"stages": [{"type": "crop", "margin": 2}],
+         "variants": [{"suffix": "_web", "profile": "jpeg_web",
+                       "stages": [{"type": "max_dimension", "size": 1280}]}]}
+    主输出的处理阶段在当前线程执行；各衍生版本以未经主输出处理的截图为输入，
+    互不依赖，在进程池中并行生成。
+    """
+
+    def __init__(self, config, writer):
+        if not isinstance(config, dict):
+            raise ValueError("处理流水线配置必须是对象")
+        self.stages = config.get("stages", [])
+        self.variants = config.get("variants", [])
+        self.writer = writer
+        self.pool = None
+        self.validate()
+
+    @classmethod
+    def from_settings(cls, settings, writer):
+        """从设置加载流水线，配置无效时退回空流水线"""
+        try:
+            return cls(json.loads(settings.value("pipeline", "") or "{}"), writer)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.error(f"处理流水线配置无效: {e}")
+            return cls({}, writer)
+
+    def validate(self):
+        """检查各阶段的类型和参数，以及衍生版本的后缀和输出配置"""
+        if not isinstance(self.stages, list) or not isinstance(self.variants, list):
+            raise ValueError("stages 和 variants 必须是数组")
+        for variant in self.variants:
+            if not isinstance(variant, dict) or not isinstance(variant.get("stages", []), list):
+                raise ValueError(f"衍生版本必须是对象，且 stages 为数组: {variant!r}")
+        for stages in [self.stages] + [variant.get("stages", []) for variant in self.variants]:
+            for stage in stages:
+                validate_pipeline_stage(stage)
+        for variant in self.variants:
+            if not variant.get("suffix") or not isinstance(variant["suffix"], str):
+                raise ValueError("衍生版本必须指定文件名后缀")
+            if not is_valid_profile(variant.get("profile", "png")):
+                raise ValueError(f"未知的输出配置: {variant.get('profile')}")
+
+    def process(self, image):
+        """对主输出执行处理阶段"""
+        return run_pipeline_stages(image, self.stages) if self.stages else image
+
+    def submit_variants(self, image, base_path):
+        """在进程池中生成各衍生版本，完成后写到主输出旁边"""
+        if not self.variants:
+            return []
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=min(len(self.variants), os.cpu_count() or 2))
+        futures = []
+        for variant in self.variants:
+            future = self.pool.submit(render_pipeline_variant, image, variant.get("stages", []),
+                                      variant.get("profile", "png"))
+            future.add_done_callback(lambda f, v=variant: self._write_variant(f, base_path, v))
+            futures.append(future)
+        return futures
+
+    def _write_variant(self, future, base_path, variant):
+        try:
+            ext, data = future.result()
+            path = self.writer.write(os.path.splitext(base_path)[0] + variant["suffix"] + ext, data)
+            logger.debug(f"衍生版本已保存: {path}")
+        except Exception as e:
+            logger.error(f"衍生版本 {variant['suffix']} 生成失败: {e}")
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".webp", ".tif", ".tiff")
+
+
+def extract_regions_from_file(path, regions, out_dir, profile="png"):
+    """进程池任务：解码一张图片，裁出各区域并按输出配置编码写出，返回写出的文件列表
+
+    regions 为 (名称, x, y, 宽, 高) 列表，裁剪使用视图，只编码所需区域的像素。
+    """
+    image = cv2.imdecode(np.fromfile(path, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"无法解码: {path}")
+    stem = os.path.splitext(os.path.basename(path))[0]
+    writer = AtomicFileWriter()
+    outputs = []
+    for name, x, y, w, h in regions:
+        crop = image[max(0, y):y + h, max(0, x):x + w]
+        if crop.size == 0:
+            continue
+        ext, data = encode_profile(crop, profile)
+        outputs.append(writer.write(os.path.join(out_dir, f"{stem}_{name}{ext}"), data))
+    return outputs
+
+
+def batch_extract_regions(src_dir, regions, out_dir, profile="png", workers=None, progress=None):
+    """批量从目录中的图片裁剪相同区域
+
+    文件按目录遍历顺序逐个提交到进程池，同时在途的任务数有上限，
+    内存占用与目录中的文件数无关。progress(已完成数, 失败数, 当前文件) 在每张图片完成后调用。
+    返回 (成功数, 失败文件列表)。
+    """
+    workers = workers or os.cpu_count() or 2
+    max_pending = workers * 2
+    succeeded = 0
+    failed = []
+
+    def collect(finished):
+        nonlocal succeeded
+        for future in finished:
+            path = pending.pop(future)
+            try:
+                future.result()
+                succeeded += 1
+            except (OSError, ValueError, cv2.error) as e:
+                logger.error(f"批量裁剪失败 {path}: {e}")
+                failed.append(path)
+            if progress:
+                progress(succeeded, len(failed), path)
+
+    pending = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        with os.scandir(src_dir) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                pending[pool.submit(extract_regions_from_file, entry.path, regions, out_dir, profile)] = entry.path
+                if len(pending) >= max_pending:
+                    finished, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                    collect(finished)
+        finished, _ = wait(list(pending))
+        collect(finished)
+    return succeeded, failed
+
+
+def sanitize_filename(name):
+    """去掉 Windows 文件名中不允许的字符"""
+    return re.sub(r'[\\/*?:"<>|]', '', name)
+
+
+def parse_region_presets(text):
+    """解析区域预设 JSON，返回 (名称, x, y, 宽, 高) 列表
+
+    格式: [{"name": "cpu", "x": 0, "y": 0, "width": 640, "height": 360}, ...]，名称用作文件名后缀，不能重复。
+    """
+    regions = []
+    presets = json.loads(text or "[]")
+    if not isinstance(presets, list):
+        raise ValueError("区域预设必须是数组")
+    for preset in presets:
+        if not isinstance(preset, dict):
+            raise ValueError(f"区域预设必须是对象: {preset!r}")
+        name = sanitize_filename(str(preset.get("name", ""))).strip()
+        if not name:
+            raise ValueError("区域预设必须指定名称")
+        if any(name == region[0] for region in regions):
+            raise ValueError(f"区域预设名称重复: {name}")
+        x, y, width, height = (int(preset[key]) for key in ("x", "y", "width", "height"))
+        if width <= 0 or height <= 0:
+            raise ValueError(f"区域预设 {name} 的尺寸无效: {width}x{height}")
+        regions.append((name, x, y, width, height))
+    return regions
+
+
+def _encode_region(frame, x, y, width, height, path, profile, writer):
+    """线程池任务：裁出一个区域（视图）并编码写出"""
+    crop = frame[y:y + height, x:x + width]
+    if crop.shape[2] == 4:
+        crop = cv2.cvtColor(crop, cv2.COLOR_BGRA2BGR)
+    ext, data = encode_profile(crop, profile)
+    return writer.write(path + ext, data), len(data)
+
+
+def capture_regions(frame, regions, directory, name, profile, writer, executor, captured_at=None):
+    """从同一帧裁出全部预设区域，在线程池中并行编码写出，最后写清单文件，返回清单
+
+    frame 为 BGR 或 BGRX 像素，裁剪只取视图，各区域只编码自己的像素。
+    文件名为 名称_区域名.扩展名，清单为 名称_manifest.json，记录抓取时间、帧尺寸和每个区域的结果。
+    """
+    height, width = frame.shape[:2]
+    manifest = {
+        "name": name,
+        "captured_at": captured_at or time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "frame": [width, height],
+        "profile": profile,
+        "regions": [],
+    }
+    futures = []
+    for region_name, x, y, w, h in regions:
+        # 裁到帧范围内
+        left, top = max(0, x), max(0, y)
+        right, bottom = min(width, x + w), min(height, y + h)
+        entry = {"name": region_name, "rect": [x, y, w, h]}
+        manifest["regions"].append(entry)
+        if right <= left or bottom <= top:
+            entry["error"] = "区域超出屏幕范围"
+            continue
+        entry["captured_rect"] = [left, top, right - left, bottom - top]
+        path = os.path.join(directory, f"{name}_{region_name}")
+        futures.append((entry, executor.submit(_encode_region, frame, left, top, right - left, bottom - top,
+                                               path, profile, writer)))
+    for entry, future in futures:
+        try:
+            path, size = future.result()
+            entry["file"] = os.path.basename(path)
+            entry["bytes"] = size
+        except (OSError, ValueError, cv2.error) as e:
+            logger.error(f"区域 {entry['name']} 保存失败: {e}")
+            entry["error"] = str(e)
+    manifest_path = writer.write(os.path.join(directory, f"{name}_manifest.json"),
+                                 json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8"))
+    manifest["manifest"] = manifest_path
+    return manifest
+
+
+def apply_run_retention(directory, keep):
+    """只保留目录中最近 keep 次区域截图（以清单文件计），删除更早的清单及其列出的文件，返回删除的文件数"""
+    if keep <= 0 or not os.path.isdir(directory):
+        return 0
+    manifests = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # 文件名冲突时写入器会追加 _序号
+            if entry.is_file() and re.search(r"_manifest(_\d+)?\.json$", entry.name):
+                manifests.append((entry.stat().st_mtime, entry.name))
+    manifests.sort()
+    deleted = 0
+    for _, manifest_name in manifests[:-keep]:
+        manifest_path = os.path.join(directory, manifest_name)
+        try:
+            with open(manifest_path, encoding="utf-8") as f:
+                files = [entry["file"] for entry in json.load(f).get("regions", []) if "file" in entry]
+        except (OSError, ValueError) as e:
+            logger.error(f"读取清单失败 {manifest_path}: {e}")
+            files = []
+        for name in files + [manifest_name]:
+            try:
+                os.remove(os.path.join(directory, name))
+                deleted += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"删除过期截图失败 {name}: {e}")
+    return deleted
+
+
+class IntervalSchedule:
+    """固定间隔：触发时刻为纪元时间加 offset 后间隔的整数倍，不受前一次执行耗时影响"""
+
+    def __init__(self, seconds, offset=0):
+        if seconds <= 0:
+            raise ValueError(f"间隔必须大于 0: {seconds}")
+        self.seconds = seconds
+        self.offset = offset
+
+    def next_after(self, t):
+        return (math.floor((t - self.offset) / self.seconds) + 1) * self.seconds + self.offset
+
+    def missed_between(self, due, now):
+        """due 之后、now 及之前错过的触发次数"""
+        return max(0, math.floor((now - due) / self.seconds))
+
+    def __str__(self):
+        return f"every {self.seconds:g}s"
+
+
+class CronSchedule:
+    """类 cron 表达式：分 时 日 月 周，支持 *、*/n、a-b、a-b/n 和逗号列表，周日为 0 或 7"""
+    FIELDS = (("minute", 0, 59), ("hour", 0, 23), ("day", 1, 31), ("month", 1, 12), ("weekday", 0, 7))
+
+    def __init__(self, expression):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"cron 表达式需要 5 个字段: {expression}")
+        self.expression = expression
+        for (name, low, high), part in zip(self.FIELDS, parts):
+            setattr(self, name, self._parse_field(part, low, high))
+        self.weekday = {0 if day == 7 else day for day in self.weekday}
+        # 日和周都受限时两者满足其一即可（与 cron 一致）
+        self.day_any = parts[2] == "*"
+        self.weekday_any = parts[4] == "*"
+
+    @staticmethod
+    def _parse_field(text, low, high):
+        values = set()
+        for item in text.split(","):
+            item, _, step = item.partition("/")
+            if item == "*":
+                start, stop = low, high
+            elif "-" in item:
+                start, stop = (int(v) for v in item.split("-", 1))
+            else:
+                start = stop = int(item)
+            if start < low or stop > high or start > stop:
+                raise ValueError(f"cron 字段超出范围: {text}")
+            values.update(range(start, stop + 1, int(step) if step else 1))
+        return values
+
+    def _day_matches(self, moment):
+        day = moment.day in self.day
+        weekday = (moment.weekday() + 1) % 7 in self.weekday
+        if self.day_any or self.weekday_any:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, t):
+        from datetime import datetime, timedelta
+        moment = datetime.fromtimestamp(t).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # 逐级跳过不匹配的月、日、小时，最多向后找 5 年
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.month:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hour:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minute:
+                moment += timedelta(minutes=1)
+            else:
+                return moment.timestamp()
+        raise ValueError(f"cron 表达式没有可触发的时间: {self.expression}")
+
+    def missed_between(self, due, now, limit=100):
+        """due 之后、now 及之前错过的触发次数，最多计 limit 次（长时间休眠后不逐分钟遍历）"""
+        missed = 0
+        moment = self.next_after(due)
+        while moment <= now and missed < limit:
+            missed += 1
+            moment = self.next_after(moment)
+        return missed
+
+    def __str__(self):
+        return self.expression
+
+
+def parse_schedule(spec):
+    """解析计划：数字（秒）、"every 30s" / "5m" / "1h" 形式的间隔，或 5 字段 cron 表达式"""
+    if isinstance(spec, (int, float)):
+        return IntervalSchedule(float(spec))
+    text = str(spec).strip()
+    match = re.fullmatch(r"(?:every\s+)?(\d+(?:\.\d+)?)\s*([smhd]?)", text)
+    if match:
+        unit = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}[match.group(2)]
+        return IntervalSchedule(float(match.group(1)) * unit)
+    return CronSchedule(text)
+
+
+class CaptureJob:
+    """定时截图任务：按计划对指定区域预设截图，保留最近 retention 次结果，并记录耗时统计"""
+
+    def __init__(self, name, schedule, regions=(), profile="png", retention=0, enabled=True):
+        self.name = name
+        self.schedule = schedule
+        self.regions = list(regions)
+        self.profile = profile
+        self.retention = retention
+        self.enabled = enabled
+        self.next_due = None
+        self.running = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.runs = 0
+        self.failures = 0
+        self.coalesced = 0
+        self.last_error = None
+        self.last_run = None
+        self.durations = collections.deque(maxlen=200)
+        self.lateness = collections.deque(maxlen=200)
+
+    def stats(self):
+        """耗时统计（毫秒）"""
+        durations = sorted(self.durations)
+        lateness = sorted(self.lateness)
+        return {
+            "runs": self.runs,
+            "failures": self.failures,
+            "coalesced": self.coalesced,
+            "duration_ms": {"p50": _percentile(durations, 50) * 1000, "p95": _percentile(durations, 95) * 1000,
+                            "max": (durations[-1] if durations else 0) * 1000},
+            "lateness_ms": {"p50": _percentile(lateness, 50) * 1000, "max": (lateness[-1] if lateness else 0) * 1000},
+        }
+
+
+def parse_capture_jobs(text):
+    """解析定时任务 JSON，返回 CaptureJob 列表
+
+    格式: [{"name": "dash", "schedule": "every 5m" 或 "*/5 * * * *", "regions": ["cpu", "mem"],
+            "profile": "png", "retention": 288, "enabled": true}]，regions 为空时使用全部区域预设。
+    """
+    jobs = []
+    now = time.time()
+    for config in json.loads(text or "[]"):
+        if not isinstance(config, dict):
+            raise ValueError(f"定时任务必须是对象: {config!r}")
+        name = sanitize_filename(str(config.get("name", ""))).strip()
+        if not name:
+            raise ValueError("定时任务必须指定名称")
+        if any(job.name == name for job in jobs):
+            raise ValueError(f"定时任务名称重复: {name}")
+        profile = config.get("profile", "png")
+        if not is_valid_profile(profile):
+            raise ValueError(f"未知的输出配置: {profile}")
+        schedule = parse_schedule(config["schedule"])
+        # 先算一次下一个触发时刻，永远不会触发的 cron 表达式（如 2 月 31 日）在这里报错
+        schedule.next_after(now)
+        jobs.append(CaptureJob(name, schedule, config.get("regions", []), profile,
+                               int(config.get("retention", 0)), bool(config.get("enabled", True))))
+    return jobs
+
+
+class CaptureScheduler(QObject):
+    """定时任务调度
+
+    每次触发后都按各任务的计划重新计算下一次的绝对时刻，定时器只等待到最近的那个时刻，
+    误差不会累积；等待最长 60 秒，系统休眠或调整时钟后也能及时校正：时钟向回调整时，
+    下一次时刻晚于按当前时间算出的时刻，按当前时间重新对齐。
+    错过的多次触发合并为一次执行，任务仍在执行时到期的触发直接跳过，都计入 coalesced。
+    start_job(job) 在界面线程中调用（抓屏），返回在工作线程中执行的函数；编码和写文件都不在事件循环中进行。
+    """
+    finished = pyqtSignal(object, object, float)
+    MAX_WAIT = 60.0
+
+    def __init__(self, start_job, parent=None):
+        super().__init__(parent)
+        self.start_job = start_job
+        self.jobs = []
+        self.stopped = False
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="CaptureJob")
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self._on_timer)
+        self.finished.connect(self._on_finished)
+
+    def set_jobs(self, jobs):
+        """替换任务列表，同名任务保留统计数据"""
+        previous = {job.name: job for job in self.jobs}
+        now = time.time()
+        for job in jobs:
+            old = previous.get(job.name)
+            if old is not None:
+                job.runs, job.failures, job.coalesced = old.runs, old.failures, old.coalesced
+                job.durations, job.lateness, job.last_run = old.durations, old.lateness, old.last_run
+            job.next_due = job.schedule.next_after(now)
+        self.jobs = jobs
+        self._arm()
+
+    def _arm(self):
+        due = [job.next_due for job in self.jobs if job.enabled]
+        if not due:
+            self.timer.stop()
+            return
+        delay = min(max(0.0, min(due) - time.time()), self.MAX_WAIT)
+        self.timer.start(int(math.ceil(delay * 1000)))
+
+    def _on_timer(self):
+        now = time.time()
+        for job in self.jobs:
+            if not job.enabled:
+                continue
+            next_due = job.schedule.next_after(now)
+            if job.next_due > next_due:
+                logger.info(f"定时任务 {job.name}: 系统时钟已向回调整，重新计算下一次触发时刻")
+                job.next_due = next_due
+                continue
+            if job.next_due > now:
+                continue
+            due = job.next_due
+            # 跳过已错过的触发时刻，直接取当前时间之后的下一个时刻
+            missed = job.schedule.missed_between(due, now)
+            job.next_due = next_due
+            if job.running:
+                job.coalesced += missed + 1
+                logger.warning(f"定时任务 {job.name} 仍在执行，跳过本次触发")
+                continue
+            job.coalesced += missed
+            job.lateness.append(now - due)
+            self._run(job)
+        self._arm()
+
+    def _run(self, job):
+        start = time.perf_counter()
+        try:
+            work = self.start_job(job)
+        except Exception as e:
+            job.failures += 1
+            job.last_error = str(e)
+            logger.error(f"定时任务 {job.name} 启动失败: {e}")
+            return
+        job.running = True
+        future = self.executor.submit(work)
+
+        def done(f):
+            # 停止后调度器可能已被销毁，不再投递结果
+            if not self.stopped:
+                self.finished.emit(job, f, start)
+
+        future.add_done_callback(done)
+
+    def _on_finished(self, job, future, start):
+        job.running = False
+        job.last_run = time.time()
+        job.durations.append(time.perf_counter() - start)
+        try:
+            future.result()
+            job.runs += 1
+            job.last_error = None
+        except Exception as e:
+            job.failures += 1
+            job.last_error = str(e)
+            logger.error(f"定时任务 {job.name} 执行失败: {e}")
+
+    def run_now(self, name):
+        """立即执行一次任务（不影响计划）"""
+        for job in self.jobs:
+            if job.name == name and not job.running:
+                self._run(job)
+
+    def report(self):
+        """各任务的计划、下一次触发时间和耗时统计"""
+        lines = []
+        for job in self.jobs:
+            stats = job.stats()
+            state = "已停用" if not job.enabled else time.strftime("下次 %m-%d %H:%M:%S", time.localtime(job.next_due))
+            line = (f"{job.name} [{job.schedule}] {state}\n"
+                    f"  执行 {stats['runs']} 次, 失败 {stats['failures']} 次, 合并/跳过 {stats['coalesced']} 次\n"
+                    f"  耗时 p50 {stats['duration_ms']['p50']:.1f} ms, p95 {stats['duration_ms']['p95']:.1f} ms, "
+                    f"最大 {stats['duration_ms']['max']:.1f} ms; 触发延迟 p50 {stats['lateness_ms']['p50']:.1f} ms")
+            if job.last_error:
+                line += f"\n  最近错误: {job.last_error}"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def stop(self):
+        self.stopped = True
+        self.timer.stop()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def estimate_shift(before, after, max_side=1024, min_response=0.2):
+    """用相位相关估计 after 相对 before 的整体平移 (dx, dy)，用于对齐滚动或窗口移动前后的截图
+
+    先缩小到最长边 max_side 再做 FFT，相关峰不明显时认为没有平移。
+    """
+    height = min(before.shape[0], after.shape[0])
+    width = min(before.shape[1], after.shape[1])
+    scale = min(1.0, max_side / max(height, width))
+    size = (max(1, int(width * scale)), max(1, int(height * scale)))
+
+    def prepare(image):
+        gray = image[:height, :width] if image.ndim == 2 else cv2.cvtColor(image[:height, :width], cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    (dx, dy), response = cv2.phaseCorrelate(prepare(before), prepare(after))
+    if response < min_response:
+        return 0, 0
+    return int(round(dx / scale)), int(round(dy / scale))
+
+
+def diff_images(before, after, threshold=24, block_size=16, tile_rows=256, shift=(0, 0), overlay=True):
+    """逐像素、逐块比较两张 BGR 截图，返回 (叠加图, 变化区域列表, 统计)
+
+    shift 为 after 相对 before 的平移，只比较两图重叠的部分。按 tile_rows 行分条处理，
+    中间结果只占一条的内存。像素任一通道差值超过 threshold 即视为变化；
+    含变化像素的块按 8 邻接合并为区域，区域为 after 坐标下的 (x, y, 宽, 高)。
+    叠加图在 after 的副本上把未变化部分压暗、变化像素标红并画出区域框，overlay=False 时为 None。
+    """
+    dx, dy = shift
+    bx0, by0 = max(0, -dx), max(0, -dy)
+    ax0, ay0 = max(0, dx), max(0, dy)
+    width = min(before.shape[1] - bx0, after.shape[1] - ax0)
+    height = min(before.shape[0] - by0, after.shape[0] - ay0)
+    if width <= 0 or height <= 0:
+        raise ValueError("两张截图没有重叠区域")
+    tile_rows = max(block_size, tile_rows // block_size * block_size)
+    grid = np.zeros((-(-height // block_size), -(-width // block_size)), dtype=np.uint8)
+    result = after.copy() if overlay else None
+    changed = 0
+    for top in range(0, height, tile_rows):
+        rows = min(tile_rows, height - top)
+        old = before[by0 + top:by0 + top + rows, bx0:bx0 + width]
+        new = after[ay0 + top:ay0 + top + rows, ax0:ax0 + width]
+        delta = cv2.absdiff(old, new)
+        if delta.ndim == 3:
+            # 逐通道取最大值，比 max(axis=2) 快一个数量级
+            delta = np.maximum(np.maximum(delta[..., 0], delta[..., 1]), delta[..., 2])
+        mask = delta > threshold
+        changed += int(np.count_nonzero(mask))
+        # 补齐到整块后按块归约
+        pad_rows, pad_cols = -rows % block_size, -width % block_size
+        padded = np.pad(mask, ((0, pad_rows), (0, pad_cols))) if pad_rows or pad_cols else mask
+        blocks = padded.reshape(padded.shape[0] // block_size, block_size, -1, block_size).any(axis=(1, 3))
+        grid[top // block_size:top // block_size + blocks.shape[0]] = blocks
+        if overlay:
+            view = result[ay0 + top:ay0 + top + rows, ax0:ax0 + width]
+            highlight = cv2.add(cv2.convertScaleAbs(view, alpha=0.4), (0, 0, 153, 0))
+            view //= 3
+            cv2.copyTo(highlight, mask.view(np.uint8), view)
+    count, _, stats, _ = cv2.connectedComponentsWithStats(grid, connectivity=8)
+    boxes = []
+    for x, y, w, h, _ in stats[1:count]:
+        x, y = int(x) * block_size, int(y) * block_size
+        w = min(int(w) * block_size, width - x)
+        h = min(int(h) * block_size, height - y)
+        boxes.append((ax0 + x, ay0 + y, w, h))
+    boxes.sort(key=lambda box: (box[1], box[0]))
+    if overlay:
+        for x, y, w, h in boxes:
+            cv2.rectangle(result, (x, y), (x + w - 1, y + h - 1), (0, 255, 255), 2)
+    summary = {
+        "shift": [dx, dy],
+        "compared": [width, height],
+        "changed_pixels": changed,
+        "changed_ratio": round(changed / (width * height), 6),
+        "regions": len(boxes),
+    }
+    return result, boxes, summary
+
+
+def diff_capture_files(before_path, after_path, out_path=None, align=True, **options):
+    """比较两个截图文件，写出叠加图和同名 .json（区域列表与统计），返回 (叠加图路径, 区域列表, 统计)"""
+    images = []
+    for path in (before_path, after_path):
+        image = cv2.imdecode(np.fromfile(path, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError(f"无法解码: {path}")
+        images.append(image)
+    before, after = images
+    shift = estimate_shift(before, after) if align else (0, 0)
+    overlay, boxes, summary = diff_images(before, after, shift=shift, **options)
+    if out_path is None:
+        out_path = os.path.splitext(after_path)[0] + "_diff.png"
+    writer = AtomicFileWriter()
+    out_path = writer.write(out_path, encode_profile(overlay, "png")[1])
+    summary.update(before=os.path.abspath(before_path), after=os.path.abspath(after_path),
+                   boxes=[list(box) for box in boxes])
+    writer.write(os.path.splitext(out_path)[0] + ".json",
+                 json.dumps(summary, ensure_ascii=False, indent=2).encode("utf-8"))
+    logger.info(f"截图对比: 变化 {summary['changed_ratio'] * 100:.2f}%, {len(boxes)} 个区域, 平移 {shift} -> {out_path}")
+    return out_path, boxes, summary
+
+
+def image_hashes(image):
+    """计算感知哈希，返回 (aHash, dHash) 两个 64 位整数
+
+    aHash：缩到 8x8 后与均值比较；dHash：缩到 9x8 后比较水平相邻像素。
+    缩放用 INTER_AREA，对整屏截图也只需几毫秒。
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY if image.shape[2] == 3
+                                                       else cv2.COLOR_BGRA2GRAY)
+    small = cv2.resize(gray, (8, 8), interpolation=cv2.INTER_AREA)
+    wide = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    ahash = np.packbits(small > small.mean()).view(">u8")[0]
+    dhash = np.packbits(wide[:, 1:] > wide[:, :-1]).view(">u8")[0]
+    return int(ahash), int(dhash)
+
+
+def read_hash_image(path):
+    """按计算哈希的统一方式读取图片文件：完整彩色解码，灰度化与缩放交给 image_hashes
+
+    保存时、补算时和查询时都经过同一条路径，哈希才可以互相比较。
+    """
+    return cv2.imdecode(np.fromfile(path, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def hamming_distances(hashes, value):
+    """hashes（uint64 数组）中每一项与 value 的汉明距离"""
+    diff = np.bitwise_xor(hashes, np.uint64(value))
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(diff)
+    return _POPCOUNT8[diff.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+
+class HashIndex:
+    """截图感知哈希索引
+
+    哈希保存在两个按倍增扩容的 uint64 数组中（前 len(paths) 项有效），查询时对全部条目做向量化异或和位计数（10 万条约几毫秒）。
+    索引文件为追加写入的 JSONL，加载时后出现的同路径条目覆盖之前的，失效条目过多时重写压缩。
+    新截图和历史文件的哈希由低优先级后台线程按 read_hash_image 读取已落盘的文件计算。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.paths = []
+        self.positions = {}
+        self.mtimes = []
+        self.ahashes = np.zeros(0, dtype=np.uint64)
+        self.dhashes = np.zeros(0, dtype=np.uint64)
+        self.load()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="HashIndex", daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def load(self):
+        """读取索引文件"""
+        records = {}
+        lines = 0
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    lines += 1
+                    if record.get("removed"):
+                        records.pop(record["path"], None)
+                    else:
+                        records[record["path"]] = record
+        self.paths = list(records)
+        self.positions = {path: i for i, path in enumerate(self.paths)}
+        self.mtimes = [records[path]["mtime"] for path in self.paths]
+        self.ahashes = np.array([int(records[path]["ahash"], 16) for path in self.paths], dtype=np.uint64)
+        self.dhashes = np.array([int(records[path]["dhash"], 16) for path in self.paths], dtype=np.uint64)
+        if lines > 2 * len(self.paths) + 1000:
+            self.compact()
+        logger.info(f"哈希索引已加载: {len(self.paths)} 条")
+
+    def compact(self):
+        """重写索引文件，去掉重复和已删除的条目"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for i, path in enumerate(self.paths):
+                f.write(json.dumps({"path": path, "mtime": self.mtimes[i], "ahash": f"{int(self.ahashes[i]):016x}",
+                                    "dhash": f"{int(self.dhashes[i]):016x}"}, ensure_ascii=False) + "\n")
+        os.replace(temp_path, self.path)
+
+    def _append(self, records):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def add(self, path, hashes, mtime=None):
+        """登记一个文件的哈希"""
+        path = os.path.abspath(path)
+        ahash, dhash = hashes
+        if mtime is None:
+            # 溢写模式下文件可能尚未转码落盘，以后补算时会按实际修改时间更新
+            mtime = os.path.getmtime(path) if os.path.exists(path) else time.time()
+        with self.lock:
+            index = self.positions.get(path)
+            if index is None:
+                index = len(self.paths)
+                if index == len(self.ahashes):
+                    # 倍增扩容，逐条补算时总开销保持线性
+                    capacity = max(64, 2 * index)
+                    self.ahashes = np.resize(self.ahashes, capacity)
+                    self.dhashes = np.resize(self.dhashes, capacity)
+                self.positions[path] = index
+                self.paths.append(path)
+                self.mtimes.append(mtime)
+                self.ahashes[index] = ahash
+                self.dhashes[index] = dhash
+            else:
+                self.mtimes[index] = mtime
+                self.ahashes[index] = ahash
+                self.dhashes[index] = dhash
+            self._append([{"path": path, "mtime": mtime, "ahash": f"{ahash:016x}", "dhash": f"{dhash:016x}"}])
+
+    def remove(self, paths):
+        """删除失效条目"""
+        removed = set(paths)
+        with self.lock:
+            keep = [i for i, path in enumerate(self.paths) if path not in removed]
+            self.paths = [self.paths[i] for i in keep]
+            self.mtimes = [self.mtimes[i] for i in keep]
+            self.ahashes = self.ahashes[keep]
+            self.dhashes = self.dhashes[keep]
+            self.positions = {path: i for i, path in enumerate(self.paths)}
+            self._append([{"path": path, "removed": True} for path in paths])
+
+    def query(self, hashes, limit=20, max_distance=24, exclude=None):
+        """返回 [(距离, 路径)]，距离为 aHash 与 dHash 汉明距离之和（0-128），从近到远排序"""
+        ahash, dhash = hashes
+        with self.lock:
+            if not self.paths:
+                return []
+            count = len(self.paths)
+            distance = hamming_distances(self.ahashes[:count], ahash).astype(np.uint16)
+            distance += hamming_distances(self.dhashes[:count], dhash)
+            candidates = np.flatnonzero(distance <= max_distance)
+            # 只对候选项排序
+            candidates = candidates[np.argsort(distance[candidates], kind="stable")]
+            results = [(int(distance[i]), self.paths[i]) for i in candidates]
+        results = [(d, path) for d, path in results if path != exclude]
+        missing = {path for _, path in results[:limit * 2] if not os.path.exists(path)}
+        if missing:
+            self.remove(missing)
+            results = [(d, path) for d, path in results if path not in missing]
+        return results[:limit]
+
+    def submit_image(self, path, image):
+        """后台计算已保存截图的哈希；文件已落盘时读文件计算，溢写待转码时暂用内存中的图像"""
+        self.queue.put((path, image))
+
+    def backfill(self, directory):
+        """后台为目录中尚未登记或已修改的图片补算哈希"""
+        self.queue.put((directory, None))
+
+    def _backfill(self, directory):
+        if not os.path.isdir(directory):
+            return
+        with self.lock:
+            known = dict(zip(self.paths, self.mtimes))
+        added = 0
+        for root, _, names in os.walk(directory):
+            for name in names:
+                if not name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                path = os.path.abspath(os.path.join(root, name))
+                try:
+                    mtime = os.path.getmtime(path)
+                    if known.get(path) == mtime:
+                        continue
+                    image = read_hash_image(path)
+                    if image is None:
+                        continue
+                    self.add(path, image_hashes(image), mtime)
+                    added += 1
+                except OSError as e:
+                    logger.debug(f"跳过 {path}: {e}")
+        logger.info(f"哈希索引补算完成: {directory} 新增/更新 {added} 条, 共 {len(self.paths)} 条")
+
+    def _run(self):
+        lower_current_thread_priority()
+        while True:
+            path, image = self.queue.get()
+            if path is None:
+                break
+            try:
+                if image is None:
+                    self._backfill(path)
+                    continue
+                mtime = None
+                if os.path.exists(path) and os.path.getsize(path) > 0:
+                    # 与补算和查询一致，按编码后的文件计算（JPEG、调色板量化后的像素）
+                    mtime = os.path.getmtime(path)
+                    image = read_hash_image(path)
+                if image is not None:
+                    self.add(path, image_hashes(image), mtime)
+            except Exception as e:
+                logger.error(f"计算哈希失败 {path}: {e}")
+
+    def stop(self):
+        self.queue.put((None, None))
+        self.thread.join(timeout=2)
+
+
+class RetentionManager:
+    """保存目录的保留策略：总字节数、文件数和最长保留时间上限，超出时从最旧的文件开始删除或归档
+
+    只管理本工具写入的文件：写入器回调把保存目录下新写入的文件登记到持久化索引
+    （追加写入的 JSONL，路径 -> 修改时间和字节数），目录中其它文件从不删除。
+    启动时加载索引并在后台核对文件是否仍存在，之后增量更新；按修改时间排序的堆给出最旧的文件，
+    失效项在弹出时跳过。清理在低优先级线程中按批进行，批之间让出磁盘，停止时在批内及时退出。
+    """
+    EXTENSIONS = IMAGE_EXTENSIONS + (".json",)
+    BATCH_SIZE = 200
+    BATCH_PAUSE = 0.05
+    VERIFY_INTERVAL = 3600
+
+    def __init__(self, directory, index_path, max_bytes=0, max_files=0, max_age=0, archive_dir=None):
+        self.directory = os.path.abspath(directory)
+        self.index_path = index_path
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.max_age = max_age
+        self.archive_dir = os.path.abspath(archive_dir) if archive_dir else None
+        self.lock = threading.Lock()
+        self.file_lock = threading.Lock()
+        self.entries = {}
+        self.heap = []
+        self.total_bytes = 0
+        self.removed_files = 0
+        self.removed_bytes = 0
+        self.last_verify = None
+        self.stop_event = threading.Event()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="Retention", daemon=True)
+        self.thread.start()
+
+    @property
+    def enabled(self):
+        return bool(self.max_bytes or self.max_files or self.max_age)
+
+    def record(self, path, size=None):
+        """登记新写入的文件（写入器回调，只入队，不访问磁盘；大小在后台线程中读取）"""
+        self.queue.put(("add", path))
+
+    def enforce_now(self):
+        """立即检查上限（例如保存失败时）"""
+        self.queue.put(("enforce", None))
+
+    def tracks(self, path):
+        path = os.path.abspath(path)
+        if not path.startswith(self.directory + os.sep) or not path.lower().endswith(self.EXTENSIONS):
+            return False
+        return not (self.archive_dir and path.startswith(self.archive_dir + os.sep))
+
+    def load(self):
+        """读取索引文件，只保留保存目录下的条目"""
+        records = {}
+        lines = 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    lines += 1
+                    if record.get("removed"):
+                        records.pop(record["path"], None)
+                    elif self.tracks(record["path"]):
+                        records[record["path"]] = (record["mtime"], record["size"])
+        self._replace_entries(records)
+        if lines > 2 * len(records) + 1000:
+            self.compact()
+
+    def verify(self):
+        """核对索引中的文件：去掉已被外部删除的，更新被修改过的"""
+        with self.lock:
+            paths = list(self.entries)
+        entries = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries[path] = (stat.st_mtime, stat.st_size)
+        with self.lock:
+            # 核对期间新登记的文件保留
+            checked = set(paths)
+            for path, entry in self.entries.items():
+                if path not in checked:
+                    entries[path] = entry
+        self._replace_entries(entries)
+        self.last_verify = time.time()
+        if len(entries) != len(paths):
+            self.compact()
+        logger.info(f"保存目录索引: {len(entries)} 个文件, {self.total_bytes / 1024 / 1024:.1f} MB")
+
+    def _replace_entries(self, entries):
+        with self.lock:
+            self.entries = entries
+            self.heap = [(mtime, path) for path, (mtime, _) in entries.items()]
+            heapq.heapify(self.heap)
+            self.total_bytes = sum(size for _, size in entries.values())
+
+    def compact(self):
+        """重写索引文件，去掉重复和已删除的条目"""
+        with self.lock:
+            entries = dict(self.entries)
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        temp_path = self.index_path + ".tmp"
+        with self.file_lock:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                for path, (mtime, size) in entries.items():
+                    f.write(json.dumps({"path": path, "mtime": mtime, "size": size}, ensure_ascii=False) + "\n")
+            os.replace(temp_path, self.index_path)
+
+    def _append(self, records):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        with self.file_lock:
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _add(self, paths):
+        records = []
+        for path in paths:
+            path = os.path.abspath(path)
+            if not self.tracks(path):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            with self.lock:
+                old = self.entries.get(path)
+                if old is not None:
+                    self.total_bytes -= old[1]
+                self.entries[path] = (stat.st_mtime, stat.st_size)
+                self.total_bytes += stat.st_size
+                heapq.heappush(self.heap, (stat.st_mtime, path))
+            records.append({"path": path, "mtime": stat.st_mtime, "size": stat.st_size})
+        if records:
+            self._append(records)
+
+    def _pop_oldest(self):
+        """取出最旧的有效条目，返回 (路径, 修改时间, 字节数)"""
+        while self.heap:
+            mtime, path = heapq.heappop(self.heap)
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != mtime:
+                continue
+            del self.entries[path]
+            self.total_bytes -= entry[1]
+            return path, mtime, entry[1]
+        return None
+
+    def _over_limit(self, now):
+        # 至少保留最新的一个文件
+        if len(self.entries) <= 1:
+            return False
+        if self.max_files and len(self.entries) > self.max_files:
+            return True
+        if self.max_bytes and self.total_bytes > self.max_bytes:
+            return True
+        if self.max_age:
+            while self.heap and self.entries.get(self.heap[0][1], (None,))[0] != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            return bool(self.heap) and now - self.heap[0][0] > self.max_age
+        return False
+
+    def enforce(self):
+        """按批清理直到满足全部上限或收到停止请求，返回本次处理的文件数"""
+        if not self.enabled:
+            return 0
+        handled = 0
+        while not self.stop_event.is_set():
+            now = time.time()
+            batch = []
+            with self.lock:
+                while len(batch) < self.BATCH_SIZE and self._over_limit(now):
+                    batch.append(self._pop_oldest())
+            if not batch:
+                break
+            removed = []
+            for path, _, size in batch:
+                # 未处理的条目仍在索引文件中，下次启动后会重新纳入
+                if self.stop_event.is_set():
+                    break
+                try:
+                    self._dispose(path)
+                    self.removed_files += 1
+                    self.removed_bytes += size
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.error(f"清理截图失败 {path}: {e}")
+                    continue
+                removed.append({"path": path, "removed": True})
+            self._append(removed)
+            handled += len(removed)
+            # 批之间让出磁盘给保存操作
+            self.stop_event.wait(self.BATCH_PAUSE)
+        if handled:
+            action = "归档" if self.archive_dir else "删除"
+            logger.info(f"保留策略: {action} {handled} 个文件, 剩余 {len(self.entries)} 个, "
+                        f"{self.total_bytes / 1024 / 1024:.1f} MB")
+        return handled
+
+    def _dispose(self, path):
+        if not self.archive_dir:
+            os.remove(path)
+            return
+        target = os.path.join(self.archive_dir, os.path.relpath(path, self.directory))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.replace(path, target)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # 归档目录在其它磁盘上
+            shutil.move(path, target)
+
+    def status(self):
+        """当前占用和上限"""
+        with self.lock:
+            files, total = len(self.entries), self.total_bytes
+            oldest = min((mtime for mtime, _ in self.entries.values()), default=None)
+        return {
+            "files": files,
+            "bytes": total,
+            "oldest": oldest,
+            "max_files": self.max_files,
+            "max_bytes": self.max_bytes,
+            "max_age": self.max_age,
+            "removed_files": self.removed_files,
+            "removed_bytes": self.removed_bytes,
+            "last_verify": self.last_verify,
+        }
+
+    def _run(self):
+        lower_current_thread_priority()
+        try:
+            self.load()
+            self.verify()
+        except OSError as e:
+            logger.error(f"加载保存目录索引失败: {e}")
+        self.enforce()
+        while not self.stop_event.is_set():
+            try:
+                kind, path = self.queue.get(timeout=60)
+            except queue.Empty:
+                kind = "tick"
+            if kind == "stop":
+                break
+            try:
+                if kind == "add":
+                    paths = [path]
+                    # 连续保存时合并处理
+                    while True:
+                        try:
+                            kind, path = self.queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if kind == "stop":
+                            return
+                        if kind == "add":
+                            paths.append(path)
+                    self._add(paths)
+                elif kind == "tick" and time.time() - (self.last_verify or 0) > self.VERIFY_INTERVAL:
+                    self.verify()
+                self.enforce()
+            except Exception as e:
+                logger.error(f"保留策略执行失败: {e}")
+
+    def stop(self):
+        """停止后台线程并等待其退出（正在进行的清理在当前文件处理完后结束）"""
+        self.stop_event.set()
+        self.queue.put(("stop", None))
+        self.thread.join()
+
+
+class FileSink(FrameSink):
+    """文件输出：按输出配置编码后原子写入目录；溢写模式下直接落盘原始像素"""
+
+    def __init__(self, writer, directory, profile="png", spill_transcoder=None, name="文件"):
+        self.writer = writer
+        self.directory = directory
+        self.profile = profile
+        self.spill_transcoder = spill_transcoder
+        self.name = name
+
+    def publish(self, frame):
+        """返回 (实际文件路径, 是否已溢写待转码)"""
+        profile = frame.resolved_profile(self.profile)
+        ext = ENCODE_PROFILES[profile][0]
+        path = os.path.join(self.directory, frame.name + ext)
+        reserved = None
+        if self.spill_transcoder is not None:
+            try:
+                # 先以空文件占用最终文件名，转码完成后原子替换，调用方拿到的就是最终路径
+                reserved = self.writer.reserve(path)
+                self.spill_transcoder.spill(frame.image, reserved, profile)
+                return reserved, True
+            except OSError as e:
+                logger.error(f"溢写失败，改为直接保存: {e}")
+        _, data = frame.encoded(self.profile)
+        if reserved is not None:
+            return self.writer.write(reserved, data, replace=True), False
+        return self.writer.write(path, data), False
+
+
+class ClipboardSink(FrameSink):
+    """剪贴板输出"""
+    name = "剪贴板"
+    gui_thread = True
+
+    def publish(self, frame):
+        image = np.ascontiguousarray(frame.image)
+        height, width = image.shape[:2]
+        qimage = QImage(image.data, width, height, image.strides[0], QImage.Format_BGR888).copy()
+        QApplication.clipboard().setImage(qimage)
+        return f"{width}x{height}"
+
+
+class SocketSink(FrameSink):
+    """本地套接字输出：订阅者连接 127.0.0.1:端口，每帧收到头部（数据长度、宽、高）和编码后的图像
+
+    每个订阅者有自己的发送线程和有界队列，publish 只把帧放入队列；不读取数据的订阅者
+    队列满后丢帧，发送超时后断开，不会阻塞截图。
+    """
+    name = "套接字"
+    HEADER = struct.Struct("<QII")
+    QUEUE_SIZE = 4
+    SEND_TIMEOUT = 10
+
+    def __init__(self, port, profile="png"):
+        self.profile = profile
+        self.clients = []
+        self.senders = []
+        self.lock = threading.Lock()
+        self.server = socket.create_server(("127.0.0.1", port))
+        self.thread = threading.Thread(target=self._accept_loop, name="SocketSink", daemon=True)
+        self.thread.start()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                break
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn.settimeout(self.SEND_TIMEOUT)
+            client = (conn, queue.Queue(self.QUEUE_SIZE))
+            sender = threading.Thread(target=self._send_loop, args=client, name="SocketSinkClient", daemon=True)
+            with self.lock:
+                self.clients.append(client)
+                self.senders = [thread for thread in self.senders if thread.is_alive()] + [sender]
+            sender.start()
+
+    def _send_loop(self, conn, frames):
+        """发送线程：依次发送队列中的帧，收到 None 或发送失败时退出"""
+        while True:
+            item = frames.get()
+            if item is None:
+                break
+            header, data = item
+            try:
+                conn.sendall(header)
+                conn.sendall(data)
+            except OSError as e:
+                # 订阅者已断开或长时间不读取
+                logger.warning(f"套接字订阅者断开: {e}")
+                break
+        with self.lock:
+            if (conn, frames) in self.clients:
+                self.clients.remove((conn, frames))
+        conn.close()
+
+    def publish(self, frame):
+        with self.lock:
+            clients = list(self.clients)
+        if not clients:
+            return "无订阅者"
+        _, data = frame.encoded(self.profile)
+        height, width = frame.image.shape[:2]
+        header = self.HEADER.pack(len(data), width, height)
+        queued = dropped = 0
+        for _, frames in clients:
+            try:
+                frames.put_nowait((header, data))
+                queued += 1
+            except queue.Full:
+                dropped += 1
+        return f"{queued} 个订阅者" + (f", {dropped} 个积压丢帧" if dropped else "")
+
+    def close(self):
+        """关闭监听和所有订阅者，等待各线程退出后端口即可重新绑定"""
+        # 只 close 不会唤醒阻塞在 accept 中的线程，端口也不会释放
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server.close()
+        self.thread.join(timeout=2)
+        with self.lock:
+            clients, self.clients = self.clients, []
+            senders, self.senders = self.senders, []
+        for conn, frames in clients:
+            # 唤醒阻塞在发送中的线程，并丢弃积压的帧
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            while True:
+                try:
+                    frames.get_nowait()
+                except queue.Empty:
+                    break
+            frames.put(None)
+        for sender in senders:
+            sender.join(timeout=2)
+
+
+class FrameDispatcher:
+    """把一次截图并发分发到所有启用的输出，分别记录各输出的耗时和失败"""
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(sinks)), thread_name_prefix="FrameSink")
+
+    @staticmethod
+    def _publish(sink, frame):
+        """返回 (输出, 是否成功, 结果或异常, 耗时秒数)"""
+        start = time.perf_counter()
+        try:
+            return sink, True, sink.publish(frame), time.perf_counter() - start
+        except Exception as e:
+            return sink, False, e, time.perf_counter() - start
+
+    @staticmethod
+    def _log(result):
+        sink, ok, value, elapsed = result
+        if ok:
+            logger.debug(f"输出[{sink.name}] {elapsed * 1000:.1f} ms: {value}")
+        else:
+            logger.error(f"输出[{sink.name}] 失败 ({elapsed * 1000:.1f} ms): {value}")
+
+    def _report(self, future, on_result):
+        if future.cancelled():
+            return
+        result = future.result()
+        self._log(result)
+        if on_result:
+            on_result(result)
+
+    def dispatch(self, frame, on_result=None):
+        """并发输出一帧
+
+        只等待主输出（第一个输出）和界面线程输出完成，按输出列表顺序返回它们的结果；
+        其余输出在后台完成，结果记录日志后在工作线程中调用 on_result(结果)，慢输出不会阻塞保存。
+        """
+        primary = self.sinks[0]
+        futures = {}
+        for sink in self.sinks:
+            if sink.gui_thread:
+                continue
+            future = self.executor.submit(self._publish, sink, frame)
+            futures[sink] = future
+            if sink is not primary:
+                future.add_done_callback(lambda f: self._report(f, on_result))
+        gui_results = {sink: self._publish(sink, frame) for sink in self.sinks if sink.gui_thread}
+        results = [gui_results[sink] if sink.gui_thread else futures[sink].result()
+                   for sink in self.sinks if sink is primary or sink.gui_thread]
+        for result in results:
+            self._log(result)
+        return results
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        for sink in self.sinks:
+            sink.close()
+
+
+class SelectionModel:
+    """选择框几何模型：矩形、控制点/边手柄、最小尺寸和边界约束，不依赖绘制
+
+    手柄只在矩形变化时重算（以矩形坐标元组为缓存键，原地修改矩形同样能识别），
+    命中检测直接按坐标区间计算，不遍历手柄列表。
+    """
+
+    CURSORS = {
+        'topleft': Qt.SizeFDiagCursor,
+        'bottomright': Qt.SizeFDiagCursor,
+        'topright': Qt.SizeBDiagCursor,
+        'bottomleft': Qt.SizeBDiagCursor,
+        'top': Qt.SizeVerCursor,
+        'bottom': Qt.SizeVerCursor,
+        'left': Qt.SizeHorCursor,
+        'right': Qt.SizeHorCursor,
+    }
+
+    def __init__(self, point_size=10, handle_size=6, handle_length=20, min_size=20):
+        self.rect = QRect()
+        self.point_size = point_size
+        self.handle_size = handle_size
+        self.handle_length = handle_length
+        self.min_size = min_size
+        self._handles_key = None
+        self._handles = []
+        self._zones = None
+
+    def _key(self):
+        return (self.rect.x(), self.rect.y(), self.rect.width(), self.rect.height())
+
+    def handles(self):
+        """返回 [(QRect, 类型)]：四个角控制点和四条边的手柄"""
+        key = self._key()
+        if key == self._handles_key:
+            return self._handles
+        rect = self.rect
+        size = self.point_size
+        handles = [(QRect(pos.x() - size // 2, pos.y() - size // 2, size, size), point_type)
+                   for point_type, pos in (('topleft', rect.topLeft()), ('topright', rect.topRight()),
+                                           ('bottomleft', rect.bottomLeft()), ('bottomright', rect.bottomRight()))]
+        center_x = rect.left() + rect.width() // 2
+        center_y = rect.top() + rect.height() // 2
+        short, long = self.handle_size, self.handle_length
+        handles.append((QRect(center_x - long // 2, rect.top() - short // 2, long, short), 'top'))
+        handles.append((QRect(center_x - long // 2, rect.bottom() - short // 2, long, short), 'bottom'))
+        handles.append((QRect(rect.left() - short // 2, center_y - long // 2, short, long), 'left'))
+        handles.append((QRect(rect.right() - short // 2, center_y - long // 2, short, long), 'right'))
+        # 命中检测用的整数边界：left/right/top/bottom 和中心，外扩后的整体范围用于快速排除
+        left, top, width, height = key
+        right, bottom = left + width - 1, top + height - 1
+        reach = max(size, short, long)
+        self._zones = (left, right, top, bottom, left + width // 2, top + height // 2,
+                       left - reach, right + reach, top - reach, bottom + reach)
+        self._handles = handles
+        self._handles_key = key
+        return handles
+
+    def handle_at(self, pos):
+        """返回 pos 处的手柄类型，优先级与 handles() 的顺序一致"""
+        if not self.rect.isValid():
+            return None
+        self.handles()
+        left, right, top, bottom, center_x, center_y, min_x, max_x, min_y, max_y = self._zones
+        x, y = pos.x(), pos.y()
+        if x < min_x or x > max_x or y < min_y or y > max_y:
+            return None
+        size = self.point_size
+        half = size // 2
+        column = 'left' if 0 <= x - left + half < size else 'right' if 0 <= x - right + half < size else None
+        row = 'top' if 0 <= y - top + half < size else 'bottom' if 0 <= y - bottom + half < size else None
+        if column and row:
+            return row + column
+        short, long = self.handle_size, self.handle_length
+        if 0 <= x - center_x + long // 2 < long:
+            if 0 <= y - top + short // 2 < short:
+                return 'top'
+            if 0 <= y - bottom + short // 2 < short:
+                return 'bottom'
+        if 0 <= y - center_y + long // 2 < long:
+            if 0 <= x - left + short // 2 < short:
+                return 'left'
+            if 0 <= x - right + short // 2 < short:
+                return 'right'
+        return None
+
+    def cursor_at(self, pos, lock_size=False):
+        """pos 处应显示的光标形状"""
+        if not lock_size:
+            handle = self.handle_at(pos)
+            if handle:
+                return self.CURSORS[handle]
+        if self.rect.contains(pos):
+            return Qt.SizeAllCursor
+        return Qt.ArrowCursor
+
+    @staticmethod
+    def from_points(start, end):
+        """两点确定的规范化矩形"""
+        return QRect(min(start.x(), end.x()), min(start.y(), end.y()),
+                     abs(start.x() - end.x()), abs(start.y() - end.y()))
+
+    def resized_from_handle(self, handle, pos, bounds):
+        """拖动手柄到 pos 后的矩形，保证最小尺寸并裁剪到 bounds 内"""
+        rect = self.rect.normalized()
+        if handle == 'topleft':
+            rect.setTopLeft(pos)
+        elif handle == 'topright':
+            rect.setTopRight(pos)
+        elif handle == 'bottomleft':
+            rect.setBottomLeft(pos)
+        elif handle == 'bottomright':
+            rect.setBottomRight(pos)
+        elif handle == 'top':
+            rect.setTop(pos.y())
+        elif handle == 'bottom':
+            rect.setBottom(pos.y())
+        elif handle == 'left':
+            rect.setLeft(pos.x())
+        elif handle == 'right':
+            rect.setRight(pos.x())
+
+        if rect.width() < self.min_size:
+            if handle in ('left', 'topleft', 'bottomleft'):
+                rect.setLeft(rect.right() - self.min_size)
+            else:
+                rect.setRight(rect.left() + self.min_size)
+        if rect.height() < self.min_size:
+            if handle in ('top', 'topleft', 'topright'):
+                rect.setTop(rect.bottom() - self.min_size)
+            else:
+                rect.setBottom(rect.top() + self.min_size)
+        return rect.intersected(bounds)
+
+    def moved_to(self, top_left, bounds):
+        """平移到 top_left 后的矩形，整体保持在 bounds 内"""
+        x = max(bounds.left(), min(top_left.x(), bounds.left() + bounds.width() - self.rect.width()))
+        y = max(bounds.top(), min(top_left.y(), bounds.top() + bounds.height() - self.rect.height()))
+        return QRect(x, y, self.rect.width(), self.rect.height())
+
+    def resized_around_center(self, size, bounds):
+        """保持中心点不变改为 size 大小，超出 bounds 时平移回来"""
+        rect = QRect(0, 0, size.width(), size.height())
+        rect.moveCenter(self.rect.center())
+        if rect.left() < bounds.left():
+            rect.moveLeft(bounds.left())
+        if rect.top() < bounds.top():
+            rect.moveTop(bounds.top())
+        if rect.right() > bounds.right():
+            rect.moveRight(bounds.right())
+        if rect.bottom() > bounds.bottom():
+            rect.moveBottom(bounds.bottom())
+        return rect
+
+    @staticmethod
+    def centered(size, bounds):
+        """在 bounds 中居中放置 size 大小的矩形（锁定尺寸模式）"""
+        rect = QRect(bounds.left() + bounds.width() // 2 - size.width() // 2,
+                     bounds.top() + bounds.height() // 2 - size.height() // 2,
+                     size.width(), size.height())
+        return rect.intersected(bounds)
+
+
+def diagnostics_dir():
+    """诊断输出目录（操作轨迹、回放报告等），不存在时创建"""
+    path = os.path.join(QStandardPaths.writableLocation(QStandardPaths.GenericDataLocation),
+                        "ScreenshotTool", "diagnostics")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class InputTraceRecorder(QObject):
+    """通过事件过滤器把窗口收到的鼠标/键盘事件录制为 JSONL 轨迹
+
+    过滤器只记录不拦截，不改变原有事件处理；尺寸对话框等模态流程的结果单独记录，
+    回放时按顺序注入。
+    """
+
+    EVENT_TYPES = {
+        QEvent.MouseButtonPress: "press",
+        QEvent.MouseButtonRelease: "release",
+        QEvent.MouseMove: "move",
+        QEvent.KeyPress: "key_press",
+        QEvent.KeyRelease: "key_release",
+    }
+
+    def __init__(self, target, path):
+        super().__init__(target)
+        self.target = target
+        self.path = path
+        self.file = open(path, "w", encoding="utf-8")
+        self.start = time.perf_counter()
+        self.count = 0
+        self._write({"type": "header", "width": target.width(), "height": target.height(),
+                     "backend": target.capture_backend.name, "created": time.time()})
+        target.installEventFilter(self)
+        logger.info(f"开始录制操作轨迹: {path}")
+
+    def _write(self, record):
+        record["t"] = round(time.perf_counter() - self.start, 6)
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def eventFilter(self, obj, event):
+        kind = self.EVENT_TYPES.get(event.type())
+        if obj is self.target and kind:
+            if kind in ("key_press", "key_release"):
+                self._write({"type": kind, "key": event.key(), "text": event.text(),
+                             "modifiers": int(event.modifiers()), "auto_repeat": event.isAutoRepeat()})
+            else:
+                self._write({"type": kind, "x": event.x(), "y": event.y(), "button": int(event.button()),
+                             "buttons": int(event.buttons()), "modifiers": int(event.modifiers())})
+            self.count += 1
+        return False
+
+    def record_dialog(self, name, result):
+        """记录模态对话框的结果，取消时 result 为 None"""
+        self._write({"type": "dialog", "name": name, "result": result})
+
+    def stop(self):
+        self.target.removeEventFilter(self)
+        self.file.close()
+        logger.info(f"操作轨迹录制结束: {self.count} 个事件 -> {self.path}")
+        return self.path
+
+
+def _percentile(values, percent):
+    """最近秩百分位数，values 已排序"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, math.ceil(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+class InputTraceReplayer:
+    """在 ScreenshotTool 上无界面回放操作轨迹，统计每个事件的处理耗时和绘制耗时
+
+    事件用 sendEvent 同步投递，处理耗时即 sendEvent 的耗时；随后处理挂起的刷新请求，
+    期间 paintEvent 的耗时计为该事件的绘制耗时。
+    """
+
+    def __init__(self, tool, path):
+        self.tool = tool
+        self.path = path
+        with open(path, encoding="utf-8") as f:
+            self.records = [json.loads(line) for line in f if line.strip()]
+        self.header = next((r for r in self.records if r["type"] == "header"), {})
+        self.paint_time = 0.0
+        self.paint_count = 0
+
+    def _build_event(self, record):
+        kind = record["type"]
+        modifiers = Qt.KeyboardModifiers(record.get("modifiers", 0))
+        if kind in ("key_press", "key_release"):
+            event_type = QEvent.KeyPress if kind == "key_press" else QEvent.KeyRelease
+            return QKeyEvent(event_type, record["key"], modifiers, record.get("text", ""),
+                             record.get("auto_repeat", False))
+        event_type = {"press": QEvent.MouseButtonPress, "release": QEvent.MouseButtonRelease,
+                      "move": QEvent.MouseMove}[kind]
+        pos = QPoint(record["x"], record["y"])
+        return QMouseEvent(event_type, QPointF(pos), QPointF(self.tool.mapToGlobal(pos)),
+                           Qt.MouseButton(record["button"]), Qt.MouseButtons(record["buttons"]), modifiers)
+
+    def _timed_paint(self, paint_event):
+        def paint(event):
+            start = time.perf_counter()
+            paint_event(event)
+            self.paint_time += time.perf_counter() - start
+            self.paint_count += 1
+        return paint
+
+    def prepare(self):
+        """按轨迹头部恢复窗口尺寸；没有可用屏幕内容时改用同尺寸的合成画面"""
+        width = self.header.get("width") or self.tool.width()
+        height = self.header.get("height") or self.tool.height()
+        if self.tool.screenshot.isNull() or self.tool.screenshot.size() != QSize(width, height):
+            self.tool.capture_backend.close()
+            self.tool.capture_backend = SyntheticCaptureBackend(width, height)
+            self.tool.capture_screen()
+        self.tool.setGeometry(0, 0, width, height)
+        self.tool.show()
+        QApplication.processEvents()
+
+    def run(self):
+        """回放全部事件，返回统计报告"""
+        self.prepare()
+        tool = self.tool
+        tool.scripted_dialog_results.extend(r["result"] for r in self.records if r["type"] == "dialog")
+        tool.paintEvent = self._timed_paint(tool.paintEvent)
+        samples = []
+        try:
+            for index, record in enumerate(self.records):
+                if record["type"] not in InputTraceRecorder.EVENT_TYPES.values():
+                    continue
+                event = self._build_event(record)
+                start = time.perf_counter()
+                QApplication.sendEvent(tool, event)
+                handler = time.perf_counter() - start
+                self.paint_time = 0.0
+                self.paint_count = 0
+                QApplication.processEvents()
+                samples.append({"index": index, "type": record["type"], "handler_ms": handler * 1000,
+                                "paint_ms": self.paint_time * 1000, "paints": self.paint_count})
+        finally:
+            del tool.paintEvent
+        return self.report(samples)
+
+    def report(self, samples):
+        """按事件类型汇总 p50/p95/最大值，并列出最慢的事件"""
+        summary = {}
+        for kind in sorted({s["type"] for s in samples}):
+            group = [s for s in samples if s["type"] == kind]
+            entry = {"count": len(group)}
+            for field in ("handler_ms", "paint_ms"):
+                values = sorted(s[field] for s in group)
+                entry[field] = {"p50": round(_percentile(values, 50), 3), "p95": round(_percentile(values, 95), 3),
+                                "max": round(values[-1], 3), "mean": round(sum(values) / len(values), 3)}
+            summary[kind] = entry
+        totals = sorted(s["handler_ms"] + s["paint_ms"] for s in samples)
+        slowest = sorted(samples, key=lambda s: s["handler_ms"] + s["paint_ms"], reverse=True)[:10]
+        return {"trace": self.path, "events": len(samples), "by_type": summary,
+                "total_ms": {"p50": round(_percentile(totals, 50), 3), "p95": round(_percentile(totals, 95), 3),
+                             "max": round(totals[-1], 3) if totals else 0.0},
+                "slowest": slowest}
+
+
+class ProfileSession:
+    """按需性能分析：界面线程用 cProfile 做确定性分析，另起线程定时采样所有线程的调用栈
+
+    输出 pstats 文件和折叠栈文件（每行 "线程;外层函数;...;内层函数 次数"，可直接用 flamegraph.pl 或 speedscope 打开）。
+    只在 start 和 stop 之间安装钩子，未分析时没有任何额外开销。
+    """
+
+    def __init__(self, directory, interval=0.005, deterministic=True):
+        self.directory = directory
+        self.interval = interval
+        self.deterministic = deterministic
+        self.profiler = None
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.labels = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.started = None
+
+    def start(self):
+        """在界面线程中调用"""
+        self.started = time.perf_counter()
+        if self.deterministic:
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError as e:
+                # 已有其它分析工具在运行时只做采样
+                logger.warning(f"无法启用 cProfile，仅采样调用栈: {e}")
+                self.profiler = None
+        self.thread = threading.Thread(target=self._sample, name="ProfileSampler", daemon=True)
+        self.thread.start()
+
+    def _label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self.labels[code] = label
+        return label
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"Thread-{ident}"))
+                stack.reverse()
+                self.stacks[";".join(stack)] += 1
+            self.samples += 1
+
+    def stop(self):
+        """停止分析并写出文件，返回 (pstats 路径, 折叠栈路径, 摘要)"""
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.stop_event.set()
+        self.thread.join()
+        elapsed = time.perf_counter() - self.started
+        stem = os.path.join(self.directory, time.strftime("profile_%Y%m%d_%H%M%S"))
+        stats_path = None
+        summary = f"{elapsed:.1f} 秒, {self.samples} 次采样"
+        if self.profiler is not None:
+            stats_path = stem + ".pstats"
+            self.profiler.dump_stats(stats_path)
+            buffer = io.StringIO()
+            pstats.Stats(self.profiler, stream=buffer).sort_stats("cumulative").print_stats(15)
+            logger.info(f"性能分析（界面线程，按累计耗时）:\n{buffer.getvalue()}")
+        collapsed_path = stem + ".collapsed"
+        with open(collapsed_path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info(f"性能分析完成: {summary} -> {collapsed_path}")
+        return stats_path, collapsed_path, summary
+
+
+class ScreenshotTool(QMainWindow):
+    # 后台线程通过信号更新状态栏
+    status_message = pyqtSignal(str)
+
+    def __init__(self, settings=None, background_services=True):
+        """settings 默认为用户设置；background_services 为 False 时（轨迹回放）不恢复溢写文件、不启用哈希索引、保留策略和定时任务"""
         super().__init__()
+        self.background_services = background_services
         # 状态变量
         self.dragging = False
         self.dragging_rect = False
@@ -396,22 +4036,34 @@ class ScreenshotTool(QMainWindow):
         self.drag_offset = QPoint()
         self.start_point = QPoint()
         self.end_point = QPoint()
-        self.rect = QRect()
+        self.selection = SelectionModel(point_size=10, handle_size=6, handle_length=20)
         self.size_text_rect = QRect()
         self.original_rect = QRect()
+        self.cursor_shape = None
 
         # 控制点状态
         self.dragging_control_point = False
         self.active_control_point = None
-        self.control_points = []
 
-        # 控制点尺寸
-        self.control_point_size = 10
-        self.edge_handle_size = 6
-        self.edge_handle_length = 20
+        # 后台任务
+        self.background = BackgroundRunner(parent=self)
+
+        # 边缘吸附索引
+        self.snap_index = None
+        self.snap_generation = 0
+        self.hover_candidate = None
+
+        # 文字区域检测（打码建议）
+        self.text_proposals = []
+        self.detection_generation = 0
+
+        # 标注状态
+        self.annotation_mode = None
+        self.annotations = AnnotationLayer()
+        self.current_annotation = None
 
         # 设置
-        self.settings = QSettings("ScreenshotTool", "ScreenshotTool")
+        self.settings = settings if settings is not None else QSettings("ScreenshotTool", "ScreenshotTool")
         self.save_path = self.settings.value("save_path", os.path.expanduser("~/Pictures"))
         self.filename_format = self.settings.value("filename_format", "截图_%Y%m%d_%H%M%S")
         
@@ -421,6 +4073,22 @@ class ScreenshotTool(QMainWindow):
             int(self.settings.value("locked_height", 600))
         )
         self.lock_size_enabled = self.settings.value("lock_size_enabled", False, type=bool)
+
+        # 命名区域预设：同一帧中一次裁出多个区域
+        try:
+            self.region_presets = parse_region_presets(self.settings.value("region_presets", "[]"))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.error(f"区域预设配置无效: {e}")
+            self.region_presets = []
+        self.region_pool = None
+
+        # 定时截图任务（托盘常驻时按计划执行）
+        self.scheduler = CaptureScheduler(self.start_capture_job, self)
+        if background_services:
+            try:
+                self.scheduler.set_jobs(parse_capture_jobs(self.settings.value("capture_jobs", "[]")))
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                logger.error(f"定时任务配置无效: {e}")
         
         # 默认热键设置
         self.default_hotkeys = {
@@ -443,11 +4111,82 @@ class ScreenshotTool(QMainWindow):
         # 系统托盘
         self.tray_icon = None
 
+        # 抓屏后端（qt / xshm / synthetic / file:<路径>）
+        self.capture_backend = create_capture_backend(self.settings.value("capture_backend", "qt"))
+
+        # 原始帧推流
+        self.streamer = None
+
+        # 操作轨迹录制；回放时模态对话框的结果从队列中取出
+        self.trace_recorder = None
+        self.scripted_dialog_results = collections.deque()
+
+        # 按需性能分析（托盘菜单启动，结果写入诊断目录）
+        self.profile_session = None
+        self.profile_timer = None
+        self.profile_action = None
+
+        # 窗口/控件边缘吸附
+        self.snap_enabled = self.settings.value("snap_enabled", True, type=bool)
+        self.snap_distance = int(self.settings.value("snap_distance", 8))
+
+        # 像素放大镜
+        self.loupe_enabled = self.settings.value("loupe_enabled", True, type=bool)
+
+        # 后台文字区域检测（可选）
+        self.text_detection_enabled = self.settings.value("text_detection_enabled", False, type=bool)
+
+        # 文件写入（临时文件 + 改名，文件名冲突时追加序号）
+        try:
+            self.file_writer = AtomicFileWriter(self.settings.value("fsync_policy", "none"))
+        except ValueError as e:
+            logger.error(f"{e}，改用 none")
+            self.file_writer = AtomicFileWriter("none")
+
+        # 输出配置和后处理流水线
+        self.output_profile = self.settings.value("output_profile", "png")
+        if not is_valid_profile(self.output_profile):
+            logger.error(f"未知的输出配置: {self.output_profile}")
+            self.output_profile = "png"
+        self.pipeline = CapturePipeline.from_settings(self.settings, self.file_writer)
+
+        # 溢写模式：先落盘原始像素，后台转码
+        self.spill_enabled = self.settings.value("spill_enabled", False, type=bool)
+        spill_dir = os.path.join(QStandardPaths.writableLocation(QStandardPaths.GenericDataLocation),
+                                 "ScreenshotTool", "spill")
+        self.spill_transcoder = SpillTranscoder(spill_dir, self.file_writer, fsync=self.settings.value("spill_fsync", True, type=bool))
+        if background_services:
+            self.spill_transcoder.resume()
+
+        # 感知哈希索引：保存时计算新截图的哈希，启动后在后台补算保存目录中的历史文件
+        self.hash_index = None
+        # 默认关闭：开启后会在后台遍历保存目录中的全部图片补算哈希
+        if background_services and self.settings.value("hash_index_enabled", False, type=bool):
+            self.hash_index = HashIndex(os.path.join(QStandardPaths.writableLocation(QStandardPaths.GenericDataLocation),
+                                                     "ScreenshotTool", "hash_index.jsonl"))
+            QTimer.singleShot(5000, lambda: self.hash_index and self.hash_index.backfill(self.save_path))
+
+        # 保存目录的保留策略（总大小、文件数、保留天数上限）
+        self.retention = None
+        self.build_retention()
+
+        # 截图输出（文件、剪贴板、共享内存、套接字、镜像目录）
+        self.dispatcher = None
+        self.build_sinks()
+
         # 快捷键对象
         self.shortcuts = {}
 
+        # 空闲模式：隐藏到托盘时释放整屏缓冲和遮罩控件
+        self.idle = False
+        self.idle_baseline_rss = None
+        self.idle_memory_bound = int(self.settings.value("idle_memory_bound_mb", 32)) * 1024 * 1024
+        self.status_text = "就绪"
+        self.status_label = None
+
         # 创建UI
         self.initUI()
+        self.status_message.connect(self.set_status)
         self.capture_screen()
         
         # 如果启用了锁定大小，设置初始矩形
@@ -486,17 +4225,12 @@ class ScreenshotTool(QMainWindow):
         self.setGeometry(0, 0, QApplication.primaryScreen().size().width(),
                          QApplication.primaryScreen().size().height())
 
-        # 创建标签用于显示屏幕截图
-        self.label = QLabel(self)
-        self.label.setGeometry(0, 0, self.width(), self.height())
-        self.label.setAlignment(Qt.AlignCenter)
-
         # 设置鼠标跟踪
         self.setMouseTracking(True)
-        self.label.setMouseTracking(True)
+        self.screenshot_image = None
 
-        # 创建工具栏
-        self.create_toolbar()
+        # 截图标签、放大镜和工具栏
+        self.build_overlay_widgets()
 
         # 创建隐藏时的迷你控制面板
         self.create_mini_control()
@@ -504,6 +4238,37 @@ class ScreenshotTool(QMainWindow):
         # 创建系统托盘
         self.create_system_tray()
 
+    def build_overlay_widgets(self):
+        """创建遮罩用到的截图标签、像素放大镜和工具栏（空闲时销毁，显示时重建）"""
+        # 创建标签用于显示屏幕截图
+        self.label = QLabel(self)
+        self.label.setGeometry(0, 0, self.width(), self.height())
+        self.label.setAlignment(Qt.AlignCenter)
+        self.label.setMouseTracking(True)
+        self.label.show()
+
+        # 像素放大镜
+        self.loupe = PixelLoupe(self)
+
+        # 创建工具栏
+        self.create_toolbar()
+
+    def release_overlay_widgets(self):
+        """销毁遮罩控件，截图标签持有的整屏合成图随之释放"""
+        for widget in (self.toolbar, self.loupe, self.label):
+            widget.hide()
+            widget.deleteLater()
+        self.toolbar = None
+        self.loupe = None
+        self.label = None
+        self.status_label = None
+
+    def set_status(self, text):
+        """更新状态文字；工具栏已销毁时只记录，重建后显示"""
+        self.status_text = text
+        if self.status_label is not None:
+            self.status_label.setText(text)
+
     def create_mini_control(self):
         """创建隐藏时显示的迷你控制面板"""
         self.mini_control = QFrame(self)
@@ -602,7 +4367,63 @@ class ScreenshotTool(QMainWindow):
             tray_menu.addAction(hide_action)
             
             tray_menu.addSeparator()
-            
+
+            self.stream_action = QAction("开始推流", self)
+            self.stream_action.triggered.connect(self.toggle_streaming)
+            tray_menu.addAction(self.stream_action)
+
+            batch_action = QAction("批量裁剪目录...", self)
+            batch_action.triggered.connect(self.batch_extract)
+            tray_menu.addAction(batch_action)
+
+            pipeline_action = QAction("编辑处理流水线...", self)
+            pipeline_action.triggered.connect(self.edit_pipeline)
+            tray_menu.addAction(pipeline_action)
+
+            similar_action = QAction("查找相似截图...", self)
+            similar_action.triggered.connect(self.find_similar)
+            tray_menu.addAction(similar_action)
+
+            presets_action = QAction("按区域预设截图", self)
+            presets_action.triggered.connect(self.capture_region_presets)
+            tray_menu.addAction(presets_action)
+
+            save_preset_action = QAction("将当前选区存为预设...", self)
+            save_preset_action.triggered.connect(self.save_selection_as_preset)
+            tray_menu.addAction(save_preset_action)
+
+            edit_presets_action = QAction("编辑区域预设...", self)
+            edit_presets_action.triggered.connect(self.edit_region_presets)
+            tray_menu.addAction(edit_presets_action)
+
+            jobs_stats_action = QAction("定时任务统计", self)
+            jobs_stats_action.triggered.connect(self.show_capture_job_stats)
+            tray_menu.addAction(jobs_stats_action)
+
+            edit_jobs_action = QAction("编辑定时任务...", self)
+            edit_jobs_action.triggered.connect(self.edit_capture_jobs)
+            tray_menu.addAction(edit_jobs_action)
+
+            storage_action = QAction("存储占用", self)
+            storage_action.triggered.connect(self.show_storage_status)
+            tray_menu.addAction(storage_action)
+
+            diff_action = QAction("对比两张截图...", self)
+            diff_action.triggered.connect(self.choose_captures_to_compare)
+            tray_menu.addAction(diff_action)
+
+            memory_action = QAction("内存占用报告", self)
+            memory_action.triggered.connect(self.show_memory_report)
+            tray_menu.addAction(memory_action)
+
+            self.trace_action = QAction("录制操作轨迹", self)
+            self.trace_action.triggered.connect(self.toggle_trace_recording)
+            tray_menu.addAction(self.trace_action)
+
+            self.profile_action = QAction("性能分析...", self)
+            self.profile_action.triggered.connect(self.toggle_profiling)
+            tray_menu.addAction(self.profile_action)
+
             settings_action = QAction("设置", self)
             settings_action.triggered.connect(self.open_settings)
             tray_menu.addAction(settings_action)
@@ -642,17 +4463,423 @@ class ScreenshotTool(QMainWindow):
         if not self.hidden:
             self.hide_screenshot_tool()
 
+    def toggle_trace_recording(self):
+        """开始/停止录制操作轨迹，文件保存到诊断目录"""
+        if self.trace_recorder:
+            path = self.trace_recorder.stop()
+            self.trace_recorder = None
+            self.trace_action.setText("录制操作轨迹")
+            self.tray_icon.showMessage("操作轨迹已保存", path, QSystemTrayIcon.Information, 3000)
+            return
+        path = os.path.join(diagnostics_dir(), time.strftime("trace_%Y%m%d_%H%M%S.jsonl"))
+        self.trace_recorder = InputTraceRecorder(self, path)
+        self.trace_action.setText("停止录制操作轨迹")
+
+    def toggle_profiling(self):
+        """分析进程若干秒（界面事件处理和保存流程），结果写入诊断目录；分析中再次点击提前结束"""
+        if self.profile_session:
+            self.finish_profiling()
+            return
+        seconds, ok = QInputDialog.getInt(self, "性能分析", "分析时长（秒）:",
+                                          int(self.settings.value("profile_seconds", 10)), 1, 600)
+        if not ok:
+            return
+        self.settings.setValue("profile_seconds", seconds)
+        interval = float(self.settings.value("profile_sample_interval_ms", 5)) / 1000
+        self.profile_session = ProfileSession(diagnostics_dir(), interval,
+                                              self.settings.value("profile_deterministic", True, type=bool))
+        self.profile_session.start()
+        self.profile_timer = QTimer(self)
+        self.profile_timer.setSingleShot(True)
+        self.profile_timer.timeout.connect(self.finish_profiling)
+        self.profile_timer.start(seconds * 1000)
+        if self.profile_action:
+            self.profile_action.setText("停止性能分析")
+        self.set_status(f"性能分析中（{seconds} 秒）")
+
+    def finish_profiling(self):
+        """结束性能分析并提示输出文件"""
+        if not self.profile_session:
+            return
+        self.profile_timer.stop()
+        stats_path, collapsed_path, summary = self.profile_session.stop()
+        self.profile_session = None
+        if self.profile_action:
+            self.profile_action.setText("性能分析...")
+        self.set_status("性能分析完成")
+        if self.tray_icon:
+            files = "\n".join(path for path in (stats_path, collapsed_path) if path)
+            self.tray_icon.showMessage("性能分析完成", f"{summary}\n{files}", QSystemTrayIcon.Information, 5000)
+
+    def toggle_streaming(self):
+        """开始/停止选定区域的原始帧推流"""
+        if self.streamer and self.streamer.is_running():
+            stats = self.streamer.stop()
+            self.streamer = None
+            self.stream_action.setText("开始推流")
+            self.tray_icon.showMessage("推流已停止",
+                                       f"共 {stats['frames']} 帧, 丢帧 {stats['dropped']}, 实际帧率 {stats['fps']} fps",
+                                       QSystemTrayIcon.Information, 3000)
+            return
+
+        if not self.rect.isValid() or self.rect.width() < 10 or self.rect.height() < 10:
+            self.set_status("区域无效，请重新选择")
+            QTimer.singleShot(2000, lambda: self.set_status("就绪"))
+            return
+
+        self.streamer = RawFrameStreamer(
+            self.grab_screen,
+            self.rect,
+            target=self.settings.value("stream_target", "-"),
+            fps=int(self.settings.value("stream_fps", 30)),
+            pixel_format=self.settings.value("stream_pixel_format", "bgra"),
+            parent=self
+        )
+        # 先隐藏遮罩窗口，避免抓到工具自身
+        self.hide_screenshot_tool()
+        QTimer.singleShot(200, self.start_streaming)
+
+    def start_streaming(self):
+        """窗口隐藏后开始推流"""
+        try:
+            self.streamer.start()
+            self.stream_action.setText("停止推流")
+        except (OSError, RuntimeError) as e:
+            logger.error(f"推流启动失败: {e}")
+            self.streamer = None
+            self.tray_icon.showMessage("推流失败", str(e), QSystemTrayIcon.Warning, 3000)
+
+    def batch_extract(self):
+        """从目录中的全屏截图批量裁剪当前选择区域（未选择时使用锁定尺寸）"""
+        if self.rect.isValid():
+            rect = QRect(self.rect)
+        else:
+            screen_size = QApplication.primaryScreen().size()
+            rect = QRect(0, 0, self.locked_size.width(), self.locked_size.height())
+            rect.moveCenter(QPoint(screen_size.width() // 2, screen_size.height() // 2))
+
+        src_dir = QFileDialog.getExistingDirectory(self, "选择图片目录", self.save_path)
+        if not src_dir:
+            return
+        out_dir = os.path.join(src_dir, "crops")
+        regions = [(f"{rect.width()}x{rect.height()}", rect.x(), rect.y(), rect.width(), rect.height())]
+        profile = self.output_profile
+
+        def report(done, failed, path):
+            self.status_message.emit(f"批量裁剪: 已完成 {done}, 失败 {failed}")
+
+        def finished(result):
+            succeeded, failed = result
+            self.set_status(f"批量裁剪完成: {succeeded} 张, 失败 {len(failed)} 张")
+            if self.tray_icon:
+                self.tray_icon.showMessage("批量裁剪完成", f"成功 {succeeded} 张, 失败 {len(failed)} 张\n输出目录: {out_dir}",
+                                           QSystemTrayIcon.Information, 3000)
+
+        self.set_status("批量裁剪: 开始")
+        self.background.submit(batch_extract_regions, src_dir, regions, out_dir, profile, None, report,
+                               callback=finished)
+
+    def find_similar(self):
+        """选择一张图片，在截图归档中查找外观相似的截图"""
+        if self.hash_index is None:
+            QMessageBox.information(self, "查找相似截图", "哈希索引未启用（设置项 hash_index_enabled）")
+            return
+        path, _ = QFileDialog.getOpenFileName(self, "选择图片", self.save_path,
+                                              "图片 (" + " ".join("*" + ext for ext in IMAGE_EXTENSIONS) + ")")
+        if not path:
+            return
+        image = read_hash_image(path)
+        if image is None:
+            QMessageBox.warning(self, "查找相似截图", f"无法读取图片: {path}")
+            return
+        start = time.perf_counter()
+        results = self.hash_index.query(image_hashes(image), exclude=os.path.abspath(path))
+        elapsed = time.perf_counter() - start
+        logger.info(f"相似截图查询: {len(results)} 张, 索引 {len(self.hash_index)} 条, {elapsed * 1000:.1f} ms")
+        SimilarCapturesDialog(path, results, elapsed, self).exec_()
+
+    def choose_captures_to_compare(self):
+        """选择两张截图（较早的作为基准）进行像素对比"""
+        paths, _ = QFileDialog.getOpenFileNames(self, "选择两张截图", self.save_path,
+                                                "图片 (" + " ".join("*" + ext for ext in IMAGE_EXTENSIONS) + ")")
+        if not paths:
+            return
+        if len(paths) != 2:
+            QMessageBox.warning(self, "截图对比", "请选择两张截图")
+            return
+        self.compare_captures(*sorted(paths, key=os.path.getmtime))
+
+    def compare_captures(self, before_path, after_path):
+        """后台对比两张截图，完成后显示叠加图和变化区域"""
+        def finished(result):
+            overlay_path, boxes, summary = result
+            self.set_status(f"截图对比完成: {len(boxes)} 个变化区域")
+            CaptureDiffDialog(overlay_path, boxes, summary, self).exec_()
+
+        self.set_status("截图对比: 计算中")
+        self.background.submit(diff_capture_files, before_path, after_path,
+                               callback=finished)
+
+    def build_retention(self):
+        """根据设置创建保存目录的保留策略
+
+        未设置上限时也登记本工具写入的文件，之后启用上限时这些截图同样受管理。
+        旧的管理器先停止并等待线程退出，避免两个管理器同时清理。
+        """
+        if self.retention:
+            self.file_writer.on_written = None
+            self.retention.stop()
+            self.retention = None
+        if not self.background_services:
+            return
+        max_bytes = int(float(self.settings.value("retention_max_mb", 0)) * 1024 * 1024)
+        max_files = int(self.settings.value("retention_max_files", 0))
+        max_age = float(self.settings.value("retention_max_age_days", 0)) * 86400
+        index_path = os.path.join(QStandardPaths.writableLocation(QStandardPaths.GenericDataLocation),
+                                  "ScreenshotTool", "retention_index.jsonl")
+        # 归档目录为空时直接删除
+        self.retention = RetentionManager(self.save_path, index_path, max_bytes, max_files, max_age,
+                                          self.settings.value("retention_archive_dir", "") or None)
+        self.file_writer.on_written = self.retention.record
+
+    def show_storage_status(self):
+        """托盘菜单：显示保存目录占用和保留策略"""
+        if self.retention is None:
+            return
+        status = self.retention.status()
+        if not self.retention.enabled:
+            message = (f"{status['files']} 个文件, {status['bytes'] / 1024 / 1024:.1f} MB\n"
+                       "未设置上限（retention_max_mb / retention_max_files / retention_max_age_days）")
+        else:
+            limits = []
+            if status["max_bytes"]:
+                limits.append(f"{status['max_bytes'] / 1024 / 1024:.0f} MB")
+            if status["max_files"]:
+                limits.append(f"{status['max_files']} 个文件")
+            if status["max_age"]:
+                limits.append(f"{status['max_age'] / 86400:g} 天")
+            message = (f"{status['files']} 个文件, {status['bytes'] / 1024 / 1024:.1f} MB (上限 {', '.join(limits)})\n"
+                       f"已{'归档' if self.retention.archive_dir else '删除'} {status['removed_files']} 个文件, "
+                       f"{status['removed_bytes'] / 1024 / 1024:.1f} MB")
+        logger.info(f"存储占用: {message}")
+        if self.tray_icon:
+            self.tray_icon.showMessage("存储占用", message, QSystemTrayIcon.Information, 5000)
+
+    def on_sink_result(self, result):
+        """工作线程：次要输出完成，失败时在状态栏提示"""
+        sink, ok, _, _ = result
+        if not ok:
+            self.status_message.emit(f"{sink.name} 输出失败")
+
+    def build_sinks(self):
+        """根据设置创建输出列表，文件输出始终启用"""
+        if self.dispatcher:
+            self.dispatcher.close()
+
+        spill = self.spill_transcoder if self.spill_enabled else None
+        sinks = [FileSink(self.file_writer, self.save_path, self.output_profile, spill)]
+        for mirror in str(self.settings.value("mirror_dirs", "")).split(";"):
+            if mirror.strip():
+                sinks.append(FileSink(self.file_writer, mirror.strip(), self.output_profile, name=f"镜像:{mirror.strip()}"))
+        if self.settings.value("clipboard_enabled", False, type=bool):
+            sinks.append(ClipboardSink())
+        if self.settings.value("shm_export_enabled", False, type=bool):
+            screen_size = QApplication.primaryScreen().size()
+            sinks.append(SharedMemoryFrameSink(
+                segment_name=self.settings.value("shm_name", "screenshot_tool_frame"),
+                notify_port=int(self.settings.value("shm_notify_port", 47800)),
+                capacity=SharedMemoryFrameSink.HEADER_SIZE + screen_size.width() * screen_size.height() * 4
+            ))
+        socket_port = int(self.settings.value("socket_sink_port", 0))
+        if socket_port:
+            try:
+                sinks.append(SocketSink(socket_port, self.output_profile))
+            except OSError as e:
+                logger.error(f"套接字输出启动失败: {e}")
+        self.dispatcher = FrameDispatcher(sinks)
+
+    def edit_pipeline(self):
+        """以 JSON 编辑后处理流水线配置"""
+        current = self.settings.value("pipeline", "") or json.dumps({"stages": [], "variants": []}, indent=2)
+        text, ok = QInputDialog.getMultiLineText(self, "处理流水线", "流水线配置 (JSON):", current)
+        if not ok:
+            return
+        try:
+            pipeline = CapturePipeline(json.loads(text or "{}"), self.file_writer)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            QMessageBox.warning(self, "错误", f"流水线配置无效: {e}")
+            return
+        self.pipeline.shutdown()
+        self.pipeline = pipeline
+        self.settings.setValue("pipeline", text)
+
+    def set_region_presets(self, regions):
+        """更新区域预设并写入设置"""
+        self.region_presets = regions
+        self.settings.setValue("region_presets", json.dumps(
+            [{"name": name, "x": x, "y": y, "width": w, "height": h} for name, x, y, w, h in regions],
+            ensure_ascii=False, indent=2))
+
+    def save_selection_as_preset(self):
+        """把当前选择框保存为命名区域预设，同名预设会被替换"""
+        if not self.rect.isValid():
+            QMessageBox.information(self, "区域预设", "请先选择区域")
+            return
+        name, ok = QInputDialog.getText(self, "区域预设", "预设名称:")
+        name = sanitize_filename(name).strip()
+        if not ok or not name:
+            return
+        rect = self.rect
+        regions = [region for region in self.region_presets if region[0] != name]
+        regions.append((name, rect.x(), rect.y(), rect.width(), rect.height()))
+        self.set_region_presets(regions)
+        self.set_status(f"已保存区域预设: {name} ({rect.width()}x{rect.height()})")
+
+    def edit_region_presets(self):
+        """以 JSON 编辑区域预设"""
+        current = self.settings.value("region_presets", "") or "[]"
+        text, ok = QInputDialog.getMultiLineText(self, "区域预设", "区域预设 (JSON):", current)
+        if not ok:
+            return
+        try:
+            regions = parse_region_presets(text)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            QMessageBox.warning(self, "错误", f"区域预设无效: {e}")
+            return
+        self.set_region_presets(regions)
+
+    def capture_region_presets(self):
+        """一次抓屏，按全部区域预设裁剪，并行编码后写出共享时间戳的文件和清单"""
+        if not self.region_presets:
+            QMessageBox.information(self, "区域预设", "尚未配置区域预设")
+            return
+        # 工具显示中时使用冻结的截图（即用户看到的画面），否则重新抓一帧
+        if self.isVisible() and self.screenshot_image is not None:
+            image = self.screenshot_image
+        else:
+            image = self.grab_screen()
+            if self.idle:
+                # 与定时任务一致，空闲时不保留抓屏缓冲
+                self.capture_backend.release()
+        if image.isNull():
+            self.set_status("屏幕捕获失败")
+            return
+        from datetime import datetime
+        now = datetime.now()
+        name = sanitize_filename(now.strftime(self.filename_format))
+        image = image.convertToFormat(QImage.Format_RGB32)
+        if self.region_pool is None:
+            self.region_pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 2),
+                                                  thread_name_prefix="RegionEncode")
+        start = time.perf_counter()
+
+        def finished(manifest):
+            saved = sum(1 for entry in manifest["regions"] if "file" in entry)
+            failed = len(manifest["regions"]) - saved
+            logger.info(f"区域预设截图: {saved} 个区域, {(time.perf_counter() - start) * 1000:.1f} ms -> {manifest['manifest']}")
+            message = f"已保存 {saved} 个预设区域" + (f" ({failed} 个失败)" if failed else "")
+            self.set_status(message)
+            if self.tray_icon and not self.isVisible():
+                self.tray_icon.showMessage("区域预设截图", message, QSystemTrayIcon.Information, 3000)
+
+        def run(regions, directory, profile):
+            # BGRX 视图，各区域在编码线程中裁剪和转换；image 在编码结束前一直被引用
+            frame = qimage_to_ndarray(image)
+            return capture_regions(frame, regions, directory, name, profile, self.file_writer, self.region_pool,
+                                   now.isoformat(timespec="milliseconds"))
+
+        self.background.submit(run, list(self.region_presets), self.save_path, self.output_profile, callback=finished)
+
+    def start_capture_job(self, job):
+        """界面线程：为定时任务抓一帧，返回在工作线程中裁剪、编码、写文件和清理过期结果的函数"""
+        regions = [region for region in self.region_presets if not job.regions or region[0] in job.regions]
+        missing = set(job.regions) - {region[0] for region in regions}
+        if missing:
+            logger.warning(f"定时任务 {job.name} 引用了不存在的区域预设: {', '.join(sorted(missing))}")
+        if not regions:
+            raise ValueError("没有可用的区域预设")
+        image = self.grab_screen()
+        if self.idle:
+            # 空闲时不保留抓屏缓冲
+            self.capture_backend.release()
+        if image.isNull():
+            raise ValueError("屏幕捕获失败")
+        image = image.convertToFormat(QImage.Format_RGB32)
+        from datetime import datetime
+        now = datetime.now()
+        directory = os.path.join(self.save_path, "jobs", job.name)
+        if self.region_pool is None:
+            self.region_pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 2),
+                                                  thread_name_prefix="RegionEncode")
+        writer, pool = self.file_writer, self.region_pool
+
+        def run():
+            frame = qimage_to_ndarray(image)
+            manifest = capture_regions(frame, regions, directory, f"{job.name}_{now.strftime('%Y%m%d_%H%M%S_%f')[:-3]}",
+                                       job.profile, writer, pool, now.isoformat(timespec="milliseconds"))
+            failed = [entry["name"] for entry in manifest["regions"] if "file" not in entry]
+            apply_run_retention(directory, job.retention)
+            if failed:
+                raise ValueError(f"区域保存失败: {', '.join(failed)}")
+            return manifest
+
+        return run
+
+    def show_capture_job_stats(self):
+        """托盘菜单：显示定时任务的执行统计"""
+        report = self.scheduler.report() or "尚未配置定时任务"
+        logger.info(f"定时任务统计:\n{report}")
+        QMessageBox.information(self, "定时任务统计", report)
+
+    def edit_capture_jobs(self):
+        """以 JSON 编辑定时任务"""
+        current = self.settings.value("capture_jobs", "") or "[]"
+        text, ok = QInputDialog.getMultiLineText(self, "定时任务", "定时任务 (JSON):", current)
+        if not ok:
+            return
+        try:
+            jobs = parse_capture_jobs(text)
+            self.scheduler.set_jobs(jobs)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            QMessageBox.warning(self, "错误", f"定时任务配置无效: {e}")
+            return
+        self.settings.setValue("capture_jobs", text)
+
     def quit_application(self):
         """退出应用程序"""
+        if self.profile_session:
+            self.finish_profiling()
+        if self.streamer:
+            self.streamer.stop()
+            self.streamer = None
+        if self.trace_recorder:
+            self.trace_recorder.stop()
+            self.trace_recorder = None
         if self.tray_icon:
             self.tray_icon.hide()
+        if self.dispatcher:
+            self.dispatcher.close()
+            self.dispatcher = None
+        if self.hash_index:
+            self.hash_index.stop()
+            self.hash_index = None
+        self.scheduler.stop()
+        if self.retention:
+            self.retention.stop()
+            self.retention = None
+        if self.region_pool:
+            self.region_pool.shutdown(wait=False, cancel_futures=True)
+            self.region_pool = None
+        self.spill_transcoder.stop()
+        self.pipeline.shutdown()
+        self.capture_backend.close()
         self.close()
 
     def create_toolbar(self):
         """创建截图工具栏"""
         """创建截图工具栏"""
         self.toolbar = QFrame(self)
-        self.toolbar.setGeometry(10, 10, 465, 50)
+        self.toolbar.setGeometry(10, 10, 565, 50)
         self.toolbar.setStyleSheet("""
             QFrame {
                 background-color: rgba(44, 62, 80, 200);
@@ -685,6 +4912,10 @@ class ScreenshotTool(QMainWindow):
         self.capture_btn = QPushButton("截图")
         self.capture_btn.clicked.connect(self.capture_selected_area)
 
+        # 标注按钮
+        self.annotate_btn = QPushButton("标注")
+        self.annotate_btn.setMenu(self.create_annotation_menu())
+
         # 设置按钮
         self.settings_btn = QPushButton("设置")
         self.settings_btn.clicked.connect(self.open_settings)
@@ -698,9 +4929,10 @@ class ScreenshotTool(QMainWindow):
         self.close_btn.clicked.connect(self.quit_application)
 
         # 状态标签
-        self.status_label = QLabel("就绪")
+        self.status_label = QLabel(self.status_text)
 
         layout.addWidget(self.capture_btn)
+        layout.addWidget(self.annotate_btn)
         layout.addWidget(self.settings_btn)
         layout.addWidget(self.minimize_btn)
         layout.addWidget(self.close_btn)
@@ -708,6 +4940,168 @@ class ScreenshotTool(QMainWindow):
 
         self.toolbar.show()
 
+    def create_annotation_menu(self):
+        """创建标注工具菜单"""
+        menu = QMenu(self)
+        group = QActionGroup(self)
+
+        modes = [(None, "无")] + list(Annotation.KINDS.items())
+        for mode, label in modes:
+            action = QAction(label, self)
+            action.setCheckable(True)
+            action.setChecked(mode is None)
+            action.triggered.connect(lambda checked, m=mode: self.set_annotation_mode(m))
+            group.addAction(action)
+            menu.addAction(action)
+
+        menu.addSeparator()
+        proposals_action = QAction("采用文字打码建议", self)
+        proposals_action.triggered.connect(self.apply_text_proposals)
+        menu.addAction(proposals_action)
+
+        undo_action = QAction("撤销标注", self)
+        undo_action.triggered.connect(self.undo_annotation)
+        menu.addAction(undo_action)
+
+        clear_action = QAction("清除标注", self)
+        clear_action.triggered.connect(self.clear_annotations)
+        menu.addAction(clear_action)
+        return menu
+
+    def set_annotation_mode(self, mode):
+        """切换标注工具，None 表示普通选择模式"""
+        self.annotation_mode = mode
+        self.set_status(f"标注: {Annotation.KINDS[mode]}" if mode else "就绪")
+
+    def begin_annotation(self, pos):
+        """在选择框内开始绘制标注"""
+        local = pos - self.rect.topLeft()
+        if self.annotation_mode == "text":
+            text, ok = QInputDialog.getText(self, "添加文字", "文字:")
+            if ok and text:
+                dirty = self.annotations.add(Annotation("text", local, text=text))
+                self.update(dirty.translated(self.rect.topLeft()))
+            return
+        self.current_annotation = Annotation(self.annotation_mode, local)
+        self.annotations.add(self.current_annotation)
+
+    def update_annotation(self, pos):
+        """拖动时更新正在绘制的标注，只刷新变化的区域"""
+        item = self.current_annotation
+        old_bounds = item.bounds()
+        local = pos - self.rect.topLeft()
+        item.end = QPoint(max(0, min(local.x(), self.rect.width() - 1)),
+                          max(0, min(local.y(), self.rect.height() - 1)))
+        dirty = self.annotations.update_item(item, old_bounds)
+        self.update(dirty.translated(self.rect.topLeft()))
+
+    def finish_annotation(self):
+        """结束绘制，丢弃过小的图形"""
+        item = self.current_annotation
+        self.current_annotation = None
+        if item.is_empty():
+            dirty = self.annotations.remove(item)
+            self.update(dirty.translated(self.rect.topLeft()))
+
+    def undo_annotation(self):
+        """撤销最后一个标注"""
+        dirty = self.annotations.undo()
+        if dirty.isValid():
+            self.update(dirty.translated(self.rect.topLeft()))
+
+    def clear_annotations(self):
+        """清除全部标注"""
+        self.annotations.clear()
+        self.update()
+
+    def schedule_snap_index(self):
+        """截屏后在后台分析整屏边缘，建立吸附用的候选矩形索引"""
+        self.snap_generation += 1
+        self.snap_index = None
+        self.hover_candidate = None
+        if not self.snap_enabled or self.screenshot.isNull():
+            return
+        if self.screenshot_image is None:
+            self.screenshot_image = self.screenshot.toImage()
+        self.background.submit(self.build_snap_index, self.screenshot_image, self.snap_generation,
+                               callback=self.on_snap_index_ready)
+
+    @staticmethod
+    def build_snap_index(image, generation):
+        """后台线程：检测候选矩形并建立索引"""
+        start = time.perf_counter()
+        pixels = qimage_to_ndarray(image.convertToFormat(QImage.Format_RGB32))
+        index = SnapIndex(find_snap_candidates(pixels))
+        logger.debug(f"吸附索引: {len(index)} 个候选矩形, {(time.perf_counter() - start) * 1000:.1f} ms")
+        return generation, index
+
+    def on_snap_index_ready(self, result):
+        generation, index = result
+        if generation == self.snap_generation:
+            self.snap_index = index
+
+    def snap_point(self, pos, modifiers=Qt.NoModifier):
+        """把点吸附到附近的边缘，按住 Alt 时不吸附"""
+        if self.snap_index is None or modifiers & Qt.AltModifier:
+            return pos
+        return QPoint(self.snap_index.snap_x(pos.x(), self.snap_distance),
+                      self.snap_index.snap_y(pos.y(), self.snap_distance))
+
+    def update_loupe(self, pos):
+        """更新像素放大镜，源图像在首次使用时转换一次"""
+        if not self.loupe_enabled or self.screenshot.isNull():
+            return
+        if self.screenshot_image is None:
+            self.screenshot_image = self.screenshot.toImage()
+        self.loupe.update_at(self.screenshot_image, pos)
+
+    def update_hover_candidate(self, pos):
+        """没有选择区域时高亮光标下最小的候选矩形"""
+        candidate = self.snap_index.candidate_at(pos.x(), pos.y()) if self.snap_index else None
+        if candidate == self.hover_candidate:
+            return
+        self.hover_candidate = candidate
+        if candidate is None and self.label is not None:
+            self.label.setPixmap(self.screenshot)
+        self.update()
+
+    def schedule_text_detection(self):
+        """选择区域确定后在后台检测文字区域，截图时建议已准备好"""
+        self.detection_generation += 1
+        self.text_proposals = []
+        if not self.text_detection_enabled or not self.rect.isValid() or self.screenshot.isNull():
+            return
+        # QPixmap 只能在界面线程使用，这里先转为 QImage 再交给后台线程
+        image = self.screenshot.copy(self.rect).toImage()
+        self.background.submit(self.run_text_detection, image, self.detection_generation, QRect(self.rect),
+                               callback=self.on_text_detection_finished)
+
+    @staticmethod
+    def run_text_detection(image, generation, rect):
+        """后台线程：检测文字区域"""
+        start = time.perf_counter()
+        pixels = qimage_to_ndarray(image.convertToFormat(QImage.Format_RGB32))
+        regions = detect_text_regions(pixels)
+        elapsed = time.perf_counter() - start
+        megapixels = image.width() * image.height() / 1e6
+        logger.debug(f"文字区域检测: {len(regions)} 个, {elapsed * 1000:.1f} ms ({elapsed * 1000 / megapixels:.1f} ms/MP)")
+        return generation, rect, regions
+
+    def on_text_detection_finished(self, result):
+        """界面线程：保存检测结果，过期结果直接丢弃"""
+        generation, rect, regions = result
+        if generation != self.detection_generation or rect != self.rect:
+            return
+        self.text_proposals = [QRect(x, y, w, h) for x, y, w, h in regions]
+        self.update()
+
+    def apply_text_proposals(self):
+        """把文字区域建议转为马赛克打码区域"""
+        for proposal in self.text_proposals:
+            self.annotations.add(Annotation("mosaic", proposal.topLeft(), proposal.bottomRight()))
+        self.text_proposals = []
+        self.update()
+
     def toggle_visibility(self):
         logger.debug(self.hidden)
         """切换隐藏/显示状态"""
@@ -716,22 +5110,86 @@ class ScreenshotTool(QMainWindow):
         else:
             self.hide_screenshot_tool()
 
-    def clear_canvas(self):
-        """清空画布"""
-        # 清空截图和矩形选择
+    def memory_report(self):
+        """按缓冲统计持有的字节数，返回 [(名称, 字节)]，最后一项为进程常驻内存"""
+        def pixmap_bytes(pixmap):
+            if pixmap is None or pixmap.isNull():
+                return 0
+            return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+        label_pixmap = self.label.pixmap() if self.label is not None else None
+        report = [
+            ("截图 QPixmap", pixmap_bytes(self.screenshot)),
+            ("截图 QImage", self.screenshot_image.sizeInBytes() if self.screenshot_image is not None else 0),
+            ("遮罩合成图", pixmap_bytes(label_pixmap)),
+            ("标注缓存层", pixmap_bytes(self.annotations.cache)),
+            ("放大镜网格", pixmap_bytes(self.loupe.grid) if self.loupe is not None else 0),
+            (f"抓屏后端({self.capture_backend.name})", self.capture_backend.buffer_bytes()),
+            ("吸附索引", len(self.snap_index) * 4 * 8 if self.snap_index else 0),
+        ]
+        report.append(("进程常驻内存", process_rss() or 0))
+        return report
+
+    def log_memory_report(self, title="内存占用"):
+        """把内存占用报告写入日志并返回摘要文字"""
+        report = self.memory_report()
+        held = sum(size for _, size in report[:-1])
+        lines = [f"{name}: {size / 1024 / 1024:.1f} MB" for name, size in report]
+        logger.info(f"{title}: " + ", ".join(lines))
+        return f"缓冲合计 {held / 1024 / 1024:.1f} MB, 常驻内存 {report[-1][1] / 1024 / 1024:.1f} MB"
+
+    def show_memory_report(self):
+        """托盘菜单：显示内存占用报告"""
+        summary = self.log_memory_report()
+        self.tray_icon.showMessage("内存占用", summary, QSystemTrayIcon.Information, 5000)
+
+    def enter_idle_mode(self):
+        """进入空闲状态：释放所有整屏尺寸的缓冲并销毁遮罩控件"""
+        if self.idle:
+            return
+        self.idle = True
+        # 丢弃尚未返回的后台分析结果
+        self.snap_generation += 1
+        self.detection_generation += 1
+        self.snap_index = None
+        self.hover_candidate = None
+        self.text_proposals = []
+        self.annotation_mode = None
+        self.current_annotation = None
+        self.annotations.release()
         self.screenshot = QPixmap()
+        self.screenshot_image = None
         self.rect = QRect()
         self.start_point = QPoint()
         self.end_point = QPoint()
-        
-        # 清空标签显示
-        self.label.clear()
-        self.label.setText("截图工具已隐藏")
-        self.label.setStyleSheet("color: white; font-size: 24px;")
-        
-        # 强制刷新显示
-        self.label.repaint()
-        self.repaint()
+        self.release_overlay_widgets()
+        self.capture_backend.release()
+        # 等控件的延迟删除执行后再统计
+        QTimer.singleShot(500, self.check_idle_memory)
+
+    def check_idle_memory(self):
+        """空闲后的常驻内存应回到首次空闲时的基线附近，超出上限时告警"""
+        if not self.idle:
+            return
+        release_free_memory()
+        rss = process_rss()
+        self.log_memory_report("空闲内存")
+        if rss is None:
+            return
+        if self.idle_baseline_rss is None:
+            self.idle_baseline_rss = rss
+            return
+        growth = rss - self.idle_baseline_rss
+        if growth > self.idle_memory_bound:
+            logger.warning(f"空闲常驻内存比基线多 {growth / 1024 / 1024:.1f} MB，"
+                           f"超出上限 {self.idle_memory_bound / 1024 / 1024:.0f} MB")
+
+    def leave_idle_mode(self):
+        """退出空闲状态：重建遮罩控件，截图由调用方重新抓取"""
+        if not self.idle:
+            return
+        self.idle = False
+        self.build_overlay_widgets()
 
     def hide_screenshot_tool(self):
         """隐藏截图工具"""
@@ -739,12 +5197,10 @@ class ScreenshotTool(QMainWindow):
         self.hidden_pos = self.pos()
         self.hidden_size = self.size()
 
-        # 清空画布
-        self.clear_canvas()
-
-        # 隐藏主窗口
+        # 隐藏主窗口并进入空闲状态
         self.hide()
         self.hidden = True
+        self.enter_idle_mode()
 
         # 显示迷你控制面板
         self.mini_control.setGeometry(self.hidden_pos.x(), self.hidden_pos.y(),
@@ -756,57 +5212,69 @@ class ScreenshotTool(QMainWindow):
         # 隐藏迷你控制面板
         self.mini_control.hide()
 
-        # 恢复主窗口
+        # 恢复主窗口，重建遮罩控件
         self.setGeometry(0, 0, QApplication.primaryScreen().size().width(),
                          QApplication.primaryScreen().size().height())
+        self.leave_idle_mode()
         self.showFullScreen()
         self.hidden = False
 
-        # 强制清空之前的显示
-        self.label.clear()
-        self.label.setStyleSheet("")
-        
         # 延迟重新捕获屏幕，确保窗口完全显示
         QTimer.singleShot(50, self.delayed_show_screen)
 
     def delayed_show_screen(self):
         """延迟重新捕获屏幕"""
+        # 显示后 50 ms 内又被隐藏时遮罩控件已销毁，不再抓屏
+        if self.idle:
+            return
         self.capture_screen()
         self.reset_selection()
 
+    def grab_screen(self, rect=None):
+        """通过当前抓屏后端抓取整屏或指定区域，返回 QImage"""
+        return self.capture_backend.grab(rect)
+
     def capture_screen(self):
         """捕获整个屏幕并显示在标签上"""
         # 确保清除之前的截图
         self.screenshot = QPixmap()
+        self.screenshot_image = None
+        self.loupe.reset()
         
-        # 获取主屏幕并捕获
-        screen = QApplication.primaryScreen()
-        if screen:
-            self.screenshot = screen.grabWindow(0)
-            if not self.screenshot.isNull():
-                self.label.setPixmap(self.screenshot)
-            else:
-                # 如果捕获失败，显示错误信息
-                self.label.setText("屏幕捕获失败")
-                self.label.setStyleSheet("color: red; font-size: 24px;")
+        # 通过抓屏后端捕获
+        image = self.grab_screen()
+        if not image.isNull():
+            self.screenshot_image = image
+            self.screenshot = QPixmap.fromImage(image)
+            self.label.setPixmap(self.screenshot)
+            self.schedule_snap_index()
+        else:
+            # 如果捕获失败，显示错误信息
+            self.label.setText("屏幕捕获失败")
+            self.label.setStyleSheet("color: red; font-size: 24px;")
         
         self.reset_selection()
 
+    @property
+    def rect(self):
+        """当前选择框（保存在选择框模型中）"""
+        return self.selection.rect
+
+    @rect.setter
+    def rect(self, value):
+        self.selection.rect = value
+
+    def set_cursor_shape(self, shape):
+        """只在光标形状变化时调用 setCursor"""
+        if shape != self.cursor_shape:
+            self.cursor_shape = shape
+            self.setCursor(shape)
+
     def setup_locked_size(self):
         """设置锁定大小的矩形"""
         screen_size = QApplication.primaryScreen().size()
-        center_x = screen_size.width() // 2
-        center_y = screen_size.height() // 2
-        
-        self.rect = QRect(
-            center_x - self.locked_size.width() // 2,
-            center_y - self.locked_size.height() // 2,
-            self.locked_size.width(),
-            self.locked_size.height()
-        )
-        
-        # 确保矩形在屏幕内
-        self.rect = self.rect.intersected(QRect(0, 0, screen_size.width(), screen_size.height()))
+        self.rect = SelectionModel.centered(self.locked_size,
+                                            QRect(0, 0, screen_size.width(), screen_size.height()))
 
     def reset_selection(self):
         """重置选择区域"""
@@ -823,8 +5291,11 @@ class ScreenshotTool(QMainWindow):
         self.dragging_rect = False
         self.dragging_control_point = False
         self.active_control_point = None
+        self.current_annotation = None
+        self.annotations.clear()
+        self.schedule_text_detection()
         self.update()
-        self.status_label.setText("就绪")
+        self.set_status("就绪")
         self.label.setPixmap(self.screenshot)
 
     def mousePressEvent(self, event):
@@ -836,6 +5307,11 @@ class ScreenshotTool(QMainWindow):
                 self.open_size_dialog()
                 return
 
+            # 标注模式下在选择框内绘制标注
+            if self.annotation_mode and self.rect.isValid() and self.rect.contains(event.pos()):
+                self.begin_annotation(event.pos())
+                return
+
             # 如果启用了锁定大小，只允许拖动整个矩形
             if self.lock_size_enabled and self.rect.isValid():
                 if self.rect.contains(event.pos()):
@@ -861,73 +5337,76 @@ class ScreenshotTool(QMainWindow):
                     # 绘制新矩形模式
                     if not self.lock_size_enabled:
                         self.dragging = True
-                        self.start_point = event.pos()
-                        self.end_point = event.pos()
+                        self.start_point = self.snap_point(event.pos(), event.modifiers())
+                        self.end_point = self.start_point
                         self.rect = QRect()
+                        self.annotations.clear()
+                        self.text_proposals = []
 
             self.update()
 
     def mouseMoveEvent(self, event):
         """鼠标移动事件"""
-        if self.dragging and not self.lock_size_enabled:
-            self.end_point = event.pos()
+        self.update_loupe(event.pos())
+        if self.current_annotation:
+            self.update_annotation(event.pos())
+        elif self.dragging and not self.lock_size_enabled:
+            self.end_point = self.snap_point(event.pos(), event.modifiers())
             self.rect = self.get_selection_rect()
             self.update()
         elif self.dragging_rect and self.rect.isValid():
-            # 计算新的矩形位置
-            new_top_left = event.pos() - self.drag_offset
-            width = self.rect.width()
-            height = self.rect.height()
-
-            # 确保矩形不会移出屏幕
-            new_top_left.setX(max(0, min(new_top_left.x(), self.width() - width)))
-            new_top_left.setY(max(0, min(new_top_left.y(), self.height() - height)))
-
-            # 更新矩形位置
-            self.rect.moveTo(new_top_left)
+            # 移动矩形，确保不会移出屏幕
+            self.rect = self.selection.moved_to(event.pos() - self.drag_offset,
+                                                QRect(0, 0, self.width(), self.height()))
             if not self.lock_size_enabled:
                 self.start_point = self.rect.topLeft()
                 self.end_point = self.rect.bottomRight()
             self.update()
         elif self.dragging_control_point and self.active_control_point and self.rect.isValid() and not self.lock_size_enabled:
             # 调整控制点位置
-            self.adjust_rect_from_control_point(event.pos())
+            self.adjust_rect_from_control_point(self.snap_point(event.pos(), event.modifiers()))
             self.update()
         elif self.rect.isValid():
-            # 更新鼠标光标形状
-            if self.lock_size_enabled:
-                # 锁定大小时只显示移动光标
-                if self.rect.contains(event.pos()):
-                    self.setCursor(Qt.SizeAllCursor)
-                else:
-                    self.setCursor(Qt.ArrowCursor)
+            # 更新鼠标光标形状（锁定大小时只显示移动光标）
+            if self.annotation_mode and self.rect.contains(event.pos()):
+                self.set_cursor_shape(Qt.CrossCursor)
             else:
-                control_point = self.get_control_point_at(event.pos())
-                if control_point:
-                    cursor = self.get_cursor_for_control_point(control_point)
-                    self.setCursor(cursor)
-                elif self.rect.contains(event.pos()):
-                    self.setCursor(Qt.SizeAllCursor)
-                else:
-                    self.setCursor(Qt.ArrowCursor)
+                self.set_cursor_shape(self.selection.cursor_at(event.pos(), self.lock_size_enabled))
+        elif not self.lock_size_enabled:
+            self.update_hover_candidate(event.pos())
 
     def mouseReleaseEvent(self, event):
         """鼠标释放事件"""
         if event.button() == Qt.LeftButton:
-            if self.dragging:
+            if self.current_annotation:
+                self.finish_annotation()
+            elif self.dragging:
                 self.dragging = False
-                self.end_point = event.pos()
+                self.end_point = self.snap_point(event.pos(), event.modifiers())
                 self.rect = self.get_selection_rect()
+                # 单击（没有拖动）时选中光标下的候选矩形
+                if self.rect.width() < 3 and self.rect.height() < 3 and self.hover_candidate:
+                    self.rect = QRect(self.hover_candidate)
+                    self.start_point = self.rect.topLeft()
+                    self.end_point = self.rect.bottomRight()
+                self.hover_candidate = None
+                self.schedule_text_detection()
             elif self.dragging_rect:
                 self.dragging_rect = False
+                self.schedule_text_detection()
             elif self.dragging_control_point:
                 self.dragging_control_point = False
                 self.active_control_point = None
+                self.schedule_text_detection()
 
             self.update()
 
     def keyPressEvent(self, event):
         """键盘事件处理"""
+        if event.matches(QKeySequence.Undo) and not self.annotations.is_empty():
+            self.undo_annotation()
+            return
+
         # 使用QKeySequence来匹配配置的快捷键
         key_sequence = QKeySequence(event.key() | event.modifiers())
         
@@ -955,7 +5434,9 @@ class ScreenshotTool(QMainWindow):
 
     def paintEvent(self, event):
         """绘制事件 - 绘制矩形选择框和尺寸文本"""
-        if self.dragging or self.rect.isValid():
+        if self.idle:
+            return
+        if self.dragging or self.rect.isValid() or self.hover_candidate:
             # 创建屏幕截图副本
             pixmap = self.screenshot.copy()
             painter = QPainter(pixmap)
@@ -964,6 +5445,15 @@ class ScreenshotTool(QMainWindow):
             painter.setBrush(QColor(0, 0, 0, 100))
             painter.drawRect(0, 0, pixmap.width(), pixmap.height())
 
+            # 高亮光标下的候选区域
+            if self.hover_candidate and not self.rect.isValid():
+                painter.setCompositionMode(QPainter.CompositionMode_Source)
+                painter.drawPixmap(self.hover_candidate, self.screenshot, self.hover_candidate)
+                painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
+                painter.setPen(QPen(QColor(52, 152, 219), 2, Qt.DashLine))
+                painter.setBrush(Qt.NoBrush)
+                painter.drawRect(self.hover_candidate)
+
             # 清除选择区域内的遮罩
             if self.rect.isValid():
                 rect = self.rect
@@ -975,6 +5465,20 @@ class ScreenshotTool(QMainWindow):
                 painter.setPen(pen)
                 painter.drawRect(rect)
 
+                # 绘制标注缓存层
+                if not self.annotations.is_empty():
+                    self.annotations.resize(rect.size())
+                    painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
+                    painter.drawPixmap(rect.topLeft(), self.annotations.cache)
+                    painter.setCompositionMode(QPainter.CompositionMode_Source)
+
+                # 绘制文字打码建议
+                if self.text_proposals:
+                    painter.setPen(QPen(QColor(255, 165, 0), 1, Qt.DashLine))
+                    painter.setBrush(Qt.NoBrush)
+                    for proposal in self.text_proposals:
+                        painter.drawRect(proposal.translated(rect.topLeft()))
+
                 # 绘制控制点和调整手柄
                 if not self.lock_size_enabled:
                     self.draw_control_points(painter, rect)
@@ -1017,145 +5521,31 @@ class ScreenshotTool(QMainWindow):
             self.label.setPixmap(pixmap)
 
     def draw_control_points(self, painter, rect):
-        """绘制控制点和调整手柄"""
-        # 清空控制点列表
-        self.control_points = []
+        """绘制控制点和调整手柄（位置由选择框模型缓存）"""
+        handles = self.selection.handles()
 
         # 绘制四个角的控制点
-        for point_type, pos in [
-            ('topleft', rect.topLeft()),
-            ('topright', rect.topRight()),
-            ('bottomleft', rect.bottomLeft()),
-            ('bottomright', rect.bottomRight())
-        ]:
-            # 计算控制点位置
-            control_rect = QRect(
-                pos.x() - self.control_point_size // 2,
-                pos.y() - self.control_point_size // 2,
-                self.control_point_size,
-                self.control_point_size
-            )
-
-            # 保存控制点位置和类型
-            self.control_points.append((control_rect, point_type))
-
-            # 绘制控制点
-            painter.setPen(QPen(Qt.blue, 1))
-            painter.setBrush(QBrush(Qt.red))
-            painter.drawRect(control_rect)
-
-        # 绘制四个边的调整手柄
-        # 上边中点
-        top_center = QPoint(rect.left() + rect.width() // 2, rect.top())
-        top_handle = QRect(
-            top_center.x() - self.edge_handle_length // 2,
-            top_center.y() - self.edge_handle_size // 2,
-            self.edge_handle_length,
-            self.edge_handle_size
-        )
-        self.control_points.append((top_handle, 'top'))
-
-        # 下边中点
-        bottom_center = QPoint(rect.left() + rect.width() // 2, rect.bottom())
-        bottom_handle = QRect(
-            bottom_center.x() - self.edge_handle_length // 2,
-            bottom_center.y() - self.edge_handle_size // 2,
-            self.edge_handle_length,
-            self.edge_handle_size
-        )
-        self.control_points.append((bottom_handle, 'bottom'))
-
-        # 左边中点
-        left_center = QPoint(rect.left(), rect.top() + rect.height() // 2)
-        left_handle = QRect(
-            left_center.x() - self.edge_handle_size // 2,
-            left_center.y() - self.edge_handle_length // 2,
-            self.edge_handle_size,
-            self.edge_handle_length
-        )
-        self.control_points.append((left_handle, 'left'))
-
-        # 右边中点
-        right_center = QPoint(rect.right(), rect.top() + rect.height() // 2)
-        right_handle = QRect(
-            right_center.x() - self.edge_handle_size // 2,
-            right_center.y() - self.edge_handle_length // 2,
-            self.edge_handle_size,
-            self.edge_handle_length
-        )
-        self.control_points.append((right_handle, 'right'))
+        painter.setPen(QPen(Qt.blue, 1))
+        painter.setBrush(QBrush(Qt.red))
+        for handle, _ in handles[:4]:
+            painter.drawRect(handle)
 
         # 绘制边手柄
-        painter.setPen(QPen(Qt.blue, 1))
         painter.setBrush(QBrush(Qt.green))
-        painter.drawRect(top_handle)
-        painter.drawRect(bottom_handle)
-        painter.drawRect(left_handle)
-        painter.drawRect(right_handle)
+        for handle, _ in handles[4:]:
+            painter.drawRect(handle)
 
     def get_control_point_at(self, pos):
         """检查鼠标位置是否在控制点上"""
-        for rect, point_type in self.control_points:
-            if rect.contains(pos):
-                return point_type
-        return None
-
-    def get_cursor_for_control_point(self, point_type):
-        """根据控制点类型返回适当的鼠标光标"""
-        if point_type in ['topleft', 'bottomright']:
-            return Qt.SizeFDiagCursor
-        elif point_type in ['topright', 'bottomleft']:
-            return Qt.SizeBDiagCursor
-        elif point_type in ['top', 'bottom']:
-            return Qt.SizeVerCursor
-        elif point_type in ['left', 'right']:
-            return Qt.SizeHorCursor
-        return Qt.ArrowCursor
+        return self.selection.handle_at(pos)
 
     def adjust_rect_from_control_point(self, mouse_pos):
         """根据控制点调整矩形大小"""
         if not self.active_control_point or not self.rect.isValid():
             return
 
-        # 创建矩形副本
-        rect = self.rect.normalized()
-
-        # 根据控制点类型调整矩形
-        if self.active_control_point == 'topleft':
-            rect.setTopLeft(mouse_pos)
-        elif self.active_control_point == 'topright':
-            rect.setTopRight(mouse_pos)
-        elif self.active_control_point == 'bottomleft':
-            rect.setBottomLeft(mouse_pos)
-        elif self.active_control_point == 'bottomright':
-            rect.setBottomRight(mouse_pos)
-        elif self.active_control_point == 'top':
-            rect.setTop(mouse_pos.y())
-        elif self.active_control_point == 'bottom':
-            rect.setBottom(mouse_pos.y())
-        elif self.active_control_point == 'left':
-            rect.setLeft(mouse_pos.x())
-        elif self.active_control_point == 'right':
-            rect.setRight(mouse_pos.x())
-
-        # 确保矩形不小于最小尺寸
-        min_size = 20
-        if rect.width() < min_size:
-            if self.active_control_point in ['left', 'topleft', 'bottomleft']:
-                rect.setLeft(rect.right() - min_size)
-            else:
-                rect.setRight(rect.left() + min_size)
-
-        if rect.height() < min_size:
-            if self.active_control_point in ['top', 'topleft', 'topright']:
-                rect.setTop(rect.bottom() - min_size)
-            else:
-                rect.setBottom(rect.top() + min_size)
-
-        # 确保矩形在屏幕范围内
-        rect = rect.intersected(QRect(0, 0, self.width(), self.height()))
-
-        # 更新矩形
+        rect = self.selection.resized_from_handle(self.active_control_point, mouse_pos,
+                                                  QRect(0, 0, self.width(), self.height()))
         self.rect = rect
         self.start_point = rect.topLeft()
         self.end_point = rect.bottomRight()
@@ -1163,23 +5553,28 @@ class ScreenshotTool(QMainWindow):
     def get_selection_rect(self):
         """获取规范化矩形区域"""
         if self.dragging:
-            return QRect(
-                min(self.start_point.x(), self.end_point.x()),
-                min(self.start_point.y(), self.end_point.y()),
-                abs(self.start_point.x() - self.end_point.x()),
-                abs(self.start_point.y() - self.end_point.y())
-            )
+            return SelectionModel.from_points(self.start_point, self.end_point)
         elif self.rect.isValid():
             return self.rect
         return QRect()
 
     def open_size_dialog(self):
         """打开尺寸修改对话框"""
-        dialog = SizeInputDialog(self.rect.size(), self)
-        if dialog.exec_() == QDialog.Accepted:
-            new_size = dialog.get_size()
-            lock_size = dialog.get_lock_size()
-            if new_size and new_size.isValid() and new_size.width() >= 10 and new_size.height() >= 10:
+        if self.scripted_dialog_results:
+            result = self.scripted_dialog_results.popleft()
+        else:
+            dialog = SizeInputDialog(self.rect.size(), self)
+            result = None
+            if dialog.exec_() == QDialog.Accepted:
+                size = dialog.get_size()
+                if size:
+                    result = [size.width(), size.height(), dialog.get_lock_size()]
+            if self.trace_recorder:
+                self.trace_recorder.record_dialog("size", result)
+        if result:
+            new_size = QSize(result[0], result[1])
+            lock_size = result[2]
+            if new_size.isValid() and new_size.width() >= 10 and new_size.height() >= 10:
                 # 更新锁定大小设置
                 self.locked_size = new_size
                 self.lock_size_enabled = lock_size
@@ -1190,23 +5585,11 @@ class ScreenshotTool(QMainWindow):
                 self.settings.setValue("lock_size_enabled", lock_size)
                 
                 if not lock_size:
-                    # 保持矩形中心点不变
-                    center = self.rect.center()
-                    new_rect = QRect(0, 0, new_size.width(), new_size.height())
-                    new_rect.moveCenter(center)
-
-                    # 确保矩形在屏幕内
-                    if new_rect.left() < 0:
-                        new_rect.moveLeft(0)
-                    if new_rect.top() < 0:
-                        new_rect.moveTop(0)
-                    if new_rect.right() > self.width():
-                        new_rect.moveRight(self.width())
-                    if new_rect.bottom() > self.height():
-                        new_rect.moveBottom(self.height())
-
-                    self.rect = new_rect
+                    # 保持矩形中心点不变，确保矩形在屏幕内
+                    self.rect = self.selection.resized_around_center(new_size,
+                                                                     QRect(0, 0, self.width(), self.height()))
                 
+                self.schedule_text_detection()
                 self.update()
 
     def open_settings(self):
@@ -1216,6 +5599,8 @@ class ScreenshotTool(QMainWindow):
             self.save_path, self.filename_format, self.hotkeys = dialog.get_settings()
             self.save_settings()
             self.setup_shortcuts()  # 重新设置快捷键
+            self.build_sinks()
+            self.build_retention()
 
     def save_settings(self):
         """保存设置"""
@@ -1273,71 +5658,97 @@ class ScreenshotTool(QMainWindow):
     def capture_selected_area(self):
         """捕获选定区域并进行处理"""
         if not self.rect.isValid() or self.rect.width() < 10 or self.rect.height() < 10:
-            self.status_label.setText("区域无效，请重新选择")
-            QTimer.singleShot(2000, lambda: self.status_label.setText("就绪"))
+            self.set_status("区域无效，请重新选择")
+            QTimer.singleShot(2000, lambda: self.set_status("就绪"))
             return
 
+        # 自动采用后台检测出的文字打码建议
+        if self.text_proposals and self.settings.value("text_detection_auto_apply", False, type=bool):
+            self.apply_text_proposals()
+
         # 从原始截图获取选定区域
         selected_area = self.screenshot.copy(self.rect)
 
-        # 转换为OpenCV格式（修复内存对齐问题）
+        # 转换为OpenCV格式（视图已处理行尾填充字节）
         qimage = selected_area.toImage().convertToFormat(QImage.Format_RGB888)
-        width = qimage.width()
-        height = qimage.height()
-
-        # 获取每行的字节数和总字节数
-        bytes_per_line = qimage.bytesPerLine()
-        total_bytes = bytes_per_line * height
 
-        # 获取图像数据
-        ptr = qimage.bits()
-        ptr.setsize(total_bytes)
+        pixels = qimage_to_ndarray(qimage)
 
-        # 创建numpy数组
-        arr = np.frombuffer(ptr, dtype=np.uint8, count=total_bytes)
+        # 先在像素视图上原地打码，再栅格化标注，标注不会被打码覆盖
+        if not self.annotations.is_empty():
+            apply_redactions(pixels, self.annotations.redactions(),
+                             block_size=int(self.settings.value("redact_block_size", 12)),
+                             blur_size=int(self.settings.value("redact_blur_size", 25)))
+            painter = QPainter(qimage)
+            self.annotations.render(painter)
+            painter.end()
 
-        # 处理内存对齐问题
-        if bytes_per_line == width * 3:
-            # 没有填充字节的情况
-            cv_image = arr.reshape(height, width, 3)
-        else:
-            # 有填充字节的情况 - 逐行处理
-            cv_image = np.zeros((height, width, 3), dtype=np.uint8)
-            for i in range(height):
-                start = i * bytes_per_line
-                end = start + width * 3
-                row_data = arr[start:end].reshape(width, 3)
-                cv_image[i] = row_data
+        cv_image = cv2.cvtColor(pixels, cv2.COLOR_RGB2BGR)
 
-        # 转换为BGR格式
-        cv_image = cv2.cvtColor(cv_image, cv2.COLOR_RGB2BGR)
+        # 后处理流水线（主输出）
+        try:
+            output_image = self.pipeline.process(cv_image)
+        except Exception as e:
+            # 界面线程的槽函数中未捕获的异常会使 Qt 终止进程，流水线失败时保存未处理的截图
+            logger.error(f"处理流水线执行失败: {e}")
+            output_image = cv_image
 
         # 生成文件名
         from datetime import datetime
-        filename = datetime.now().strftime(self.filename_format) + ".png"
-        filename = re.sub(r'[\\/*?:"<>|]', '', filename)  # 过滤非法字符
-        filepath = os.path.join(self.save_path, filename)
-
-        # 确保目录存在
-        os.makedirs(self.save_path, exist_ok=True)
-
-        # 保存截图
-        # success = cv2.imwrite(filepath, cv_image)
-        success = cv2.imencode('.png', cv_image)[1].tofile(filepath)  # 替换imwrite
-        logger.debug(success)
-        if os.path.isfile(filepath):
-            # 显示状态信息
-            self.status_label.setText(f"已保存: {filename}")
-            # 重置选择区域
-            self.reset_selection()
-        else:
-            logger.debug("保存失败")
-            self.status_label.setText("保存失败")
-            QTimer.singleShot(3000, lambda: self.status_label.setText("就绪"))
+        name = datetime.now().strftime(self.filename_format)
+        name = sanitize_filename(name)
+
+        # 转换和编码只做一次，结果并发分发到各个输出
+        results = self.dispatcher.dispatch(CaptureFrame(output_image, name), on_result=self.on_sink_result)
+        _, saved, result, _ = results[0]
+        failed = [sink.name for sink, ok, _, _ in results[1:] if not ok]
+
+        if not saved:
+            # 可能是磁盘已满，立即按保留策略清理
+            if self.retention:
+                self.retention.enforce_now()
+            self.set_status("保存失败")
+            QTimer.singleShot(3000, lambda: self.set_status("就绪"))
+            return
+
+        filepath, spilled = result
+
+        # 衍生版本在进程池中生成
+        self.pipeline.submit_variants(cv_image, filepath)
+        if self.hash_index:
+            self.hash_index.submit_image(filepath, output_image)
+
+        # 显示状态信息
+        message = f"已保存: {os.path.basename(filepath)}"
+        if spilled:
+            message += " (后台转码中)"
+        if failed:
+            message += f" ({', '.join(failed)} 失败)"
+        # 重置选择区域后显示保存结果
+        self.reset_selection()
+        self.set_status(message)
 
 
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser(description="截图工具")
+    parser.add_argument("--replay", metavar="TRACE", help="无界面回放操作轨迹并输出耗时报告")
+    parser.add_argument("--budget-ms", type=float, help="回放时单个事件（处理+绘制）p95 耗时上限，超出则返回非零")
+    parser.add_argument("--diff", nargs=2, metavar=("BEFORE", "AFTER"), help="无界面对比两张截图，写出叠加图和变化区域 JSON")
+    parser.add_argument("--diff-out", metavar="PATH", help="叠加图输出路径（默认 AFTER_diff.png）")
+    parser.add_argument("--diff-threshold", type=int, default=24, help="像素差值阈值（0-255）")
+    args, qt_args = parser.parse_known_args()
+    if args.diff:
+        try:
+            _, boxes, _ = diff_capture_files(*args.diff, out_path=args.diff_out, threshold=args.diff_threshold)
+        except ValueError as e:
+            logger.error(f"截图对比失败: {e}")
+            sys.exit(2)
+        # 有变化时返回 1，便于脚本判断
+        sys.exit(1 if boxes else 0)
+    if args.replay:
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+    app = QApplication(sys.argv[:1] + qt_args)
     app.setStyle(QStyleFactory.create('Fusion'))
 
     # 设置应用样式
@@ -1356,6 +5767,28 @@ if __name__ == "__main__":
     palette.setColor(QPalette.HighlightedText, Qt.black)
     app.setPalette(palette)
 
+    if args.replay:
+        # 回放使用临时目录中的独立设置和保存目录：轨迹中的对话框结果不会写入用户设置，
+        # 也不会恢复用户的溢写文件或遍历其截图目录
+        replay_dir = tempfile.mkdtemp(prefix="screenshot_replay_")
+        settings = QSettings(os.path.join(replay_dir, "settings.ini"), QSettings.IniFormat)
+        settings.setValue("save_path", os.path.join(replay_dir, "captures"))
+        window = ScreenshotTool(settings, background_services=False)
+        report = InputTraceReplayer(window, args.replay).run()
+        window.quit_application()
+        report_path = os.path.splitext(args.replay)[0] + ".report.json"
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        for kind, entry in report["by_type"].items():
+            logger.info(f"{kind}: {entry['count']} 次, 处理 p95 {entry['handler_ms']['p95']} ms, "
+                        f"绘制 p95 {entry['paint_ms']['p95']} ms")
+        logger.info(f"回放完成: {report['events']} 个事件, 总耗时 p95 {report['total_ms']['p95']} ms -> {report_path}")
+        shutil.rmtree(replay_dir, ignore_errors=True)
+        if args.budget_ms is not None and report["total_ms"]["p95"] > args.budget_ms:
+            logger.error(f"p95 耗时 {report['total_ms']['p95']} ms 超出上限 {args.budget_ms} ms")
+            sys.exit(1)
+        sys.exit(0)
+
     window = ScreenshotTool()
     window.showFullScreen()
     
@@ -0,0 +1,91 @@
+"""空闲内存测试：反复显示/隐藏后，隐藏时的常驻内存应回到基线附近
+
+使用临时目录中的独立设置和合成抓屏后端，不读写用户设置，不启动溢写恢复和哈希索引补算。
+"""
+import os
+import time
+
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtCore import QEvent, QRect, QSettings
+from PyQt5.QtWidgets import QApplication
+
+from screenshot_tool import ScreenshotTool, SyntheticCaptureBackend, process_rss, release_free_memory
+
+# 4K 画面，一帧约 33 MB，泄漏一帧就会超出默认的 32 MB 上限
+WIDTH, HEIGHT = 3840, 2160
+CYCLES = 5
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QApplication.instance() or QApplication([])
+
+
+@pytest.fixture
+def tool(app, tmp_path):
+    settings = QSettings(str(tmp_path / "settings.ini"), QSettings.IniFormat)
+    settings.setValue("save_path", str(tmp_path / "captures"))
+    settings.setValue("capture_backend", "synthetic")
+    tool = ScreenshotTool(settings, background_services=False)
+    tool.capture_backend.close()
+    tool.capture_backend = SyntheticCaptureBackend(WIDTH, HEIGHT)
+    yield tool
+    tool.quit_application()
+    process_events()
+
+
+def process_events(duration=0.0):
+    """处理事件（含延迟删除），duration 秒内持续处理以便单次定时器触发"""
+    deadline = time.perf_counter() + duration
+    while True:
+        QApplication.processEvents()
+        QApplication.sendPostedEvents(None, QEvent.DeferredDelete)
+        if time.perf_counter() >= deadline:
+            break
+        time.sleep(0.01)
+
+
+def show_and_hide(tool):
+    """显示、抓屏、框选并绘制一次，然后隐藏，返回隐藏后的常驻内存"""
+    tool.show_screenshot_tool()
+    process_events(0.2)
+    assert tool.screenshot_image is not None
+    tool.rect = QRect(200, 150, 1200, 800)
+    tool.repaint()
+    process_events()
+    tool.hide_screenshot_tool()
+    process_events(0.1)
+    release_free_memory()
+    return process_rss()
+
+
+def test_hidden_holds_no_frame_buffers(tool):
+    show_and_hide(tool)
+    assert tool.idle
+    # 最后一项是进程常驻内存，其余缓冲隐藏后都应为 0
+    held = {name: size for name, size in tool.memory_report()[:-1] if size}
+    assert not held
+
+
+def test_idle_rss_returns_to_baseline(tool):
+    baseline = show_and_hide(tool)
+    if baseline is None:
+        pytest.skip("无法读取进程常驻内存")
+    samples = [show_and_hide(tool) for _ in range(CYCLES)]
+    growth = max(samples) - baseline
+    assert growth <= tool.idle_memory_bound, (
+        f"隐藏后常驻内存比基线多 {growth / 1024 / 1024:.1f} MB，"
+        f"上限 {tool.idle_memory_bound / 1024 / 1024:.0f} MB")
+
+
+def test_hide_before_delayed_capture(tool):
+    show_and_hide(tool)
+    # 显示后立即隐藏，延迟抓屏的定时器在空闲状态下触发
+    tool.show_screenshot_tool()
+    tool.hide_screenshot_tool()
+    process_events(0.2)
+    assert tool.idle
+    assert tool.screenshot_image is None
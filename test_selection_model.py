@@ -0,0 +1,156 @@
+"""SelectionModel 几何测试：手柄命中、拖动缩放、平移和居中"""
+import pytest
+from PyQt5.QtCore import QPoint, QRect, QSize
+
+from screenshot_tool import SelectionModel
+
+BOUNDS = QRect(0, 0, 800, 600)
+
+
+def make_model(rect, **options):
+    model = SelectionModel(**options)
+    model.rect = QRect(rect)
+    return model
+
+
+def expected_handle(model, pos):
+    """按 handles() 的顺序逐个判断包含关系，作为 handle_at 的参照实现"""
+    for handle_rect, handle in model.handles():
+        if handle_rect.contains(pos):
+            return handle
+    return None
+
+
+@pytest.mark.parametrize("rect", [
+    QRect(100, 100, 200, 150),
+    QRect(50, 60, 101, 77),   # 奇数尺寸，中心取整
+    QRect(10, 10, 25, 25),    # 角点与边手柄区域重叠
+    QRect(200, 200, 6, 6),    # 比控制点还小，左右、上下区域重叠
+])
+def test_handle_at_matches_handles(rect):
+    model = make_model(rect)
+    reach = max(model.point_size, model.handle_size, model.handle_length)
+    mismatches = []
+    for x in range(rect.left() - reach - 2, rect.right() + reach + 3):
+        for y in range(rect.top() - reach - 2, rect.bottom() + reach + 3):
+            pos = QPoint(x, y)
+            expected = expected_handle(model, pos)
+            if model.handle_at(pos) != expected:
+                mismatches.append((x, y, expected, model.handle_at(pos)))
+    assert not mismatches, mismatches[:10]
+
+
+def test_handle_at_follows_in_place_changes():
+    model = make_model(QRect(100, 100, 200, 150))
+    assert model.handle_at(QPoint(100, 100)) == 'topleft'
+    # 原地修改矩形后缓存的手柄也要更新
+    model.rect.moveTo(300, 300)
+    assert model.handle_at(QPoint(100, 100)) is None
+    assert model.handle_at(QPoint(300, 300)) == 'topleft'
+
+
+def test_handle_at_invalid_rect():
+    model = SelectionModel()
+    assert model.handle_at(QPoint(0, 0)) is None
+
+
+@pytest.mark.parametrize("handle, pos", [
+    ('right', QPoint(105, 200)),
+    ('left', QPoint(295, 200)),
+    ('bottom', QPoint(200, 102)),
+    ('top', QPoint(200, 248)),
+    ('bottomright', QPoint(101, 101)),
+    ('topleft', QPoint(299, 249)),
+    ('topright', QPoint(100, 249)),
+    ('bottomleft', QPoint(299, 100)),
+])
+def test_resized_from_handle_keeps_min_size(handle, pos):
+    model = make_model(QRect(100, 100, 200, 150))
+    rect = model.resized_from_handle(handle, pos, BOUNDS)
+    assert rect.width() >= model.min_size
+    assert rect.height() >= model.min_size
+    assert BOUNDS.contains(rect)
+
+
+def test_resized_from_handle_keeps_opposite_edge():
+    model = make_model(QRect(100, 100, 200, 150))
+    rect = model.resized_from_handle('left', QPoint(295, 200), BOUNDS)
+    assert rect.right() == 299
+    rect = model.resized_from_handle('bottom', QPoint(200, 102), BOUNDS)
+    assert rect.top() == 100
+
+
+def test_resized_from_handle_clamps_to_bounds():
+    model = make_model(QRect(100, 100, 200, 150))
+    rect = model.resized_from_handle('bottomright', QPoint(5000, 5000), BOUNDS)
+    assert rect.topLeft() == QPoint(100, 100)
+    assert rect.bottomRight() == BOUNDS.bottomRight()
+    rect = model.resized_from_handle('topleft', QPoint(-40, -40), BOUNDS)
+    assert rect.topLeft() == BOUNDS.topLeft()
+    assert rect.bottomRight() == QPoint(299, 249)
+
+
+def test_resized_from_handle_min_size_at_bounds_edge():
+    model = make_model(QRect(0, 0, 200, 150))
+    # 最小尺寸把左边推到 bounds 之外时按 bounds 裁剪
+    rect = model.resized_from_handle('right', QPoint(-30, 50), BOUNDS)
+    assert BOUNDS.contains(rect)
+    assert rect.left() == 0
+
+
+def test_moved_to_inside_bounds():
+    model = make_model(QRect(100, 100, 200, 150))
+    assert model.moved_to(QPoint(300, 200), BOUNDS) == QRect(300, 200, 200, 150)
+
+
+@pytest.mark.parametrize("top_left, expected", [
+    (QPoint(-50, -20), QPoint(0, 0)),
+    (QPoint(5000, 5000), QPoint(600, 450)),
+    (QPoint(700, -5), QPoint(600, 0)),
+    (QPoint(-5, 500), QPoint(0, 450)),
+])
+def test_moved_to_clamps(top_left, expected):
+    model = make_model(QRect(100, 100, 200, 150))
+    rect = model.moved_to(top_left, BOUNDS)
+    assert rect.topLeft() == expected
+    assert rect.size() == QSize(200, 150)
+    assert BOUNDS.contains(rect)
+
+
+def test_moved_to_offset_bounds():
+    # 多屏时 bounds 不一定从原点开始
+    bounds = QRect(-1920, 0, 1920, 1080)
+    model = make_model(QRect(-500, 100, 200, 150))
+    assert model.moved_to(QPoint(100, 100), bounds).topLeft() == QPoint(-200, 100)
+    assert model.moved_to(QPoint(-5000, 100), bounds).topLeft() == QPoint(-1920, 100)
+
+
+def test_resized_around_center_keeps_center():
+    model = make_model(QRect(300, 200, 100, 100))
+    rect = model.resized_around_center(QSize(60, 40), BOUNDS)
+    assert rect.size() == QSize(60, 40)
+    assert rect.center() == model.rect.center()
+
+
+@pytest.mark.parametrize("rect", [
+    QRect(0, 0, 50, 50),
+    QRect(750, 550, 50, 50),
+    QRect(0, 550, 50, 50),
+    QRect(750, 0, 50, 50),
+])
+def test_resized_around_center_shifts_into_bounds(rect):
+    model = make_model(rect)
+    result = model.resized_around_center(QSize(300, 200), BOUNDS)
+    assert result.size() == QSize(300, 200)
+    assert BOUNDS.contains(result)
+
+
+def test_centered():
+    rect = SelectionModel.centered(QSize(320, 240), BOUNDS)
+    assert rect == QRect(240, 180, 320, 240)
+    assert rect.center() == BOUNDS.center()
+
+
+def test_centered_larger_than_bounds():
+    rect = SelectionModel.centered(QSize(1000, 300), BOUNDS)
+    assert rect == QRect(0, 150, 800, 300)